@@ -0,0 +1,54 @@
+from temgymbasic import components as comp
+from temgymbasic.functions import make_test_sample
+
+import numpy as np
+import time
+
+'''Timing and the columns which the benchmarks share. The benchmarks are run from this directory,
+such as "python benchmark_stepping.py", so they import from here with
+"from _common import best_time".'''
+
+sample = make_test_sample()
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+def make_tem_components(beam_tilt = None, condenser_stig = None, objective_stig = None,
+                        stigmators = True, extra_components = ()):
+    '''TEM column with condenser and objective apertures, stigmators, a beam tilt double deflector
+    and a sample. The keyword arguments of the beam tilt and the stigmators can be changed, and
+    other components are added in order of their z.'''
+    beam_tilt = {'updefx': 0.01} if beam_tilt is None else beam_tilt
+    components = [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.08),
+                  comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+                  comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, **beam_tilt),
+                  comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+                  comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+                  comp.Aperture(name = 'Objective Aperture', z = 1.0, aperture_radius_inner = 0.05),
+                  comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+    if stigmators:
+        components += [comp.Quadrupole(name = 'Condenser Stig', z = 2.2, **(condenser_stig or {})),
+                       comp.AstigmaticLens(name = 'Objective Stig', z = 0.8,
+                                           **(objective_stig or {}))]
+
+    return sorted(components + list(extra_components),
+                  key = lambda component: -component.plane_z_positions()[0])
+
+def make_4dstem_components(sample_z = 1.2):
+    return [comp.DoubleDeflector(name = 'Scan Coils', z_up = 2.0, z_low = 1.9),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = sample_z),
+            comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.8, z_low = 0.7)]
+
+def make_biprism_components():
+    return [comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.5),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Biprism(name = 'Biprism', z = 1.0, deflection = 0.05, theta = np.pi/2),
+            comp.Deflector(name = 'Image Shift', z = 0.6, defx = 0.01, defy = -0.02),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
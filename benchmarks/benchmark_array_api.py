@@ -0,0 +1,26 @@
+from temgymbasic.model import Model
+from _common import best_time, make_tem_components
+
+import importlib
+import sys
+
+'''Benchmark of tracing with other array namespaces than numpy (Model(array_namespace=...)), for a
+full step and for the detector image of trace_chunked. The namespaces to time can be given by module
+name on the command line, such as "python benchmark_array_api.py array_api_strict torch". The
+conformance of array_api_strict with numpy is tested in tests/test_array_api.py.'''
+
+def make_model(array_namespace, num_rays):
+    return Model(make_tem_components(), beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+                 gun_beam_semi_angle = 0.15, detector_pixels = 256,
+                 array_namespace = array_namespace)
+
+namespaces = [importlib.import_module(name) for name in (sys.argv[1:] or ['array_api_strict'])]
+
+num_rays = 2**20
+
+print('{:>24} {:>14} {:>18}'.format('namespace', 'step (ms)', 'detector image (ms)'))
+for xp in [None] + namespaces:
+    model = make_model(xp, num_rays)
+    step_time = best_time(model.update_rays_stepwise, 3)
+    image_time = best_time(model.trace_chunked, 3)
+    print('{:>24} {:>14.3f} {:>18.3f}'.format(model.xp.__name__, step_time*1e3, image_time*1e3))
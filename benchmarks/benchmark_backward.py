@@ -0,0 +1,43 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of forming the detector image of a TEM column by tracing backwards from the centre of
+every detector pixel (Model.trace_backward), or by tracing beams of more and more rays forwards
+(Model.trace_chunked). The backward images are tested against the forward images of the gun rays of
+the pixels (Model.backward_gun_rays) in tests/test_backward.py. Forward images leave holes in the
+pixels of the backward image that no ray hits, which are counted.'''
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.2),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.8),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Lens(name = 'Objective Lens', z = 1.0, f = -0.15),
+            comp.Aperture(name = 'Objective Aperture', z = 0.8, aperture_radius_inner = 0.05),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 0.7, fx = -2.0, fy = -2.2),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+beams = {'paralell': {'beam_radius': 0.15}, 'point': {'gun_beam_semi_angle': 0.05}}
+
+print('{:>10} {:>10} {:>12} {:>16} {:>12}'.format('beam', 'method', 'rays', 'time (ms)', 'holes'))
+
+for beam_type, beam_kwargs in beams.items():
+    model = Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = 2**10,
+                  detector_pixels = 256, **beam_kwargs)
+
+    ray_image, sample_image = model.trace_backward()
+    lit = (ray_image > 0) | (sample_image != 0)
+
+    backward_time = best_time(model.trace_backward, 10)
+    print('{:>10} {:>10} {:>12} {:>16.3f} {:>12}'.format(
+        beam_type, 'backward', model.detector_pixels**2, backward_time*1e3, 0))
+
+    for num_rays in [2**16, 2**20]:
+        forward_ray_image, forward_sample_image, _ = model.trace_chunked(num_rays = num_rays)
+        holes = np.count_nonzero(lit & (forward_ray_image == 0) & (forward_sample_image == 0))
+        forward_time = best_time(lambda: model.trace_chunked(num_rays = num_rays), 3)
+        print('{:>10} {:>10} {:>12} {:>16.3f} {:>12}'.format(
+            beam_type, 'forward', num_rays, forward_time*1e3, holes))
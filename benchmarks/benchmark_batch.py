@@ -0,0 +1,51 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of a focal length sweep of the objective lens of a TEM column. Each configuration is
+traced by changing the lens and stepping the model, or every configuration is traced at once with
+Model.trace_batch. The rays, blocked rays and detector images of each configuration are tested
+against those of the steps in tests/test_batch.py. Small beams gain the most, as the time of large
+beams goes into writing the rays of every plane of every configuration.'''
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.08),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Quadrupole(name = 'Condenser Stig', z = 2.2),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, updefx = 0.01),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Aperture(name = 'Objective Aperture', z = 1.0, aperture_radius_inner = 0.05),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+focal_lengths = np.linspace(-0.3, -0.15, 64)
+params = [{'Objective Lens': {'f': f}} for f in focal_lengths]
+
+def sweep_steps():
+    r, blocked_at = [], []
+    for f in focal_lengths:
+        objective_lens.f = f
+        objective_lens.set_matrix()
+        model.update_component_matrix()
+        model.step()
+        r.append(model.r.copy())
+        blocked_at.append(model.get_blocked_at().copy())
+
+    return np.stack(r), np.stack(blocked_at)
+
+print('{:>10} {:>10} {:>16} {:>18} {:>10}'.format(
+    'configs', 'rays', 'steps (ms)', 'trace_batch (ms)', 'speedup'))
+
+for num_rays in [2**10, 2**14]:
+    model = Model(make_components(), beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+                  gun_beam_semi_angle = 0.15, detector_pixels = 256)
+    model.step()
+    objective_lens = model.components[4]
+
+    step_time = best_time(sweep_steps, 3)
+    batch_time = best_time(lambda: model.trace_batch(params), 3)
+
+    print('{:>10} {:>10} {:>16.3f} {:>18.3f} {:>10.2f}'.format(
+        len(focal_lengths), num_rays, step_time*1e3, batch_time*1e3, step_time/batch_time))
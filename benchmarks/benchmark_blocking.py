@@ -0,0 +1,52 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of finding the blocked rays of a column with several stops. Each stop is tested
+against its whole plane with one boolean array per component, or every stop is tested against a
+tile of rays in one fused pass (Model.find_blocked_rays). With Model(defer_blocking=True), a step
+only propagates the rays, and the blocked rays are found when they are first needed. The codes of
+the blocked rays are tested against each other in tests/test_blocking.py.'''
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.08),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Aperture(name = 'Selected Area Aperture', z = 2.0, aperture_radius_inner = 0.05),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Biprism(name = 'Biprism', z = 1.3, deflection = 0.01, width = 0.001),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Aperture(name = 'Objective Aperture', z = 1.0, aperture_radius_inner = 0.05),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+def find_blocked_rays_per_stop(model):
+    # Every stop allocates a boolean array of all rays
+    blocked_at = np.full(model.num_rays, len(model.components), dtype=model.blocked_at.dtype)
+    planes = model.get_plane_arrays()
+    for component_idx, component in enumerate(model.components):
+        if component.stops_rays:
+            blocked = component.blocked(planes[model.component_plane_idcs[component_idx]])
+            blocked_at[blocked & (blocked_at > component_idx)] = component_idx
+
+    return blocked_at
+
+num_rays = 2**20
+
+model = Model(make_components(), beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+              gun_beam_semi_angle = 0.15)
+deferred = Model(make_components(), beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+                 gun_beam_semi_angle = 0.15, defer_blocking = True)
+model.step()
+
+per_stop_time = best_time(lambda: find_blocked_rays_per_stop(model), 5)
+fused_time = best_time(lambda: model.find_blocked_rays(model.get_plane_arrays(),
+                                                      model.blocked_at), 5)
+step_time = best_time(model.update_rays_stepwise, 5)
+deferred_step_time = best_time(deferred.update_rays_stepwise, 5)
+
+print('{:>32} {:>12}'.format('', 'time (ms)'))
+print('{:>32} {:>12.3f}'.format('blocked rays, per stop', per_stop_time*1e3))
+print('{:>32} {:>12.3f}'.format('blocked rays, fused', fused_time*1e3))
+print('{:>32} {:>12.3f}'.format('step', step_time*1e3))
+print('{:>32} {:>12.3f}'.format('step, deferred blocking', deferred_step_time*1e3))
@@ -0,0 +1,40 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import sample
+
+import time
+import tracemalloc
+
+'''Benchmark of Model.trace_chunked() on the 4DSTEM column from the live calibration examples. The
+peak memory of a chunked trace is set by the memory budget, not by the number of rays, so the number
+of rays can be much larger than would fit in the ray matrix of the model. The merged images are
+tested against a trace of the whole beam in tests/test_chunked.py.'''
+
+components = [comp.DoubleDeflector(name = 'Scan Coils', z_up = 0.3, z_low = 0.25, updefx = 0.01),
+              comp.Lens(name = 'Lens', z = 0.20),
+              comp.Sample(name = 'Sample', sample = sample, z = 0.15, width = 0.000256),
+              comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.1, z_low = 0.05)]
+
+model = Model(components, beam_z = 0.4, beam_type = 'paralell', num_rays = 2**10,
+              experiment = '4DSTEM', detector_pixels = 256, detector_size = 0.0128)
+
+memory_budget = 2**27
+
+print('{:>10} {:>16} {:>12} {:>10} {:>16}'.format(
+    'num_rays', 'unchunked (MB)', 'chunk size', 'time (s)', 'peak memory (MB)'))
+
+for power in range(18, 25, 2):
+    tracemalloc.start()
+    start = time.perf_counter()
+    model.trace_chunked(memory_budget, num_rays = 2**power)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    model.num_rays = 2**power
+    chunk_size = model.get_chunk_size(memory_budget)
+    unchunked = model.estimate_ray_memory()
+    model.num_rays = 2**10
+
+    print('{:>10} {:>16.1f} {:>12} {:>10.3f} {:>16.1f}'.format(
+        2**power, unchunked/2**20, chunk_size, elapsed, peak/2**20))
@@ -0,0 +1,40 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of dropping blocked rays during propagation (Model(drop_blocked_rays=True)) on a TEM
+column with a condenser aperture, for a range of aperture radii. With blocked rays dropped, the
+planes below the aperture are only computed for the rays that pass it, so the time of a step
+follows the number of transmitted rays. The rays are tested against those of a model which keeps
+every ray in tests/test_drop_blocked.py.'''
+
+def make_components(aperture_radius):
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6,
+                          aperture_radius_inner = aperture_radius),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Quadrupole(name = 'Condenser Stig', z = 2.2),
+            comp.Deflector(name = 'Beam Tilt', z = 1.9),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 1.0),
+            comp.Lens(name = 'Intermediate Lens', z = 0.6, f = -0.2),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+num_rays = 2**20
+
+print('{:>16} {:>14} {:>14} {:>14} {:>10}'.format(
+    'aperture radius', 'transmitted', 'all rays (ms)', 'dropped (ms)', 'speedup'))
+
+for aperture_radius in [0.1, 0.03, 0.01, 0.003]:
+    models = [Model(make_components(aperture_radius), beam_z = 3.0, beam_type = 'point',
+                    num_rays = num_rays, gun_beam_semi_angle = 0.15,
+                    drop_blocked_rays = drop_blocked_rays)
+              for drop_blocked_rays in [False, True]]
+
+    times = [best_time(model.update_rays_stepwise, 5) for model in models]
+
+    print('{:>16} {:>14.3f} {:>14.3f} {:>14.3f} {:>10.2f}'.format(
+        aperture_radius, np.count_nonzero(models[0].allowed_ray_bools())/num_rays,
+        times[0]*1e3, times[1]*1e3, times[0]/times[1]))
@@ -0,0 +1,66 @@
+from temgymbasic.model import Model
+from _common import best_time, make_tem_components, make_biprism_components
+
+import numpy as np
+
+'''Benchmark of the derivatives of the detector rays with respect to every differentiable parameter
+of a column, from Model.jacobian, which propagates them alongside the rays in one pass, or from
+central finite differences, which step the model twice per parameter. The derivatives agree apart
+from rays which are within a step of the wire of a biprism, whose kick is not differentiable there,
+which is tested in tests/test_jacobian.py.'''
+
+def make_jacobian_tem_components():
+    return make_tem_components(beam_tilt = {'updefx': 0.01, 'scan_rotation': 10},
+                               condenser_stig = {'fx': -0.4, 'fy': 0.4},
+                               objective_stig = {'fx': -0.4, 'fy': -0.45})
+
+columns = {'tem': make_jacobian_tem_components, 'biprism': make_biprism_components}
+
+def finite_differences(model, step = 1e-7):
+    jacobian = []
+    for component in model.components:
+        for parameter in component.differentiable_parameters:
+            value = getattr(component, parameter)
+            detector_rays = []
+            for change in [step, -step]:
+                setattr(component, parameter, value + change)
+                component.update_matrices()
+                model.step()
+                detector_rays.append(model.r[-1].copy())
+            setattr(component, parameter, value)
+            component.update_matrices()
+            jacobian.append((detector_rays[0] - detector_rays[1])/(2*step))
+    model.step()
+
+    return np.stack(jacobian)[None]
+
+def differentiable_rays(model, step = 1e-5):
+    '''Rays which are not within a step of the wire of a biprism'''
+    rays = np.ones(model.num_rays, dtype=bool)
+    for idx, component in enumerate(model.components):
+        if component.type == 'Biprism':
+            biprism_rays = model.get_plane_rays(model.component_plane_idcs[idx])
+            rays &= np.abs(biprism_rays[0 if np.sin(component.theta) != 0 else 2]) > step
+
+    return rays
+
+print('{:>10} {:>10} {:>12} {:>18} {:>16} {:>10}'.format(
+    'column', 'parameters', 'max error', 'differences (ms)', 'jacobian (ms)', 'speedup'))
+
+for name, make_components in columns.items():
+    model = Model(make_components(), beam_z = 3.0, beam_type = 'point', num_rays = 2**16,
+                  gun_beam_semi_angle = 0.15)
+    model.step()
+
+    jacobian = model.jacobian()
+    differences = finite_differences(model)
+    rays = differentiable_rays(model)
+
+    error = np.max(np.abs(jacobian - differences)[..., rays])/np.max(np.abs(jacobian))
+
+    differences_time = best_time(lambda: finite_differences(model), 3)
+    jacobian_time = best_time(model.jacobian, 3)
+
+    print('{:>10} {:>10} {:>12.2e} {:>18.3f} {:>16.3f} {:>10.2f}'.format(
+        name, jacobian.shape[1], error, differences_time*1e3, jacobian_time*1e3,
+        differences_time/jacobian_time))
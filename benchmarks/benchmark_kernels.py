@@ -0,0 +1,40 @@
+from temgymbasic import components as comp
+from temgymbasic.functions import make_test_sample
+from _common import best_time
+
+import numpy as np
+
+'''Benchmark of the structure aware kernel of each component (component.apply) against the dense
+5x5 matrix multiplication that was used for every component before. The kernels are tested
+against the matrices in tests/test_kernels.py.'''
+
+num_rays = 2**20
+
+components = [comp.Lens(name = 'Lens', z = 0.5, f = -0.2),
+              comp.AstigmaticLens(name = 'Astigmatic Lens', z = 0.5, fx = -0.2, fy = -0.3),
+              comp.Quadrupole(name = 'Quadrupole', z = 0.5, fx = -0.2, fy = -0.3),
+              comp.Deflector(name = 'Deflector', z = 0.5, defx = 0.01, defy = -0.02),
+              comp.DoubleDeflector(name = 'Double Deflector', z_up = 0.5, z_low = 0.4,
+                                   updefx = 0.01, lowdefx = -0.01, scan_rotation = 30),
+              comp.Biprism(name = 'Biprism', z = 0.5, deflection = 0.01),
+              comp.Aperture(name = 'Aperture', z = 0.5),
+              comp.Sample(name = 'Sample', z = 0.5, sample = make_test_sample())
+              ]
+
+rays = np.random.default_rng(0).normal(size=(5, num_rays))
+rays[4] = 1
+out = np.empty_like(rays)
+
+print('{:>24} {:>14} {:>14} {:>10}'.format(
+    'component (plane)', 'matmul (ms)', 'apply (ms)', 'speedup'))
+
+for component in components:
+    for plane, matrix in enumerate(component.plane_matrices()):
+        matrix = np.asarray(matrix, dtype=np.float64)
+
+        matmul_time = best_time(lambda: np.matmul(matrix, rays, out=out), 10)
+        apply_time = best_time(lambda: component.apply(rays, out, plane), 10)
+
+        print('{:>24} {:>14.3f} {:>14.3f} {:>10.2f}'.format(
+            component.type + ' (' + str(plane) + ')', matmul_time*1e3, apply_time*1e3,
+            matmul_time/apply_time))
@@ -0,0 +1,62 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, make_tem_components, make_4dstem_components
+
+import numpy as np
+
+'''Benchmark of moving deflectors: a wobbler on the beam tilt coils of a TEM column, and a scan of
+the scan and descan coils of a 4DSTEM experiment (Model.update_scan_coil_ratio). Model.step moves
+the rays of every plane along their response to the changed kicks, instead of propagating them
+again from the deflectors (Model.update_rays_stepwise), and then only finds the blocked rays again.
+The rays and blocked rays are tested against propagating the column in tests/test_kicks.py.'''
+
+def make_wobbler_components():
+    return make_tem_components(beam_tilt = {'scan_rotation': 10}, extra_components = [
+        comp.Deflector(name = 'Image Shift', z = 0.6, defx = 0.0, defy = 0.0)])
+
+def wobble(model, time_step):
+    components = {component.name: component for component in model.components}
+    beam_tilt, image_shift = components['Beam Tilt'], components['Image Shift']
+    beam_tilt.updefx = 0.02*np.sin(0.3*time_step)
+    beam_tilt.lowdefx = -2*beam_tilt.updefx
+    beam_tilt.updefy = 0.01*np.cos(0.3*time_step)
+    beam_tilt.set_matrices()
+    image_shift.defx = 0.01*np.sin(0.1*time_step)
+    image_shift.set_matrix()
+
+def scan(model, time_step):
+    model.update_scan_position()
+    model.update_scan_coil_ratio()
+
+def propagate(model):
+    model.update_component_matrix()
+    model.update_rays_stepwise(model.find_first_stale_plane())
+
+columns = {'tem wobbler': (make_wobbler_components,
+                           {'beam_type': 'point', 'gun_beam_semi_angle': 0.15}, wobble),
+           '4dstem scan': (make_4dstem_components, {'experiment': '4DSTEM'}, scan)}
+
+print('{:>16} {:>18} {:>18} {:>18} {:>10}'.format(
+    '', 'blocking', 'propagate (ms)', 'kicks (ms)', 'speedup'))
+
+for name, (make_components, kwargs, move) in columns.items():
+    for defer_blocking in [False, True]:
+        models = [Model(make_components(), beam_z = 3.0, num_rays = 2**18,
+                        defer_blocking = defer_blocking, **kwargs) for _ in range(2)]
+        for model in models:
+            model.step()
+
+        time_steps = iter(range(10**6))
+        def step_kicks():
+            move(models[0], next(time_steps))
+            models[0].step()
+
+        def step_propagate():
+            move(models[1], next(time_steps))
+            propagate(models[1])
+
+        propagate_time = best_time(step_propagate, 10)
+        kicks_time = best_time(step_kicks, 10)
+        print('{:>16} {:>18} {:>18.3f} {:>18.3f} {:>10.2f}'.format(
+            name, 'deferred' if defer_blocking else 'every step', propagate_time*1e3,
+            kicks_time*1e3, propagate_time/kicks_time))
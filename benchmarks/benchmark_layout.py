@@ -0,0 +1,66 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, make_tem_components, make_4dstem_components
+
+import numpy as np
+
+'''Benchmark of changing the geometry of a column: a camera length series which moves the sample of
+a 4DSTEM experiment, and inserting and removing a selected area aperture in a TEM column. The model
+reads the z of every component at each step (Model.update_z_positions), and inserts or removes
+components in place (Model.insert_component, Model.remove_component), so only the planes below the
+change are propagated again, instead of building a new model, which generates the rays again and
+propagates the whole column. The rays of a changed column are tested against those of a new model
+in tests/test_layout.py.'''
+
+def make_selected_area_aperture():
+    return comp.Aperture(name = 'Selected Area Aperture', z = 0.4, aperture_radius_inner = 0.02)
+
+camera_lengths = np.linspace(1.05, 1.3, 10)
+num_rays = 2**18
+
+# Camera length series, moving the sample of a 4DSTEM experiment
+def new_4dstem_model(sample_z):
+    model = Model(make_4dstem_components(sample_z), beam_z = 3.0, experiment = '4DSTEM',
+                  num_rays = num_rays)
+    model.step()
+    return model
+
+model = new_4dstem_model(camera_lengths[0])
+
+def move_sample(sample_z):
+    model.sample.z = sample_z
+    model.set_obj_lens_f_from_overfocus(model.overfocus)
+    model.step()
+
+# Inserting and removing a selected area aperture
+def new_tem_model(selected_area_aperture):
+    components = make_tem_components(stigmators = False, extra_components = [
+        comp.Lens(name = 'Intermediate Lens', z = 0.6, f = -0.2)])
+    if selected_area_aperture:
+        components.insert(7, make_selected_area_aperture())
+    model = Model(components, beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+                  gun_beam_semi_angle = 0.15)
+    model.step()
+    return model
+
+tem_model = new_tem_model(False)
+
+def toggle_aperture():
+    if any(component.name == 'Selected Area Aperture' for component in tem_model.components):
+        tem_model.remove_component('Selected Area Aperture')
+    else:
+        tem_model.insert_component(make_selected_area_aperture())
+    tem_model.step()
+
+print('{:>24} {:>18} {:>18} {:>10}'.format('change', 'new model (ms)', 'in place (ms)', 'speedup'))
+
+sample_zs = iter(np.tile(camera_lengths, 10**3))
+new_model_time = best_time(lambda: new_4dstem_model(next(sample_zs)), 5)
+in_place_time = best_time(lambda: move_sample(next(sample_zs)), 5)
+print('{:>24} {:>18.3f} {:>18.3f} {:>10.2f}'.format(
+    '4dstem camera length', new_model_time*1e3, in_place_time*1e3, new_model_time/in_place_time))
+
+new_model_time = best_time(lambda: new_tem_model(True), 5)
+in_place_time = best_time(toggle_aperture, 6)
+print('{:>24} {:>18.3f} {:>18.3f} {:>10.2f}'.format(
+    'tem selected area', new_model_time*1e3, in_place_time*1e3, new_model_time/in_place_time))
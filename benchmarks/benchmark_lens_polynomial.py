@@ -0,0 +1,61 @@
+from temgymbasic.model import Model
+from _common import best_time, make_tem_components, make_4dstem_components
+
+import numpy as np
+
+'''Benchmark of a focus series of the objective lens of a TEM column, and of an overfocus series of
+a 4DSTEM experiment. The cumulative transfer matrices of every plane are found by changing the lens
+and multiplying the matrices of the column (Model.update_system_matrices), or are evaluated for the
+whole series at once from the polynomial in the powers of the variable lenses
+(Model.lens_system_matrices), whose coefficients are found once for the column. The matrices are
+tested against each other in tests/test_lens_polynomial.py.'''
+
+def chain_series(model, lens, parameter, focal_lengths):
+    system_matrices = []
+    for f in focal_lengths:
+        setattr(lens, parameter, f)
+        lens.set_matrix()
+        model.update_component_matrix()
+        model.update_system_matrices()
+        system_matrices.append(model.system_matrices.copy())
+
+    return np.stack(system_matrices)
+
+focal_lengths = np.linspace(-0.3, -0.15, 256)
+overfocus = np.linspace(0.01, 0.3, 256)
+
+chain_model, model = [Model(make_tem_components(objective_stig = {'fx': -0.4, 'fy': -0.45}),
+                             beam_z = 3.0, beam_type = 'point', num_rays = 2**10,
+                             gun_beam_semi_angle = 0.15) for _ in range(2)]
+model.set_variable_lenses()
+
+stem_chain_model, stem_model = [Model(make_4dstem_components(), beam_z = 3.0, experiment = '4DSTEM',
+                                       num_rays = 2**10) for _ in range(2)]
+stem_chain_model.set_variable_lenses([])
+
+def chain_overfocus_series():
+    system_matrices = []
+    for value in overfocus:
+        stem_chain_model.set_obj_lens_f_from_overfocus(value)
+        stem_chain_model.update_component_matrix()
+        stem_chain_model.update_system_matrices()
+        system_matrices.append(stem_chain_model.system_matrices.copy())
+
+    return np.stack(system_matrices)
+
+print('{:>24} {:>10} {:>12} {:>16} {:>10}'.format(
+    'series', 'configs', 'chain (ms)', 'polynomial (ms)', 'speedup'))
+
+objective_lens = chain_model.components[4]
+chain_time = best_time(lambda: chain_series(chain_model, objective_lens, 'f', focal_lengths), 3)
+polynomial_time = best_time(
+    lambda: model.lens_system_matrices({'Objective Lens': {'f': focal_lengths}}), 100)
+print('{:>24} {:>10} {:>12.3f} {:>16.3f} {:>10.1f}'.format(
+    'tem focus', len(focal_lengths), chain_time*1e3, polynomial_time*1e3,
+    chain_time/polynomial_time))
+
+chain_time = best_time(chain_overfocus_series, 3)
+polynomial_time = best_time(lambda: stem_model.overfocus_system_matrices(overfocus), 100)
+print('{:>24} {:>10} {:>12.3f} {:>16.3f} {:>10.1f}'.format(
+    '4dstem overfocus', len(overfocus), chain_time*1e3, polynomial_time*1e3,
+    chain_time/polynomial_time))
@@ -0,0 +1,62 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of the moments of a beam at every plane of a column, from the statistics of the traced
+rays or from the propagated second moment matrix of the beam (Model.propagate_moments), for every
+beam type. The moments do not depend on the number of rays, and the statistics of the rays converge
+to them as the number of rays grows, which is tested in tests/test_moments.py.'''
+
+def make_components():
+    return [comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Quadrupole(name = 'Condenser Stig', z = 2.2, fx = -0.4, fy = 0.4),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, updefx = 0.01,
+                                 lowdefy = -0.02),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 1.0, fx = -0.3, fy = -0.35),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+def ray_statistics(model):
+    r = model.step()
+    centroid = r[:, [0, 2]].mean(axis = 2)
+    rms_size = r[:, [0, 2]].std(axis = 2)
+    divergence = r[:, [1, 3]].std(axis = 2)
+
+    return centroid, rms_size, divergence
+
+num_rays = 2**18
+
+print('{:>10} {:>18} {:>18} {:>18}'.format('beam', 'max size error', 'max slope error',
+                                           'emittance'))
+
+for beam_type in ['paralell', 'point', 'axial', 'x_axial']:
+    model = Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = num_rays,
+                  gun_beam_semi_angle = 0.15, beam_radius = 0.1, beam_tilt_x = 0.01,
+                  beam_tilt_y = -0.02)
+
+    centroid, rms_size, divergence = ray_statistics(model)
+    moments = model.propagate_moments()
+
+    # Errors relative to the largest size and slope of the column
+    size_scale = np.max(np.abs(rms_size))
+    slope_scale = np.max(divergence)
+    size_error = max(np.max(np.abs(moments.centroid() - centroid)),
+                     np.max(np.abs(moments.rms_size() - rms_size)))/size_scale
+    slope_error = np.max(np.abs(moments.divergence() - divergence))/slope_scale
+
+    # Every beam comes from a point or is parallel, so it has no emittance, and the lenses and
+    # quadrupole (which do not couple x and y) keep it so at every plane
+    relative_emittance = np.max(moments.emittance())/(size_scale*slope_scale)
+
+    print('{:>10} {:>18.2e} {:>18.2e} {:>18.2e}'.format(beam_type, size_error, slope_error,
+                                                        relative_emittance))
+
+rays_time = best_time(lambda: ray_statistics(model), 3)
+moments_time = best_time(model.propagate_moments, 100)
+
+print('{:>24} {:>12}'.format('', 'time (ms)'))
+print('{:>24} {:>12.3f}'.format('{} rays'.format(num_rays), rays_time*1e3))
+print('{:>24} {:>12.3f}'.format('moments', moments_time*1e3))
@@ -0,0 +1,29 @@
+from temgymbasic.model import Model
+from temgymbasic import numba_backend
+from _common import best_time, make_tem_components
+
+
+'''Benchmark of the numba backend (Model(backend='numba')) against the NumPy path, for a full step
+and for the detector image of trace_chunked. The parity of the two backends is tested in
+tests/test_numba_backend.py. If numba is not installed, the backend falls back to NumPy.'''
+
+def make_models(num_rays):
+    return [Model(make_tem_components(beam_tilt = {}), beam_z = 3.0, beam_type = 'point',
+                  num_rays = num_rays, gun_beam_semi_angle = 0.15, detector_pixels = 256,
+                  backend = backend)
+            for backend in ['numpy', 'numba']]
+
+print('numba installed: {}'.format(numba_backend.NUMBA_AVAILABLE))
+
+num_rays = 2**20
+models = make_models(num_rays)
+for model in models:
+    model.update_rays_stepwise()
+    model.trace_chunked()
+
+print('{:>24} {:>14} {:>14}'.format('', 'numpy (ms)', 'numba (ms)'))
+step_times = [best_time(model.update_rays_stepwise, 5) for model in models]
+print('{:>24} {:>14.3f} {:>14.3f}'.format('step', *[step_time*1e3 for step_time in step_times]))
+image_times = [best_time(model.trace_chunked, 5) for model in models]
+print('{:>24} {:>14.3f} {:>14.3f}'.format('detector image',
+                                          *[image_time*1e3 for image_time in image_times]))
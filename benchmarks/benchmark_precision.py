@@ -0,0 +1,42 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import get_image_from_rays
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of single against double precision rays on the 4DSTEM column from the live calibration
+examples. Each run propagates the rays through the column and forms the detector image, and the
+deviation of the single precision pixel coordinates from a double precision reference is reported
+by Model.check_precision(), which is tested in tests/test_precision.py.'''
+
+def make_components():
+    return [comp.DoubleDeflector(name = 'Scan Coils', z_up = 0.3, z_low = 0.25, updefx = 0.01),
+            comp.Lens(name = 'Lens', z = 0.20),
+            comp.Sample(name = 'Sample', sample = sample, z = 0.15, width = 0.000256),
+            comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.1, z_low = 0.05)]
+
+def propagate_and_image(model):
+    model.update_rays_stepwise()
+    sample = model.components[model.sample_idx]
+    get_image_from_rays(model.r[-1, 0], model.r[-1, 2],
+                        model.r[model.sample_r_idx, 0], model.r[model.sample_r_idx, 2],
+                        model.detector_size, model.detector_pixels,
+                        sample.sample_size, sample.sample_pixels, sample.sample)
+
+print('{:>10} {:>14} {:>14} {:>10} {:>18} {:>16}'.format(
+    'num_rays', 'float64 (ms)', 'float32 (ms)', 'speedup', 'detector dev (px)', 'sample dev (px)'))
+
+for power in range(12, 23, 2):
+    times = {}
+    for dtype in [np.float64, np.float32]:
+        model = Model(make_components(), beam_z = 0.4, beam_type = 'paralell', num_rays = 2**power,
+                      experiment = '4DSTEM', detector_pixels = 256, detector_size = 0.0128,
+                      dtype = dtype)
+        times[dtype] = best_time(lambda: propagate_and_image(model), max(3, 2**(20-power)))
+
+    deviations = model.check_precision()
+
+    print('{:>10} {:>14.3f} {:>14.3f} {:>10.2f} {:>18.2e} {:>16.2e}'.format(
+        2**power, times[np.float64]*1e3, times[np.float32]*1e3, times[np.float64]/times[np.float32],
+        deviations['detector'], deviations['sample']))
@@ -0,0 +1,42 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time
+
+'''Benchmark of the ray layouts of Model.update_rays_stepwise(). The coupled layout propagates x
+and y together through a (5, num rays) workspace, the separable layout propagates x and y as
+independent 2-row systems, and the compact layout also drops the row of ones from the ray matrix.
+The x-only layout is used for the 'x_axial' beam of the matplotlib diagrams. The layouts are
+tested against each other in tests/test_ray_axes.py.'''
+
+def make_components():
+    return [comp.Lens(name = '1st Condenser Lens', z = 1.5, f = -0.2),
+            comp.Aperture(name = 'Condenser Aperture', z = 1.3, aperture_radius_inner = 0.05),
+            comp.Lens(name = '2nd Condenser Lens', z = 1.1, f = -0.5),
+            comp.Deflector(name = 'Deflector', z = 0.9, defx = 0.01, defy = 0),
+            comp.Lens(name = 'Objective Lens', z = 0.7, f = -0.2),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+def coupled_axes(gun_rays=None):
+    return [(0, 2)]
+
+print('{:>10} {:>10} {:>14} {:>14} {:>14}'.format(
+    'num_rays', 'beam', 'coupled (ms)', 'separable (ms)', 'compact (ms)'))
+
+for power in range(12, 21, 4):
+    for beam_type in ['point', 'x_axial']:
+        kwargs = dict(beam_z = 2, beam_type = beam_type, num_rays = 2**power,
+                      gun_beam_semi_angle = 0.1)
+        repeats = max(3, 2**(20-power))
+
+        coupled = Model(make_components(), **kwargs)
+        coupled.get_ray_axes = coupled_axes
+        coupled_time = best_time(coupled.update_rays_stepwise, repeats)
+
+        separable = Model(make_components(), **kwargs)
+        separable_time = best_time(separable.update_rays_stepwise, repeats)
+
+        compact = Model(make_components(), compact_rays = True, **kwargs)
+        compact_time = best_time(compact.update_rays_stepwise, repeats)
+
+        print('{:>10} {:>10} {:>14.3f} {:>14.3f} {:>14.3f}'.format(
+            2**power, beam_type, coupled_time*1e3, separable_time*1e3, compact_time*1e3))
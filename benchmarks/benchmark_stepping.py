@@ -0,0 +1,51 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of a full propagation with Model.update_rays_stepwise() against the original stepping
+loop, which built a new propagation matrix for every gap and let every matrix multiplication
+allocate a new array before copying it into the ray matrix. Both are run on the 4DSTEM column from
+the live calibration examples. The rays of a step are tested against those of the original loop in
+tests/test_stepping.py.'''
+
+def legacy_update_rays_stepwise(model):
+    # Copy of the original allocating loop for the components in this column
+    model.r[1, :, :] = np.matmul(model.propagate(model.z_distances[0]), model.r[0, :, :])
+
+    idx = 1
+    for component in model.components:
+        if component.type == 'Double Deflector':
+            matrices = [component.up_matrix, component.low_matrix]
+        else:
+            matrices = [component.matrix]
+
+        for matrix in matrices:
+            model.r[idx, :, :] = np.matmul(matrix, model.r[idx, :, :])
+            propagation_matrix = model.propagate(model.z_distances[idx])
+            model.r[idx+1, :, :] = np.matmul(propagation_matrix, model.r[idx, :, :])
+            idx += 1
+
+components = [comp.DoubleDeflector(name = 'Scan Coils', z_up = 0.3, z_low = 0.25),
+              comp.Lens(name = 'Lens', z = 0.20),
+              comp.Sample(name = 'Sample', sample = sample, z = 0.15, width = 0.000256),
+              comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.1, z_low = 0.05)
+              ]
+
+print('{:>10} {:>14} {:>14} {:>10}'.format('num_rays', 'legacy (ms)', 'step (ms)', 'speedup'))
+
+for power in range(10, 21, 2):
+    model = Model(components, beam_z = 0.4, beam_type = 'paralell', num_rays = 2**power,
+                  experiment = '4DSTEM', detector_pixels = 256, detector_size = 0.0128)
+    model.update_component_matrix()
+
+    repeats = max(3, 2**(20-power))
+    legacy_time = best_time(lambda: legacy_update_rays_stepwise(model), repeats)
+
+    # Model.step() only propagates from the first component which changed, so we
+    # call update_rays_stepwise to time a propagation through the whole column
+    step_time = best_time(model.update_rays_stepwise, repeats)
+
+    print('{:>10} {:>14.3f} {:>14.3f} {:>10.2f}'.format(
+        2**power, legacy_time*1e3, step_time*1e3, legacy_time/step_time))
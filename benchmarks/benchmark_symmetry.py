@@ -0,0 +1,52 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import best_time, sample
+
+import numpy as np
+
+'''Benchmark of forming the detector image of a rotationally symmetric TEM column (round lenses,
+centred apertures and a sample) with Model.trace_chunked, which traces one ray of each ring of the
+beam and rotates the other rays of the ring from it at the sample and the detector, against tracing
+every ray of the beam. The images and the blocked ray counts must be the same, apart from the few
+pixels where the rounding of a rotated ray puts it in the neighbouring pixel, which is tested, with
+changes of the column and columns which are not symmetric, in tests/test_symmetry.py.'''
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.1),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.8),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, scan_rotation = 10),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Lens(name = 'Objective Lens', z = 1.0, f = -0.15),
+            comp.Aperture(name = 'Objective Aperture', z = 0.8, aperture_radius_inner = 0.03),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+def trace_every_ray(model, num_rays):
+    model.is_rotationally_symmetric = lambda components = None: False
+    try:
+        return model.trace_chunked(num_rays = num_rays)
+    finally:
+        del model.is_rotationally_symmetric
+
+beams = {'paralell': {'beam_radius': 0.15}, 'point': {'gun_beam_semi_angle': 0.05}}
+num_rays = 2**20
+
+print('{:>10} {:>10} {:>10} {:>12} {:>16} {:>16} {:>10}'.format(
+    'beam', 'backend', 'blocked', 'pixels off', 'every ray (ms)', 'rings (ms)', 'speedup'))
+
+for beam_type, beam_kwargs in beams.items():
+    for backend in ['numpy', 'numba']:
+        model = Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = 2**10,
+                      detector_pixels = 256, backend = backend, **beam_kwargs)
+
+        ray_image, sample_image, blocked_ray_counts = model.trace_chunked(num_rays = num_rays)
+        every_ray_image, every_sample_image, _ = trace_every_ray(model, num_rays)
+
+        pixels_off = (np.count_nonzero(ray_image != every_ray_image)
+                      + np.count_nonzero(sample_image != every_sample_image))
+        lit_pixels = np.count_nonzero((every_ray_image > 0) | (every_sample_image != 0))
+
+        every_ray_time = best_time(lambda: trace_every_ray(model, num_rays), 3)
+        rings_time = best_time(lambda: model.trace_chunked(num_rays = num_rays), 3)
+        print('{:>10} {:>10} {:>10} {:>12} {:>16.3f} {:>16.3f} {:>10.2f}'.format(
+            beam_type, backend, blocked_ray_counts.sum(), pixels_off, every_ray_time*1e3,
+            rings_time*1e3, every_ray_time/rings_time))
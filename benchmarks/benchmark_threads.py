@@ -0,0 +1,32 @@
+from temgymbasic.model import Model
+from _common import best_time, make_4dstem_components
+
+import os
+
+'''Scaling benchmark of tiled ray propagation on a thread pool (Model(num_workers=...)), from one
+worker up to the number of cores, against untiled serial propagation, on the 4DSTEM column of the
+other benchmarks. The rays of every worker count are tested against the untiled propagation in
+tests/test_threads.py.'''
+
+num_rays = 2**22
+max_workers = os.cpu_count()
+
+# Reference propagation of all rays at once, without tiles
+serial = Model(make_4dstem_components(), beam_z = 3.0, beam_type = 'paralell', num_rays = num_rays,
+               experiment = '4DSTEM', detector_pixels = 256, tile_size = num_rays)
+serial_time = best_time(serial.update_rays_stepwise, 5)
+
+print('{:>10} {:>10} {:>12} {:>10}'.format('num_rays', 'workers', 'time (ms)', 'speedup'))
+print('{:>10} {:>10} {:>12.3f} {:>10.2f}'.format(num_rays, 'untiled', serial_time*1e3, 1))
+
+workers = 1
+while workers <= max_workers:
+    model = Model(make_4dstem_components(), beam_z = 3.0, beam_type = 'paralell',
+                  num_rays = num_rays, experiment = '4DSTEM', detector_pixels = 256,
+                  num_workers = workers, tile_size = 2**15)
+
+    elapsed = best_time(model.update_rays_stepwise, 5)
+
+    print('{:>10} {:>10} {:>12.3f} {:>10.2f}'.format(
+        num_rays, workers, elapsed*1e3, serial_time/elapsed))
+    workers *= 2
@@ -1,7 +1,12 @@
 import temgymbasic.shapes as geom
+from temgymbasic.functions import apply_matrix, apply_thin_lens, apply_kick, copy_rays, \
+    get_array_namespace, transfer_matrix, is_rotationally_symmetric_matrix
+from temgymbasic import numba_backend
 from temgymbasic.gui import *
 import pyqtgraph.opengl as gl
 import numpy as np
+import copy
+import warnings
 from PyQt5.QtGui import QFont
 from pyqtgraph.Qt import QtGui
 import pyqtgraph as pg
@@ -9,11 +14,414 @@ import pyqtgraph as pg
 font = QFont()
 font.setPixelSize(20)
 
+
+class Component():
+    '''Base class of the components of the model, which defines how the model talks to a component:
+
+        - plane_z_positions() and plane_matrices() give the z position and transfer matrix of each
+          plane of the component (a double deflector has two planes, everything else has one).
+        - apply(rays, out, plane) transfers the rays through one plane of the component. The default
+          is a dense matrix multiplication, and each component overrides it with a kernel that only
+          updates the rows of the rays which the component changes.
+        - blocked(rays, plane) returns which rays are stopped by the component, if it can stop any
+          (stops_rays is True). Components which stop rays implement it with the kernel
+          find_blocked(rays, out, plane, workspace), which writes into a preallocated mask.
+        - transfer(rays, plane) and blocked_array(rays, plane) are the array API versions of apply
+          and find_blocked, which return new arrays in the namespace of the rays instead of writing
+          in place. The model uses them when it traces rays of another array namespace than numpy.
+        - update_matrices() sets the transfer matrices from the parameters of the component, and
+          with_parameters(parameters) makes a copy of the component with some parameters changed.
+        - power_matrices() splits the transfer matrix of a thin lens into a constant matrix and one
+          derivative matrix for each of its powers (one over each parameter of power_parameters),
+          so that the model can find the matrices of the column as a polynomial in the powers.
+        - kick_vectors() gives the constant kick of each plane of a deflector per unit of each of
+          its kick parameters (kick_parameters), so that the model can move the rays of a step
+          along their response to a change of the kicks instead of propagating them again.
+        - parameter_tangents(parameter, rays, plane) gives the derivatives of the rays leaving one
+          plane of the component with respect to one of its differentiable_parameters, so that the
+          model can find the Jacobian of the rays in the same pass as the rays.
+        - rotationally_symmetric() says whether the component acts on every ray rotated about the
+          optic axis in the same way, so that the model can trace one ray of each ring of a ring
+          beam.
+        - numba_kernel(plane) and numba_stop(plane) describe one plane of the component to the
+          kernels of the numba backend, which trace the rays of the whole column in compiled code.
+
+    Components whose kernel is not a matrix multiplication (such as the biprism) set affine to
+    False, so that the model does not compile them into products of matrices.
+
+    It also keeps a version number for the component which is incremented whenever the parameters
+    that act on the rays change, so that the model only needs to propagate rays again from the first
+    component that has changed.
+    '''
+    version = 0
+    affine = True
+    stops_rays = False
+    power_parameters = []
+    kick_parameters = []
+    differentiable_parameters = []
+
+    def plane_z_positions(self):
+        '''Z positions of the planes of this component in the optic axis
+
+        Returns
+        -------
+        list
+            Z position of each plane
+        '''
+        return [self.z]
+
+    def plane_matrices(self):
+        '''Ray transfer matrices of the planes of this component
+
+        Returns
+        -------
+        list
+            Transfer matrix of each plane
+        '''
+        return [self.matrix]
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Transfer rays through one plane of the component.
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays arriving at the component, of shape (5, num rays), or (4, num rays) without
+            the row of ones. This array is not modified
+        out : ndarray
+            Array of the same shape as rays, but not the same memory, where the rays
+            leaving the component are written
+        plane : int, optional
+            Index of the plane of the component, by default 0
+        axes : tuple, optional
+            Position rows of the axes to transfer - (0, 2) for x and y, or (0,) or (2,) for a
+            single axis when the model has found that x and y are not coupled, by default (0, 2)
+        '''
+        apply_matrix(self.plane_matrices()[plane], rays, out, axes)
+
+    def transfer(self, rays, plane = 0):
+        '''Array API version of apply: transfer rays through one plane of the component
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays arriving at the component, of shape (5, num rays) or (4, num rays), in any
+            array namespace
+        plane : int, optional
+            Index of the plane of the component, by default 0
+
+        Returns
+        -------
+        ndarray
+            New array of the rays leaving the component, in the namespace of the rays
+        '''
+        return transfer_matrix(self.plane_matrices()[plane], rays)
+
+    def blocked(self, rays, plane = 0):
+        '''Find the rays which are stopped by the component
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays at the plane of the component
+        plane : int, optional
+            Index of the plane of the component, by default 0
+
+        Returns
+        -------
+        ndarray or None
+            Boolean array which is True for blocked rays, or None if the component does
+            not stop rays
+        '''
+        if not self.stops_rays:
+            return None
+        elif get_array_namespace(rays) is not np:
+            return self.blocked_array(rays, plane)
+
+        out = np.empty(rays.shape[1], dtype=bool)
+        self.find_blocked(rays, out, plane)
+
+        return out
+
+    def find_blocked(self, rays, out, plane = 0, workspace = None):
+        '''Blocking kernel: write the rays which are stopped by the component into a boolean
+        array, using only the given workspace. Components which stop rays override it.
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays at the plane of the component. This array is not modified
+        out : ndarray
+            Boolean array of shape (num rays), which is set True for blocked rays
+        plane : int, optional
+            Index of the plane of the component, by default 0
+        workspace : tuple, optional
+            Float array of shape (2, num rays) of the dtype of the rays, and boolean array of
+            shape (num rays), by default new arrays
+        '''
+        out[:] = False
+
+    def blocked_array(self, rays, plane = 0):
+        '''Array API version of find_blocked: find the rays which are stopped by the component.
+        Components which stop rays override it.
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays at the plane of the component, in any array namespace
+        plane : int, optional
+            Index of the plane of the component, by default 0
+
+        Returns
+        -------
+        ndarray
+            New boolean array which is True for blocked rays, in the namespace of the rays
+        '''
+        xp = get_array_namespace(rays)
+
+        return xp.zeros(rays.shape[1], dtype=xp.bool)
+
+    def ray_parameters(self):
+        '''Parameters of the component that act on the rays
+
+        Returns
+        -------
+        list
+            List of numbers or arrays
+        '''
+        return [self.matrix]
+
+    def update_matrices(self):
+        '''Set the transfer matrices of the component from its parameters
+        '''
+        self.set_matrix()
+
+    def with_parameters(self, parameters):
+        '''Make a shallow copy of the component with some of its parameters changed, and
+        its matrices set from them. The component itself is not changed.
+
+        Parameters
+        ----------
+        parameters : dict
+            New values of attributes of the component, such as {'f': -0.2}
+
+        Returns
+        -------
+        Component
+            Copy of the component
+        '''
+        component = copy.copy(self)
+
+        for attribute, value in parameters.items():
+            if not hasattr(self, attribute):
+                raise AttributeError('{} has no parameter {}'.format(self.name, attribute))
+            setattr(component, attribute, value)
+
+        component.update_matrices()
+
+        return component
+
+    def power_matrices(self):
+        '''Split the transfer matrix of the component into a constant matrix and one derivative
+        matrix for each power (one over each parameter of power_parameters), which the matrix of
+        a thin lens is linear in: matrix = constant + sum(power * derivative)
+
+        Returns
+        -------
+        constant : ndarray
+            Transfer matrix with every power at zero
+        derivatives : list
+            Derivative of the transfer matrix with respect to each power
+        '''
+        zero_powers = {parameter: np.inf for parameter in self.power_parameters}
+        constant = np.asarray(self.with_parameters(zero_powers).matrix, dtype=np.float64)
+        derivatives = [
+            np.asarray(self.with_parameters(dict(zero_powers, **{parameter: 1.0})).matrix,
+                       dtype=np.float64) - constant for parameter in self.power_parameters]
+
+        return constant, derivatives
+
+    def kick_vectors(self):
+        '''Constant kicks (the last column of the transfer matrices) of the planes of the component
+        per unit of each parameter of kick_parameters, which the matrices of a deflector are affine
+        in: plane_matrices()[plane][:, 4] = constant + sum(kick * vector[plane])
+
+        The vectors only depend on the linear part of the matrices (the layout of the deflector and
+        its scan rotation), so they are cached, and only found again when the component has changed
+        other than by its kicks.
+
+        Returns
+        -------
+        ndarray
+            Kick vectors of shape (kick parameters, planes, 5)
+        '''
+        if getattr(self, 'kick_vectors_key', None) == (id(self), self.version):
+            return self.cached_kick_vectors
+
+        linear_part = np.array(self.plane_matrices(), dtype=np.float64)[..., :4]
+        if not np.array_equal(linear_part, getattr(self, 'kick_vectors_linear_part', None)):
+            zero_kicks = {parameter: 0.0 for parameter in self.kick_parameters}
+            def kicks(parameters):
+                matrices = self.with_parameters(dict(zero_kicks, **parameters)).plane_matrices()
+                return np.array(matrices, dtype=np.float64)[..., 4]
+
+            constant = kicks({})
+            self.cached_kick_vectors = np.array([kicks({parameter: 1.0}) - constant
+                                                 for parameter in self.kick_parameters])
+            self.kick_vectors_linear_part = linear_part
+
+        self.kick_vectors_key = (id(self), self.version)
+
+        return self.cached_kick_vectors
+
+    def matrix_derivatives(self, parameter):
+        '''Derivatives of the transfer matrices of the planes of the component with respect to one
+        of its parameters. They are found by a complex step of the parameter, which is exact to
+        machine precision for matrices which are analytic in the parameter, without any
+        cancellation.
+
+        Parameters
+        ----------
+        parameter : str
+            Name of the parameter
+
+        Returns
+        -------
+        ndarray
+            Derivative of the matrix of each plane, of shape (planes, 5, 5)
+        '''
+        step = 1e-20
+        component = self.with_parameters({parameter: getattr(self, parameter) + 1j*step})
+
+        return np.imag(np.array(component.plane_matrices(), dtype=np.complex128))/step
+
+    def parameter_tangents(self, parameter, rays, plane = 0):
+        '''Derivatives of the rays leaving one plane of the component with respect to one of its
+        parameters, for the rays arriving at it
+
+        Parameters
+        ----------
+        parameter : str
+            Name of the parameter
+        rays : ndarray
+            Rays arriving at the component, of shape (5, num rays)
+        plane : int, optional
+            Plane of the component, by default 0
+
+        Returns
+        -------
+        ndarray
+            Derivatives of shape (5, num rays)
+        '''
+        return self.matrix_derivatives(parameter)[plane] @ rays
+
+    def powers(self):
+        '''Powers of the component, one over each parameter of power_parameters
+
+        Returns
+        -------
+        list
+            Power of each parameter
+        '''
+        return [1 / getattr(self, parameter) for parameter in self.power_parameters]
+
+    def rotationally_symmetric(self):
+        '''Whether the component commutes with every rotation about the optic axis. Components
+        which stop rays or are not affine are not, unless they override this method
+
+        Returns
+        -------
+        bool
+        '''
+        return self.affine and not self.stops_rays and all(
+            is_rotationally_symmetric_matrix(matrix) for matrix in self.plane_matrices())
+
+    @property
+    def blocked_ray_idcs(self):
+        '''Indices of the rays of the last step of the model of the component which the component
+        is the first to block. Deprecated: the model keeps the first component that blocks every ray
+        in one array instead (see Model.get_blocked_at and Model.alive_after), which this is read
+        from.
+
+        Returns
+        -------
+        ndarray
+            Indices of the blocked rays
+        '''
+        warnings.warn('Component.blocked_ray_idcs is deprecated, use Model.get_blocked_at() or '
+                      'Model.alive_after() instead', DeprecationWarning, stacklevel=2)
+
+        model = getattr(self, 'model', None)
+        component_idx = None if model is None else next(
+            (idx for idx, component in enumerate(model.components) if component is self), None)
+        if component_idx is None:
+            return np.array([], dtype=np.int64)
+
+        return np.flatnonzero(model.get_blocked_at() == component_idx)
+
+    def numba_kernel(self, plane = 0):
+        '''Kernel of the numba backend which transfers the rays through one plane of the component
+        (see numba_backend.compile_column). Affine components are a matrix multiplication, and other
+        components must override this method to be traced by the numba backend
+
+        Parameters
+        ----------
+        plane : int, optional
+            Plane of the component, by default 0
+
+        Returns
+        -------
+        int or None
+            numba_backend.KERNEL_MATRIX or KERNEL_BIPRISM, or None if the kernels can't trace the
+            plane
+        '''
+        return numba_backend.KERNEL_MATRIX if self.affine else None
+
+    def numba_stop(self, plane = 0):
+        '''Stop of the numba backend which finds the rays blocked at one plane of the component
+        (see numba_backend.compile_column). Components which stop rays must override this method
+        to be traced by the numba backend
+
+        Parameters
+        ----------
+        plane : int, optional
+            Plane of the component, by default 0
+
+        Returns
+        -------
+        tuple or None
+            numba_backend.STOP_NONE, STOP_APERTURE or STOP_RECTANGLE, and the 4 parameters of the
+            stop (or None if it has none), or None if the kernels can't find the blocked rays of
+            the plane
+        '''
+        return None if self.stops_rays else (numba_backend.STOP_NONE, None)
+
+    def update_version(self):
+        '''Increment the version of the component if its ray parameters have changed since
+        the last time this method was called
+
+        Returns
+        -------
+        int
+            Version of the component
+        '''
+        state = np.concatenate(
+            [np.ravel(parameter) for parameter in self.ray_parameters()]).astype(np.float64)
+
+        if not np.array_equal(state, getattr(self, 'version_state', None)):
+            self.version += 1
+            self.version_state = state
+
+        return self.version
+
     
-class Lens():
+class Lens(Component):
     '''Creates a lens component and handles calls to GUI creation, updates to GUI
         and stores the component matrix.
     '''    
+    power_parameters = ['f']
+    differentiable_parameters = ['f']
+
     def __init__(self, z, name = '', f = 0.5, label_radius = 0.3, radius = 0.25, num_points = 50):
         '''
 
@@ -42,7 +450,6 @@ class Lens():
         self.f = f
         self.f_temp = f
         self.ftime = 0
-        self.blocked_ray_idcs = []
         
         self.name = name
         self.set_matrix()
@@ -76,6 +483,11 @@ class Lens():
         '''
         '''        
         self.matrix = self.lens_matrix(self.f)
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Lens kernel: only the slopes change, by -position/f
+        '''
+        apply_thin_lens(self.matrix, rays, out, axes)
     
     def set_gl_geom(self):
         '''
@@ -131,10 +543,13 @@ class Lens():
             self.set_matrix()
             
 
-class AstigmaticLens():
+class AstigmaticLens(Component):
     '''Creates an Astigmatic lens component and handles calls to GUI creation, updates to GUI
         and stores the component matrix.
     '''    
+    power_parameters = ['fx', 'fy']
+    differentiable_parameters = ['fx', 'fy']
+
     def __init__(self, z, name = '', fx = -0.5, fy = -0.5, label_radius = 0.3, radius = 0.25, num_points = 50):
         '''
 
@@ -169,7 +584,6 @@ class AstigmaticLens():
         self.fy_temp = fy
         self.ftime = 0
 
-        self.blocked_ray_idcs = []
         
         self.name = name
         
@@ -205,6 +619,11 @@ class AstigmaticLens():
         '''
         '''        
         self.matrix = self.lens_matrix(self.fx, self.fy)
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Astigmatic lens kernel: only the slopes change, by -position/f in x and y
+        '''
+        apply_thin_lens(self.matrix, rays, out, axes)
     
     def set_gl_geom(self):
         '''
@@ -277,10 +696,13 @@ class AstigmaticLens():
         if abs(self.fx) > 1e-14 and abs(self.fy) > 1e-14:
             self.set_matrix()
             
-class Quadrupole():
+class Quadrupole(Component):
     '''Creates a quadrupole component and handles calls to GUI creation, updates to GUI
         and stores the component matrix. Almost exactly the same as astigmatic lens component
         '''
+    power_parameters = ['fx', 'fy']
+    differentiable_parameters = ['fx', 'fy']
+
     def __init__(self, z, name = '', fx = -0.5, fy = -0.5, label_radius = 0.3, radius = 0.25, num_points = 50):
         '''
 
@@ -315,7 +737,6 @@ class Quadrupole():
         self.fy_temp = fy
         self.ftime = 0
 
-        self.blocked_ray_idcs = []
         
         self.name = name
         
@@ -351,6 +772,11 @@ class Quadrupole():
         '''
         '''        
         self.matrix = self.lens_matrix(self.fx, self.fy)
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Quadrupole kernel: only the slopes change, by -position/f in x and y
+        '''
+        apply_thin_lens(self.matrix, rays, out, axes)
     
     def set_gl_geom(self):
         '''
@@ -420,7 +846,7 @@ class Quadrupole():
         if abs(self.fx) > 1e-14 and abs(self.fy) > 1e-14:
             self.set_matrix()
 
-class Sample():
+class Sample(Component):
     '''Creates a sample component which serves only as a visualisation on the 3D model. 
     '''    
     def __init__(self, z = 0., sample = None, name = '', label_radius = 0.3, width = 0.25, num_points = 50, x = 0., y = 0.):
@@ -463,7 +889,6 @@ class Sample():
         self.sample_pixels = sample.shape[0]
         self.sample_size = width
         
-        self.blocked_ray_idcs = []
         self.name = name
         self.set_matrix()
         self.set_gl_geom()
@@ -493,6 +918,11 @@ class Sample():
         '''
         '''        
         self.matrix = self.sample_matrix()
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Sample kernel: rays pass through unchanged
+        '''
+        copy_rays(rays, out, axes)
     
     def set_gl_geom(self):   
         '''
@@ -578,10 +1008,13 @@ class Sample():
         
         self.set_slabel()
 
-class Deflector():
+class Deflector(Component):
     '''Creates a single deflector component and handles calls to GUI creation, updates to GUI
         and stores the component matrix. See Double Deflector component for a more useful version
     '''    
+    kick_parameters = ['defx', 'defy']
+    differentiable_parameters = ['defx', 'defy']
+
     def __init__(self, z, name = '', defx = 0.5, defy = 0.5, label_radius = 0.3, radius = 0.25, num_points = 50):
         '''_summary_
 
@@ -614,7 +1047,6 @@ class Deflector():
         self.defx_temp = defx
         self.defy_temp = defy
         
-        self.blocked_ray_idcs = []
         
         self.name = name
         
@@ -650,6 +1082,11 @@ class Deflector():
         '''
         '''        
         self.matrix = self.deflector_matrix(self.defx, self.defy)
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Deflector kernel: a constant kick is added to the slopes
+        '''
+        apply_kick(self.matrix, rays, out, axes)
     
     def set_gl_geom(self):
         '''
@@ -728,10 +1165,13 @@ class Deflector():
     #     self.set_deflabel()
     #     self.set_matrix()
         
-class DoubleDeflector():
+class DoubleDeflector(Component):
     '''Creates a double deflector component and handles calls to GUI creation, updates to GUI
         and stores the component matrix. Primarily used in the Beam Tilt/Shift alignment.
     '''    
+    kick_parameters = ['updefx', 'updefy', 'lowdefx', 'lowdefy']
+    differentiable_parameters = ['updefx', 'updefy', 'lowdefx', 'lowdefy', 'scan_rotation']
+
     def __init__(self, z_up, z_low, name = '', updefx = 0.0, updefy = 0.0, lowdefx = 0.0, lowdefy = 0.0, 
                  scan_rotation = 0, label_radius = 0.3, radius = 0.25, num_points = 50):
         '''
@@ -798,7 +1238,6 @@ class DoubleDeflector():
         self.defratioy = -1.
         
         self.name = name
-        self.blocked_ray_idcs = []
         
         self.set_gl_geom()
         self.set_gl_label()
@@ -854,11 +1293,70 @@ class DoubleDeflector():
         
     
     def set_matrices(self):
-        '''
+        '''Set the transfer matrices of the upper and lower deflectors from their kicks. The lower
+        matrix also rotates the ray positions by the scan rotation
         '''        
         self.up_matrix = self.deflector_matrix(self.updefx, self.updefy)
         self.low_matrix = np.matmul(self.rotation_matrix(self.scan_rotation), self.deflector_matrix(self.lowdefx, self.lowdefy))#self.deflector_matrix(self.lowdefx, self.lowdefy)
+
+    def plane_z_positions(self):
+        '''Z positions of the upper and lower deflectors
+
+        Returns
+        -------
+        list
+            Z position of each plane
+        '''
+        return [self.z_up, self.z_low]
+
+    def plane_matrices(self):
+        '''Transfer matrices of the upper and lower deflectors
+
+        Returns
+        -------
+        list
+            Ray transfer matrix of each plane
+        '''
+        return [self.up_matrix, self.low_matrix]
     
+    def ray_parameters(self):
+        '''Transfer matrices of both deflectors, and the scan rotation
+
+        Returns
+        -------
+        list
+            Parameters that act on the rays
+        '''
+        return [self.up_matrix, self.low_matrix, self.scan_rotation]
+
+    def update_matrices(self):
+        '''Set the transfer matrices of both deflectors from their kicks (see set_matrices)
+        '''
+        self.set_matrices()
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Double deflector kernel: a constant kick is added to the slopes, and the lower
+        deflector also rotates the ray positions if there is a scan rotation
+        '''
+        if plane == 0:
+            apply_kick(self.up_matrix, rays, out, axes)
+        elif self.low_matrix[0, 2] == 0 and self.low_matrix[2, 0] == 0:
+            apply_kick(self.low_matrix, rays, out, axes)
+        else:
+            # The rotation couples x and y, so both axes are always transferred together.
+            # The slope rows of out are used as scratch space before they are written
+            cos, sin = self.low_matrix[0, 0], self.low_matrix[2, 0]
+
+            np.multiply(rays[2], -sin, out=out[0])
+            np.multiply(rays[0], cos, out=out[1])
+            out[0] += out[1]
+            np.multiply(rays[0], sin, out=out[2])
+            np.multiply(rays[2], cos, out=out[1])
+            out[2] += out[1]
+
+            np.add(rays[1], self.low_matrix[1, 4], out=out[1])
+            np.add(rays[3], self.low_matrix[3, 4], out=out[3])
+
     def set_gl_geom(self):
         '''
         '''        
@@ -1028,11 +1526,15 @@ class DoubleDeflector():
         self.set_deflabel()
         self.set_matrices()
             
-class Biprism():
+class Biprism(Component):
     '''Creates a biprism component and handles calls to GUI creation, updates to GUI and stores the component
     parameters. Important to note that the transfer matrix of the biprism is only cosmetic: It still
     need to be multiplied by the sign of the position of the ray to perform like a biprism. 
     '''    
+    affine = False
+    stops_rays = True
+    differentiable_parameters = ['deflection', 'theta']
+
     def __init__(self, z, name = '', deflection = 0.5, theta = 0, label_radius = 0.3, radius = 0.25, width = 0.01, num_points = 50):
         '''
 
@@ -1065,7 +1567,6 @@ class Biprism():
         self.width = width
         
         self.deflection = deflection
-        self.blocked_ray_idcs = []
         self.name = name
         
         self.set_gl_geom()
@@ -1097,7 +1598,93 @@ class Biprism():
         '''
         '''        
         self.matrix = self.biprism_matrix(self.deflection)
+
+    def ray_parameters(self):
+        '''Transfer matrix of the biprism, and the orientation and size of its wire
+
+        Returns
+        -------
+        list
+            Parameters that act on the rays
+        '''
+        return [self.matrix, self.theta, self.width, self.radius]
     
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Biprism kernel: the slopes are kicked away from the biprism wire, so the
+        sign of the kick depends on which side of the wire the ray is
+        '''
+        for row in axes:
+            np.copyto(out[row], rays[row])
+            np.sign(rays[row], out=out[row+1])
+            out[row+1] *= rays.dtype.type(self.matrix[row+1, 4])
+            out[row+1] += rays[row+1]
+
+    def find_blocked(self, rays, out, plane = 0, workspace = None):
+        '''Rays which hit the biprism wire are blocked
+        '''
+        if workspace is None:
+            workspace = (np.empty((2, rays.shape[1]), dtype=rays.dtype),
+                         np.empty(rays.shape[1], dtype=bool))
+        (x, y), inside = workspace
+
+        np.abs(rays[0], out=x)
+        np.abs(rays[2], out=y)
+
+        if self.theta != 0:
+            np.less(x, self.width, out=out)
+            np.less(y, self.radius, out=inside)
+        else:
+            np.less(x, self.radius, out=out)
+            np.less(y, self.width, out=inside)
+        out &= inside
+
+    def numba_kernel(self, plane = 0):
+        '''The numba backend has a biprism kernel
+        '''
+        return numba_backend.KERNEL_BIPRISM
+
+    def numba_stop(self, plane = 0):
+        '''The biprism wire is a rectangle of half widths in x and y
+        '''
+        if self.theta != 0:
+            return numba_backend.STOP_RECTANGLE, [self.width, self.radius, 0, 0]
+
+        return numba_backend.STOP_RECTANGLE, [self.radius, self.width, 0, 0]
+
+    def parameter_tangents(self, parameter, rays, plane = 0):
+        '''Derivatives of the kicks of the biprism, which have the sign of the side of the wire of
+        each ray
+        '''
+        derivative = self.matrix_derivatives(parameter)[0]
+
+        tangents = np.zeros(rays.shape, dtype=np.float64)
+        for row in [0, 2]:
+            np.multiply(np.sign(rays[row]), derivative[row+1, 4], out=tangents[row+1])
+
+        return tangents
+
+    def transfer(self, rays, plane = 0):
+        '''Array API version of the biprism kernel
+        '''
+        xp = get_array_namespace(rays)
+
+        rows = [rays[row, ...] for row in range(rays.shape[0])]
+        for row in [0, 2]:
+            rows[row+1] = rows[row+1] + xp.sign(rows[row])*float(self.matrix[row+1, 4])
+
+        return xp.stack(rows)
+
+    def blocked_array(self, rays, plane = 0):
+        '''Array API version of find_blocked
+        '''
+        xp = get_array_namespace(rays)
+        x, y = xp.abs(rays[0, ...]), xp.abs(rays[2, ...])
+
+        if self.theta != 0:
+            return (x < float(self.width)) & (y < float(self.radius))
+
+        return (x < float(self.radius)) & (y < float(self.width))
+
     def set_gl_geom(self):   
         '''
         '''        
@@ -1139,18 +1726,18 @@ class Biprism():
     def update_parameters_from_gui(self):
         '''
         '''        
-        self.blocked_ray_idcs = []
         self.deflection = self.gui.defslider.value()*1e-3
         self.theta = self.gui.rotslider.value()*np.pi/2
         self.update_geometry()
         self.set_gui_label()
         self.set_matrix()
         
-class Aperture():
+class Aperture(Component):
     '''Creates an aperture component and handles calls to GUI creation, updates to GUI and stores the component
     parameters. Important to note that the transfer matrix of the aperture only propagates rays. The logic of 
-    blocking rays is handled inside the "model" function. 
+    blocking rays is handled by the "blocked" method.
     '''
+    stops_rays = True
 
     def __init__(self, z, name = 'Aperture', aperture_radius_inner = 0.005, aperture_radius_outer = 0.25, label_radius = 0.3, num_points = 50, x = 0, y = 0):
         '''
@@ -1195,7 +1782,6 @@ class Aperture():
         self.set_gl_label()
         self.set_matrix()
         
-        self.blocked_ray_idcs = []
         
     def create_gui(self):
         '''
@@ -1252,8 +1838,59 @@ class Aperture():
     def set_matrix(self):
         '''
         '''        
-        self.matrix = self.aperture_matrix
+        self.matrix = self.aperture_matrix()
+
+    def ray_parameters(self):
+        '''Centre, and inner and outer radius of the aperture
+
+        Returns
+        -------
+        list
+            Parameters that act on the rays
+        '''
+        return [self.x, self.y, self.aperture_radius_inner, self.aperture_radius_outer]
     
+    def rotationally_symmetric(self):
+        '''An aperture blocks every ray of a ring or none of them if it is centred on the optic axis
+        '''
+        return self.x == 0 and self.y == 0
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        '''Aperture kernel: rays pass through unchanged
+        '''
+        copy_rays(rays, out, axes)
+
+    def numba_stop(self, plane = 0):
+        '''The aperture is a ring of inner and outer radius about its centre
+        '''
+        return numba_backend.STOP_APERTURE, [self.x, self.y, self.aperture_radius_inner,
+                                             self.aperture_radius_outer]
+
+    def find_blocked(self, rays, out, plane = 0, workspace = None):
+        '''Rays which hit the aperture between its inner and outer radius are blocked
+        '''
+        if workspace is None:
+            workspace = (np.empty((2, rays.shape[1]), dtype=rays.dtype),
+                         np.empty(rays.shape[1], dtype=bool))
+        (distance, y), inside = workspace
+
+        np.subtract(rays[0], self.x, out=distance)
+        np.subtract(rays[2], self.y, out=y)
+        np.hypot(distance, y, out=distance)
+
+        np.greater_equal(distance, self.aperture_radius_inner, out=out)
+        np.less(distance, self.aperture_radius_outer, out=inside)
+        out &= inside
+
+    def blocked_array(self, rays, plane = 0):
+        '''Array API version of find_blocked
+        '''
+        xp = get_array_namespace(rays)
+        distance = xp.hypot(rays[0, ...] - float(self.x), rays[2, ...] - float(self.y))
+
+        return ((distance >= float(self.aperture_radius_inner))
+                & (distance < float(self.aperture_radius_outer)))
+
     def aperture_matrix(self):
         '''Aperture transfer matrix - simply a unit matrix of ones because 
         we only need to propagate rays that pass through the centre of the aperture. 
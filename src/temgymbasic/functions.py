@@ -49,26 +49,20 @@ def make_test_sample(size=256):
     return np.abs(obj)
 
 
-# FIXME resolve code duplication between circular_beam() and point_beam()
-def circular_beam(r, outer_radius):
-    '''Generates a circular paralell initial beam
+def ring_beam_points(num_rays):
+    '''Number of rays on each ring of a beam made of evenly spaced concentric rings, with
+    one ray in the centre. Shared by circular_beam and point_beam.
 
     Parameters
     ----------
-    r : ndarray
-        Ray position and slope matrix
-    outer_radius : float
-        Outer radius of the circular beam
+    num_rays : int
+        Total number of rays in the beam
 
     Returns
     -------
-    r : ndarray
-        Updated ray position & slope matrix which create a circular beam
     num_points_kth_ring: ndarray
         Array of the number of points on each ring of our circular beam
     '''
-    num_rays = r.shape[2]
-
     # Use the equation from stack overflow about ukrainian graves from 2014
     # to calculate the number of even rings including decimal remainder
     num_circles_dec = (-1+np.sqrt(1+4*(num_rays)/(np.pi)))/2
@@ -116,31 +110,294 @@ def circular_beam(r, outer_radius):
     num_points_kth_ring[0] = 1
     num_points_kth_ring[-1] = num_points_kth_ring[-1] - 1
 
-    # Make get the radii for the number of circles of rays we need
-    radii = np.linspace(0, outer_radius, num_circles_int+1)
+    return num_points_kth_ring
 
-    # fill in the x and y coordinates to our ray array
-    idx = 0
-    for i in range(len(radii)):
-        for j in range(num_points_kth_ring[i]):
-            radius = radii[i]
-            t = j*(2 * np.pi / num_points_kth_ring[i])
-            r[0, 0, idx] = radius*np.cos(t)
-            r[0, 2, idx] = radius*np.sin(t)
-            idx += 1
 
-    return r, num_points_kth_ring
+def ring_beam_coords(num_points_kth_ring, start, stop):
+    '''Ring index and angle of a range of rays of a ring beam, without generating
+    the rays before them
 
+    Parameters
+    ----------
+    num_points_kth_ring : ndarray
+        Array of the number of points on each ring of the beam
+    start : int
+        Index of the first ray
+    stop : int
+        Index after the last ray
 
-def point_beam(r, gun_beam_semi_angle):
-    '''Generates a point initial beam that spreads out with semi angle 'gun_beam_semi_angle'
+    Returns
+    -------
+    rings : ndarray
+        Index of the ring of each ray
+    t : ndarray
+        Angle of each ray on its ring
+    '''
+    ring_starts = np.concatenate(([0], np.cumsum(num_points_kth_ring)))
+    ray_idcs = np.arange(start, min(stop, ring_starts[-1]))
+
+    # Empty rings share their start with the next ring, so searching from the right
+    # always finds the ring which holds the ray
+    rings = np.searchsorted(ring_starts, ray_idcs, side='right') - 1
+    t = (ray_idcs - ring_starts[rings])*(2 * np.pi / num_points_kth_ring[rings])
+
+    return rings, t
+
+
+def linspace_slice(start_value, stop_value, num, start, stop):
+    '''Elements [start, stop) of np.linspace(start_value, stop_value, num), without
+    generating the others
+
+    Returns
+    -------
+    ndarray
+        Values of the slice of the linspace
+    '''
+    if num == 1:
+        return np.full(len(range(start, stop)), float(start_value))
+
+    step = (stop_value - start_value)/(num - 1)
+    idcs = np.arange(start, stop)
+    values = idcs*step + start_value
+
+    # linspace sets the endpoint exactly
+    values[idcs == num - 1] = stop_value
+
+    return values
+
+
+def ring_beam_rays(r, beam_type, num_rings, rings, t, gun_beam_semi_angle=0, beam_radius=0):
+    '''Fill in the positions or slopes of rays of a ring beam from their ring and angle
+
+    Parameters
+    ----------
+    r : ndarray
+        Ray position and slope matrix of the rays, which is zero where the beam has no component
+    beam_type : str
+        'paralell' or 'point' - see Model
+    num_rings : int
+        Number of rings of the beam
+    rings : ndarray
+        Index of the ring of each ray
+    t : ndarray
+        Angle of each ray on its ring
+    gun_beam_semi_angle : float, optional
+        Beam semi angle in radians, by default 0
+    beam_radius : float, optional
+        Outer radius of the circular beam, by default 0
+
+    Returns
+    -------
+    r : ndarray
+        Updated ray position & slope matrix
+    '''
+    if beam_type == 'paralell':
+        radii = np.linspace(0, beam_radius, num_rings)[rings]
+        r[0] = radii*np.cos(t)
+        r[2] = radii*np.sin(t)
+    else:
+        slopes = np.tan(gun_beam_semi_angle*np.linspace(0, 1, num_rings)[rings])
+        r[1] = slopes*np.cos(t)
+        r[3] = slopes*np.sin(t)
+
+    return r
+
+
+def rotate_ring_rays(ring_r, rings, t, out, slopes=True):
+    '''Rays of a ring beam in a rotationally symmetric column, from the rays of one ray of each ring
+    at angle zero. Every other ray of a ring is the ray at angle zero rotated about the optic axis
+    by its angle, in every plane.
+
+    Parameters
+    ----------
+    ring_r : ndarray
+        Rays of the first ray of each ring in some planes, of shape (planes, 5, num rings)
+        or (planes, 4, num rings)
+    rings : ndarray
+        Index of the ring of each ray
+    t : ndarray
+        Angle of each ray on its ring
+    out : ndarray
+        Rays to fill in the same planes, of shape (planes, 5, len(rings)) or (planes, 4, len(rings))
+    slopes : bool, optional
+        Whether to fill the slopes as well as the positions, by default True
+
+    Returns
+    -------
+    out : ndarray
+        Rays of every ray
+    '''
+    cos_t, sin_t = np.cos(t).astype(out.dtype), np.sin(t).astype(out.dtype)
+    ring_values = np.empty(len(rings), dtype=out.dtype)
+
+    # Positions and slopes rotate in the same way. Rays of a column which does not couple
+    # x and y have no y component at angle zero.
+    for plane_ring_r, plane_out in zip(ring_r, out):
+        for x_row, y_row in [(0, 2), (1, 3)] if slopes else [(0, 2)]:
+            np.take(plane_ring_r[x_row], rings, out=ring_values)
+            np.multiply(ring_values, cos_t, out=plane_out[x_row])
+            np.multiply(ring_values, sin_t, out=plane_out[y_row])
+
+            if np.any(plane_ring_r[y_row]):
+                y_values = np.take(plane_ring_r[y_row], rings)
+                np.multiply(y_values, sin_t, out=ring_values)
+                plane_out[x_row] -= ring_values
+                np.multiply(y_values, cos_t, out=ring_values)
+                plane_out[y_row] += ring_values
+
+        if plane_out.shape[0] == 5:
+            plane_out[4] = 1
+
+    return out
+
+
+def is_rotationally_symmetric_matrix(matrix):
+    '''Whether a transfer matrix commutes with every rotation about the optic axis, which it does
+    if it acts on the x and y rays in the same way, can only mix them by a rotation, and adds no
+    kick
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Transfer matrix of shape (5, 5)
+
+    Returns
+    -------
+    bool
+    '''
+    matrix = np.asarray(matrix)
+
+    return bool(np.array_equal(matrix[0:2, 0:2], matrix[2:4, 2:4]) and
+                np.array_equal(matrix[0:2, 2:4], -matrix[2:4, 0:2]) and
+                not np.any(matrix[:4, 4]))
+
+
+def beam_slice(r, beam_type, num_rays, start, stop, gun_beam_semi_angle=0, beam_radius=0):
+    '''Fill in the rays [start, stop) of a beam of num_rays rays. The rays of the whole
+    beam never need to be generated, so the beam can be generated in chunks.
+
+    Parameters
+    ----------
+    r : ndarray
+        Ray position and slope matrix of the slice, of shape (5, stop-start) or (4, stop-start),
+        which is filled with zeros where the beam has no component
+    beam_type : str
+        'paralell', 'point', 'axial' or 'x_axial' - see Model
+    num_rays : int
+        Total number of rays in the beam
+    start : int
+        Index of the first ray
+    stop : int
+        Index after the last ray
+    gun_beam_semi_angle : float, optional
+        Beam semi angle in radians, by default 0
+    beam_radius : float, optional
+        Outer radius of the circular beam, by default 0
+
+    Returns
+    -------
+    r : ndarray
+        Updated ray position & slope matrix of the slice
+    '''
+    r[:4] = 0
+
+    if beam_type in ('paralell', 'point'):
+        num_points_kth_ring = ring_beam_points(num_rays)
+        rings, t = ring_beam_coords(num_points_kth_ring, start, stop)
+        ring_beam_rays(r[:, :len(rings)], beam_type, len(num_points_kth_ring), rings, t,
+                       gun_beam_semi_angle, beam_radius)
+
+    elif beam_type == 'axial':
+        x_rays = int(round(num_rays/2))
+        y_rays = num_rays-x_rays
+
+        # The y rays start from index y_rays
+        x_stop = min(stop, x_rays)
+        if start < x_stop:
+            r[1, :x_stop-start] = np.tan(linspace_slice(
+                -gun_beam_semi_angle, gun_beam_semi_angle, x_rays, start, x_stop))
+
+        y_start, y_stop = max(start, y_rays), min(stop, 2*y_rays)
+        if y_start < y_stop:
+            r[3, y_start-start:y_stop-start] = np.tan(linspace_slice(
+                -gun_beam_semi_angle, gun_beam_semi_angle, y_rays, y_start-y_rays, y_stop-y_rays))
+
+    elif beam_type == 'x_axial':
+        r[1] = np.tan(linspace_slice(
+            -gun_beam_semi_angle, gun_beam_semi_angle, num_rays, start, stop))
+
+    return r
+
+
+def beam_moments(beam_type, gun_beam_semi_angle=0, beam_radius=0, beam_tilt_x=0, beam_tilt_y=0):
+    '''Second moment matrix of a beam at the gun, E[r r^T] of the rays r = (x, tx, y, ty, 1), in the
+    limit of many rays, so that it does not depend on the number of rays. The last row and column
+    hold the mean of the rays. The rings of the paralell and point beams fill a disc evenly, and the
+    axial beams are evenly spaced in angle.
+
+    Parameters
+    ----------
+    beam_type : str
+        'paralell', 'point', 'axial' or 'x_axial' - see Model
+    gun_beam_semi_angle : float, optional
+        Beam semi angle in radians, by default 0
+    beam_radius : float, optional
+        Outer radius of the circular beam, by default 0
+    beam_tilt_x : float, optional
+        Tilt of the beam in the x direction, by default 0
+    beam_tilt_y : float, optional
+        Tilt of the beam in the y direction, by default 0
+
+    Returns
+    -------
+    ndarray
+        Second moment matrix of shape (5, 5)
+    '''
+    # Mean square of the slopes of each axis about the beam tilt
+    if beam_type == 'paralell':
+        position_moment, slope_moments = beam_radius**2/4, (0, 0)
+    elif beam_type == 'point':
+        # Rays at a fraction rho of the radius of the disc have slope tan(semi angle*rho),
+        # and rho has density 2 rho, so the mean of each axis is half the mean over the disc
+        rho, weights = np.polynomial.legendre.leggauss(32)
+        rho, weights = (rho + 1)/2, weights/2
+        slope_moment = np.sum(weights*rho*np.tan(gun_beam_semi_angle*rho)**2)
+        position_moment, slope_moments = 0, (slope_moment, slope_moment)
+    elif beam_type in ('axial', 'x_axial'):
+        # Mean of tan(angle)**2 over angles evenly spread in [-semi angle, semi angle]
+        if gun_beam_semi_angle == 0:
+            slope_moment = 0
+        else:
+            slope_moment = (np.tan(gun_beam_semi_angle) - gun_beam_semi_angle)/gun_beam_semi_angle
+
+        # Half of the rays of the axial beam are on each axis
+        if beam_type == 'axial':
+            position_moment, slope_moments = 0, (slope_moment/2, slope_moment/2)
+        else:
+            position_moment, slope_moments = 0, (slope_moment, 0)
+    else:
+        raise ValueError('Unknown beam type {}'.format(beam_type))
+
+    moments = np.zeros((5, 5))
+    moments[0, 0] = moments[2, 2] = position_moment
+    moments[1, 1], moments[3, 3] = slope_moments
+
+    # The tilt shifts the mean of the slopes
+    mean = np.array([0, beam_tilt_x, 0, beam_tilt_y, 1])
+    moments += np.outer(mean, mean)
+
+    return moments
+
+
+def circular_beam(r, outer_radius):
+    '''Generates a circular paralell initial beam
 
     Parameters
     ----------
     r : ndarray
         Ray position and slope matrix
-    gun_beam_semi_angle : float
-        Beam semi angle in radians
+    outer_radius : float
+        Outer radius of the circular beam
 
     Returns
     -------
@@ -151,65 +408,47 @@ def point_beam(r, gun_beam_semi_angle):
     '''
     num_rays = r.shape[2]
 
-    # Use the equation from stack overflow about ukrainian graves
-    # to calculate the number of even rings including decimal remainder
-    num_circles_dec = (-1+np.sqrt(1+4*(num_rays)/(np.pi)))/2
+    num_points_kth_ring = ring_beam_points(num_rays)
 
-    # Get the number of integer rings
-    num_circles_int = int(np.floor(num_circles_dec))
-
-    # Calculate the number of points per ring with the integer amoung of rings
-    num_points_kth_ring = np.round(
-        2*np.pi*(np.arange(0, num_circles_int+1))).astype(np.int32)
-
-    # get the remainding amount of rays
-    remainder_rays = num_rays - np.sum(num_points_kth_ring)
-
-    # Get the proportion of points in each rung
-    proportion = num_points_kth_ring/np.sum(num_points_kth_ring)
+    # Make get the radii for the number of circles of rays we need
+    radii = np.linspace(0, outer_radius, len(num_points_kth_ring))
 
-    # resolve this proportion to an integer value, and reverse it
-    num_rays_to_each_ring = np.ceil(proportion*remainder_rays)[::-1].astype(np.int32)
+    # fill in the x and y coordinates to our ray array
+    rings, t = ring_beam_coords(num_points_kth_ring, 0, num_rays)
+    r[0, 0, :len(rings)] = radii[rings]*np.cos(t)
+    r[0, 2, :len(rings)] = radii[rings]*np.sin(t)
 
-    # We need to decide on where to stop adding the remainder of rays to the
-    # rest of the rings. We find this point by summing the rays in each ring
-    # from outside to inside, and then getting the index where it is greater
-    # than or equal to the remainder
-    index_to_stop_adding_rays = np.where(
-        np.cumsum(num_rays_to_each_ring) >= remainder_rays)[0][0]
+    return r, num_points_kth_ring
 
-    # We then get the total number of rays to add
-    rays_to_add = np.cumsum(num_rays_to_each_ring)[
-        index_to_stop_adding_rays].astype(np.int32)
 
-    # The number of rays to add isn't always matching the remainder, so we
-    # collect them here with this line
-    final_sub = rays_to_add - remainder_rays
+def point_beam(r, gun_beam_semi_angle):
+    '''Generates a point initial beam that spreads out with semi angle 'gun_beam_semi_angle'
 
-    # Here we take them away so we get the number of rays we want
-    num_rays_to_each_ring[index_to_stop_adding_rays] -= final_sub
+    Parameters
+    ----------
+    r : ndarray
+        Ray position and slope matrix
+    gun_beam_semi_angle : float
+        Beam semi angle in radians
 
-    # Then we add all of these rays to the correct ring
-    num_points_kth_ring[::-1][:index_to_stop_adding_rays+1] += num_rays_to_each_ring[
-        :index_to_stop_adding_rays+1
-    ]
+    Returns
+    -------
+    r : ndarray
+        Updated ray position & slope matrix which create a circular beam
+    num_points_kth_ring: ndarray
+        Array of the number of points on each ring of our circular beam
+    '''
+    num_rays = r.shape[2]
 
-    # Add one point for the centre, and take one away from the end
-    num_points_kth_ring[0] = 1
-    num_points_kth_ring[-1] = num_points_kth_ring[-1] - 1
+    num_points_kth_ring = ring_beam_points(num_rays)
 
     # Make get the radii for the number of circles of rays we need
-    radii = np.linspace(0, 1, num_circles_int+1)
+    radii = np.linspace(0, 1, len(num_points_kth_ring))
 
     # fill in the x and y coordinates to our ray array
-    idx = 0
-    for i in range(len(radii)):
-        for j in range(num_points_kth_ring[i]):
-            radius = radii[i]
-            t = j*(2 * np.pi / num_points_kth_ring[i])
-            r[0, 1, idx] = np.tan(gun_beam_semi_angle*radius)*np.cos(t)
-            r[0, 3, idx] = np.tan(gun_beam_semi_angle*radius)*np.sin(t)
-            idx += 1
+    rings, t = ring_beam_coords(num_points_kth_ring, 0, num_rays)
+    r[0, 1, :len(rings)] = np.tan(gun_beam_semi_angle*radii[rings])*np.cos(t)
+    r[0, 3, :len(rings)] = np.tan(gun_beam_semi_angle*radii[rings])*np.sin(t)
 
     return r, num_points_kth_ring
 
@@ -274,6 +513,133 @@ def x_axial_point_beam(r, gun_beam_semi_angle):
     return r
 
 
+def apply_matrix(matrix, rays, out, axes=(0, 2)):
+    '''Apply a 5x5 ray transfer matrix to rays which are stored either with the row of ones
+    (shape (5, num rays)) or without it (shape (4, num rays)). The row of ones is always taken
+    to be one, and is not written.
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Ray transfer matrix
+    rays : ndarray
+        Ray positions & slopes
+    out : ndarray
+        Array of the same shape as rays, but not the same memory, where the result is written
+    axes : tuple, optional
+        Position rows of the axes to compute - (0, 2) for x and y, (0,) for x or (2,) for y.
+        A single axis can only be computed on its own if the matrix does not couple x and y,
+        by default (0, 2)
+    '''
+    matrix = np.asarray(matrix, dtype=rays.dtype)
+
+    if len(axes) == 2:
+        np.matmul(matrix[:4, :4], rays[:4], out=out[:4])
+        out[:4] += matrix[:4, 4:5]
+    else:
+        row = axes[0]
+        np.matmul(matrix[row:row+2, row:row+2], rays[row:row+2], out=out[row:row+2])
+        out[row:row+2] += matrix[row:row+2, 4:5]
+
+
+def get_array_namespace(*arrays):
+    '''Array namespace of arrays, from the __array_namespace__ method of the array API standard
+
+    Parameters
+    ----------
+    arrays : ndarray
+        Arrays of one namespace. Arrays without a namespace (lists, numbers or arrays of
+        numpy < 2) are taken to be numpy arrays
+
+    Returns
+    -------
+    module
+        Array namespace, such as numpy or array_api_strict
+    '''
+    for array in arrays:
+        if hasattr(array, '__array_namespace__'):
+            return array.__array_namespace__()
+
+    return np
+
+
+def to_numpy(array):
+    '''Convert an array of any array namespace on the CPU to a numpy array, without a copy
+    if possible
+
+    Parameters
+    ----------
+    array : ndarray
+        Array of an array namespace which supports DLPack
+
+    Returns
+    -------
+    ndarray
+        Numpy array
+    '''
+    if isinstance(array, np.ndarray) or get_array_namespace(array) is np:
+        return np.asarray(array)
+
+    return np.from_dlpack(array)
+
+
+def transfer_matrix(matrix, rays):
+    '''Array API version of apply_matrix, which returns the transferred rays as a new array
+    in the namespace of the rays, instead of writing into an output array
+
+    Parameters
+    ----------
+    matrix : ndarray
+        Ray transfer matrix (a 5x5 numpy array)
+    rays : ndarray
+        Ray positions & slopes, of shape (5, num rays) or (4, num rays)
+
+    Returns
+    -------
+    ndarray
+        Rays leaving the matrix
+    '''
+    xp = get_array_namespace(rays)
+    matrix = np.asarray(matrix, dtype=np.float64)
+
+    if rays.shape[0] == 5:
+        return xp.matmul(xp.asarray(matrix.tolist(), dtype=rays.dtype), rays)
+
+    return xp.matmul(xp.asarray(matrix[:4, :4].tolist(), dtype=rays.dtype), rays) + \
+        xp.asarray(matrix[:4, 4:5].tolist(), dtype=rays.dtype)
+
+
+def apply_thin_lens(matrix, rays, out, axes=(0, 2)):
+    '''Apply a thin lens matrix to rays, for which only the slopes change by the
+    lens power (matrix[1, 0] in x and matrix[3, 2] in y) times the position.
+    Parameters are the same as apply_matrix.
+    '''
+    positions = slice(axes[0], axes[-1] + 1, 2)
+    np.copyto(out[positions], rays[positions])
+    for row in axes:
+        np.multiply(rays[row], rays.dtype.type(matrix[row+1, row]), out=out[row+1])
+        out[row+1] += rays[row+1]
+
+
+def apply_kick(matrix, rays, out, axes=(0, 2)):
+    '''Apply a deflector matrix to rays, for which only the slopes change by a
+    constant kick (matrix[1, 4] in x and matrix[3, 4] in y).
+    Parameters are the same as apply_matrix.
+    '''
+    positions = slice(axes[0], axes[-1] + 1, 2)
+    np.copyto(out[positions], rays[positions])
+    for row in axes:
+        np.add(rays[row+1], rays.dtype.type(matrix[row+1, 4]), out=out[row+1])
+
+
+def copy_rays(rays, out, axes=(0, 2)):
+    '''Copy the rows of the axes of rays which pass through a component unchanged.
+    Parameters are the same as apply_matrix.
+    '''
+    rows = slice(axes[0], axes[-1] + 2)
+    np.copyto(out[rows], rays[rows])
+
+
 def _flip_y():
     # From libertem.corrections.coordinates v0.11.1
     return np.array([
@@ -303,6 +669,9 @@ def _rotate_deg(degrees):
 
 
 def get_pixel_coords(rays_x, rays_y, size, pixels, flip_y=False, scan_rotation=0.):
+    xp = get_array_namespace(rays_x, rays_y)
+    rays_x, rays_y = xp.asarray(rays_x), xp.asarray(rays_y)
+
     if flip_y:
         transform = _flip_y()
     else:
@@ -311,7 +680,14 @@ def get_pixel_coords(rays_x, rays_y, size, pixels, flip_y=False, scan_rotation=0
     # Transformations are applied right to left
     transform = _rotate_deg(scan_rotation) @ transform
 
-    y_transformed, x_transformed = (np.array((rays_y, rays_x)).T @ transform).T
+    # Keep the precision of the rays, so that single precision rays are not
+    # converted to double precision here
+    dtype = xp.result_type(rays_x.dtype, rays_y.dtype, xp.float32)
+    transform = xp.asarray(transform.tolist(), dtype=dtype)
+    size, pixels = float(size), float(pixels)
+
+    transformed = xp.stack((xp.astype(rays_y, dtype), xp.astype(rays_x, dtype)), axis=1) @ transform
+    y_transformed, x_transformed = transformed[:, 0], transformed[:, 1]
 
     pixel_coords_x = x_transformed / size * pixels + pixels/2 - 1
     pixel_coords_y = y_transformed / size * pixels + pixels/2 - 1
@@ -347,6 +723,14 @@ def get_image_from_rays(
         Pixel resolution of the the sample
     sample_image : ndarray
         image intensities of the sample. Used to form an image on the detector
+    flip_y : bool, optional
+        Flip the y axis of the pixel coordinates, by default True
+
+    The pixel coordinates are computed in the precision of the rays, so float32
+    rays give float32 coordinates. Rays can be arrays of any array API namespace: the
+    pixel coordinates are computed in that namespace, and the images are filled with numpy,
+    as the array API has no scatter into an array.
+
     Returns
     -------
     detector_ray_image : ndarray
@@ -358,36 +742,41 @@ def get_image_from_rays(
     detector_pixel_coords : ndarray
         Coordinates of where each ray has hit the detector
     '''
+    xp = get_array_namespace(rays_x, rays_y, sample_rays_x, sample_rays_y)
+
     detector_ray_image = np.zeros((detector_pixels, detector_pixels), dtype=np.uint8)
     detector_sample_image = np.zeros((detector_pixels, detector_pixels))
 
     # Convert rays from sample positions to pixel positions
-    sample_pixel_coords_x, sample_pixel_coords_y = np.round(get_pixel_coords(
+    sample_pixel_coords = xp.astype(xp.round(xp.stack(get_pixel_coords(
         rays_x=sample_rays_x,
         rays_y=sample_rays_y,
         size=sample_size,
         pixels=sample_pixels,
         flip_y=flip_y
-    )).astype(np.int32)
-
-    sample_pixel_coords = np.vstack([sample_pixel_coords_x, sample_pixel_coords_y]).T
+    ), axis=1)), xp.int32)
 
     # Convert rays from detector positions to pixel positions
-    detector_pixel_coords_x, detector_pixel_coords_y = np.round(get_pixel_coords(
+    detector_pixel_coords = xp.astype(xp.round(xp.stack(get_pixel_coords(
         rays_x=rays_x,
         rays_y=rays_y,
         size=detector_size,
         pixels=detector_pixels,
         flip_y=flip_y
-    )).astype(np.int32)
+    ), axis=1)), xp.int32)
 
-    detector_pixel_coords = np.vstack([detector_pixel_coords_x, detector_pixel_coords_y]).T
-    sample_rays_inside = np.all(
+    sample_rays_inside = xp.all(
         (sample_pixel_coords > 0) & (sample_pixel_coords < sample_pixels), axis=1
-    ).T
-    detector_rays_inside = np.all(
+    )
+    detector_rays_inside = xp.all(
         (detector_pixel_coords > 0) & (detector_pixel_coords < detector_pixels), axis=1
-    ).T
+    )
+
+    # The images are filled with numpy
+    sample_pixel_coords = to_numpy(sample_pixel_coords)
+    detector_pixel_coords = to_numpy(detector_pixel_coords)
+    sample_rays_inside = to_numpy(sample_rays_inside)
+    detector_rays_inside = to_numpy(detector_rays_inside)
     rays_that_hit_sample_and_detector = (sample_rays_inside & detector_rays_inside)
     rays_that_hit_detector_but_not_sample = (~sample_rays_inside & detector_rays_inside)
 
@@ -415,6 +804,47 @@ def get_image_from_rays(
     return detector_ray_image, detector_sample_image, sample_pixel_coords, detector_pixel_coords
 
 
+def blocked_at_dtype(num_components):
+    '''Smallest unsigned integer type that holds the index of every component of a column,
+    and the number of components, which is the code of rays that are never blocked
+
+    Parameters
+    ----------
+    num_components : int
+        Number of components in the column
+
+    Returns
+    -------
+    dtype
+        np.uint8, or np.uint16 for a column of more than 255 components
+    '''
+    return np.dtype(np.uint8 if num_components <= np.iinfo(np.uint8).max else np.uint16)
+
+
+def alive_after(blocked_at, component_idx):
+    '''Find the rays which pass a component, and every component above it
+
+    Parameters
+    ----------
+    blocked_at : ndarray
+        Index of the first component which blocks each ray
+    component_idx : int or ndarray
+        Index of the component in the column (-1 for the gun), or an array of indices
+
+    Returns
+    -------
+    ndarray
+        Boolean array of shape (num rays), or (len(component_idx), num rays) for an array of
+        indices, which is True for the rays that are still travelling after the component
+    '''
+    xp = get_array_namespace(blocked_at)
+    if xp is np:
+        return blocked_at > np.asarray(component_idx)[..., None]
+
+    # The gun (-1) is not an index of the unsigned codes
+    return xp.astype(blocked_at, xp.int32) > xp.asarray(component_idx, dtype=xp.int32)[..., None]
+
+
 def convert_rays_to_line_vertices(model):
     '''Converts a ray position matrix of size [(steps, 5, num rays)] -
     (where steps is defined by the number of components + 2 - the two being
@@ -426,45 +856,36 @@ def convert_rays_to_line_vertices(model):
     ----------
     model : class
         Microscope model that stores all associated ray position data
-    gun_beam_semi_angle : float
-        Beam semi angle in radians
 
     Returns
     -------
-    r : ndarray
-        Updated ray position & slope matrix which create a circular beam
+    lines_paired : ndarray
+        Vertices of the lines of every ray, of shape [(steps*2-2)*num rays, 3]. Rays which are
+        blocked stop at the plane of the component that blocks them
+    allowed_rays : ndarray
+        Boolean array which is True for the rays that reach the detector
     '''
+    if model.r.shape[0] != len(model.z_positions):
+        raise ValueError(
+            'Every plane of the model must be kept to draw the rays (keep_planes = \'all\')')
+
     ray_z = np.tile(model.z_positions, [model.num_rays, 1, 1]).T
 
     # Stack with the z coordinates
-    ray_xyz = np.hstack((model.r[:, [0, 2], :], ray_z))
-
-    # Repeat vertices so we can create lines. The shape of this array is [Num Steps*2, 3, Num Rays]
-    lines_repeated = np.repeat(ray_xyz[:, :, :], repeats=2, axis=0)[1:-1]
-
-    # Index the total number of rays in the model initially which are by default
-    # allowed through all components
-    allowed_rays = range(model.num_rays)
-
-    for component in model.components:
-        if len(component.blocked_ray_idcs) != 0:
-            # Find the difference between blocked rays and original amount of allowed rays
-            allowed_rays = list(set(allowed_rays).difference(set(component.blocked_ray_idcs)))
-            # Convert from ray position indexing, to line indexing
-            idx = component.index*2+2
-            # Get the coordinates of all rays which hit the aperture.
-            pts_blocked = lines_repeated[idx, :, component.blocked_ray_idcs]
-            # Do really funky array manipulation to create a copy of all of
-            # these points that is the same shape as the vertices of remaining
-            # lines after the aperture (I'm sorry to myself and anyone in the
-            # future who has to read this)
-            lines_aperture = np.broadcast_to(
-                pts_blocked[..., None], pts_blocked.shape+(lines_repeated.shape[0]-(idx),)
-            ).transpose(2, 1, 0)
-
-            # Copy the coordinate of all rays that hit the aperture, to all line
-            # vertices after this, so we don't visualise them.
-            lines_repeated[idx:, :, component.blocked_ray_idcs] = lines_aperture
+    ray_xyz = np.hstack((model.get_full_r()[:, [0, 2], :], ray_z))
+
+    # Find the plane where every ray stops, which is the last plane of the component that
+    # blocks it, or the detector for rays that are never blocked
+    stop_plane_idcs = np.array(
+        [component.index + 1 for component in model.components] + [model.steps - 1])
+    ray_stop_plane_idcs = stop_plane_idcs[model.get_blocked_at()]
+
+    # Every line vertex is a copy of the ray at a plane. The shape of the vertex array is
+    # [Num Steps*2-2, 3, Num Rays], and vertices after the plane where a ray stops are set to
+    # the point where it stops, so we don't visualise them.
+    vertex_plane_idcs = np.arange(1, 2*model.steps - 1) // 2
+    vertex_plane_idcs = np.minimum(vertex_plane_idcs[:, None], ray_stop_plane_idcs[None, :])
+    lines_repeated = np.take_along_axis(ray_xyz, vertex_plane_idcs[:, None, :], axis=0)
 
     # Then restack each line so that we end up with a long list of lines, from
     # [Num Steps*2, 3, Num Rays] > [(Num Steps*2-2)*Num rays, 3]
@@ -472,4 +893,6 @@ def convert_rays_to_line_vertices(model):
     lines_paired = lines_repeated.transpose(2, 0, 1).reshape(
         lines_repeated.shape[0]*model.num_rays, 3)
 
+    allowed_rays = model.allowed_ray_bools()
+
     return lines_paired, allowed_rays
@@ -0,0 +1,104 @@
+import numpy as np
+
+'''Cumulative ray transfer matrices of a column as polynomials in the powers (1/f) of some of its
+lenses. The matrix of a thin lens is a constant matrix plus a derivative matrix times each of its
+powers, so the cumulative matrix of every plane is a polynomial in the powers of the lenses above
+it, with one term for each choice of one power (or none) of every lens. The coefficients only
+depend on the rest of the column, so they are found once, after which the matrices of every plane
+for any powers (or for a whole series of powers at once) are a single product of the terms and the
+coefficients.'''
+
+class LensPowerPolynomial():
+    '''Coefficients of the cumulative transfer matrices of every plane of a column, as a polynomial
+    in the powers of its variable lenses. Each term is a product of at most one power of each lens.
+    '''
+    def __init__(self, propagation_matrices, plane_matrices, variable_planes):
+        '''
+
+        Parameters
+        ----------
+        propagation_matrices : ndarray
+            Propagation matrices between the planes of the column, from the gun to the detector,
+            of shape (planes - 1, 5, 5)
+        plane_matrices : ndarray
+            Transfer matrices of the planes of the components, of shape (planes - 2, 5, 5). The
+            matrices of the variable planes are not used
+        variable_planes : dict
+            Constant matrix and list of derivative matrices (see Component.power_matrices) of
+            every plane of a variable lens, keyed by the index of the plane in plane_matrices
+        '''
+        self.variable_planes = sorted(variable_planes)
+        self.num_powers = [len(variable_planes[plane][1]) for plane in self.variable_planes]
+        self.num_terms = int(np.prod([num_powers + 1 for num_powers in self.num_powers]))
+        self.steps = len(propagation_matrices) + 1
+
+        # Terms are numbered with one digit per lens, the first lens being the least significant,
+        # where the digit is 0 if the term has no power of the lens, or j if it has its j-th power.
+        # Terms of the lenses below a plane are still zero at that plane.
+        self.coefficients = np.zeros((self.steps, self.num_terms, 5, 5), dtype=np.float64)
+        product = np.zeros((self.num_terms, 5, 5), dtype=np.float64)
+        product[0] = np.eye(5)
+        self.coefficients[0] = product
+        stride = 1
+
+        for idx in range(1, self.steps):
+            product = propagation_matrices[idx-1] @ product
+
+            # The detector has no component, so it only needs the final propagation
+            if idx - 1 in variable_planes:
+                constant, derivatives = variable_planes[idx - 1]
+                lens_terms = product[:stride]
+                product = constant @ product
+                for power_idx, derivative in enumerate(derivatives, start = 1):
+                    product[power_idx*stride:(power_idx + 1)*stride] = derivative @ lens_terms
+                stride *= len(derivatives) + 1
+            elif idx < self.steps - 1:
+                product = plane_matrices[idx-1] @ product
+
+            self.coefficients[idx] = product
+
+        # Terms first, so that the matrices of all planes are one matrix product of the terms
+        self.term_coefficients = self.coefficients.transpose(1, 0, 2, 3).reshape(self.num_terms, -1)
+
+    def terms(self, powers):
+        '''Values of the terms of the polynomial
+
+        Parameters
+        ----------
+        powers : ndarray
+            Powers of the variable lenses, in order down the column, of shape (..., total powers)
+
+        Returns
+        -------
+        ndarray
+            Value of every term, of shape (..., num terms)
+        '''
+        powers = np.asarray(powers, dtype=np.float64)
+        terms = np.ones(powers.shape[:-1] + (1,), dtype=np.float64)
+
+        start = 0
+        for num_powers in self.num_powers:
+            lens_powers = powers[..., start:start + num_powers]
+            terms = np.concatenate(
+                [terms] + [terms*lens_powers[..., j:j+1] for j in range(num_powers)], axis = -1)
+            start += num_powers
+
+        return terms
+
+    def evaluate(self, powers):
+        '''Cumulative transfer matrices of every plane of the column for some powers of the lenses
+
+        Parameters
+        ----------
+        powers : ndarray
+            Powers of the variable lenses, in order down the column, of shape (total powers) or
+            (..., total powers) for a series of powers
+
+        Returns
+        -------
+        ndarray
+            Matrices of shape (..., planes, 5, 5)
+        '''
+        terms = self.terms(powers)
+
+        return (terms @ self.term_coefficients).reshape(terms.shape[:-1] + (self.steps, 5, 5))
@@ -0,0 +1,118 @@
+import numpy as np
+
+'''A segment tree of ray transfer matrix products. The leaves of the tree are the ordered transfer
+matrices of a column (propagation, component, propagation, component...), and every node stores the
+product of the leaves below it. Changing one leaf costs O(log n) matrix products, and the product of
+any prefix of the column (the cumulative matrix of a plane) can be queried in O(log n) products.'''
+
+class MatrixProductTree():
+    '''Balanced binary tree of partial products of a sequence of square matrices. The sequence
+    is applied in order, so the product of elements [e0, e1, e2] is e2 @ e1 @ e0.
+    '''
+    def __init__(self, matrices):
+        '''
+
+        Parameters
+        ----------
+        matrices : ndarray
+            Ordered stack of matrices of shape (n, d, d)
+        '''
+        matrices = np.asarray(matrices, dtype=np.float64)
+
+        self.num_leaves = matrices.shape[0]
+        self.dim = matrices.shape[1]
+
+        # Pad the number of leaves to a power of two with identity matrices
+        self.size = 1
+        while self.size < max(self.num_leaves, 1):
+            self.size *= 2
+
+        self.tree = np.empty((2*self.size, self.dim, self.dim), dtype=np.float64)
+        self.tree[:] = np.eye(self.dim)
+        self.tree[self.size:self.size + self.num_leaves] = matrices
+
+        for node in range(self.size - 1, 0, -1):
+            np.matmul(self.tree[2*node + 1], self.tree[2*node], out=self.tree[node])
+
+    def leaf(self, idx):
+        '''Get the matrix stored in a leaf
+
+        Parameters
+        ----------
+        idx : int
+            Index of the leaf
+
+        Returns
+        -------
+        ndarray
+            Matrix of the leaf
+        '''
+        return self.tree[self.size + idx]
+
+    def update(self, idx, matrix):
+        '''Replace the matrix of one leaf and recompute the products above it
+
+        Parameters
+        ----------
+        idx : int
+            Index of the leaf
+        matrix : ndarray
+            New matrix of the leaf
+        '''
+        node = self.size + idx
+        self.tree[node] = matrix
+        node //= 2
+
+        while node >= 1:
+            np.matmul(self.tree[2*node + 1], self.tree[2*node], out=self.tree[node])
+            node //= 2
+
+    def product(self, start, stop):
+        '''Product of the leaves in the range [start, stop)
+
+        Parameters
+        ----------
+        start : int
+            Index of the first leaf in the product
+        stop : int
+            Index after the last leaf in the product
+
+        Returns
+        -------
+        ndarray
+            Matrix product of the leaves, applied in order
+        '''
+        left = np.eye(self.dim)
+        right = np.eye(self.dim)
+
+        start += self.size
+        stop += self.size
+
+        # Nodes collected from the left are applied after everything before them,
+        # and nodes collected from the right are applied before everything after them
+        while start < stop:
+            if start & 1:
+                left = self.tree[start] @ left
+                start += 1
+            if stop & 1:
+                stop -= 1
+                right = right @ self.tree[stop]
+            start //= 2
+            stop //= 2
+
+        return right @ left
+
+    def prefix(self, stop):
+        '''Product of the first leaves of the tree
+
+        Parameters
+        ----------
+        stop : int
+            Number of leaves in the product
+
+        Returns
+        -------
+        ndarray
+            Matrix product of the leaves, applied in order
+        '''
+        return self.product(0, stop)
@@ -1,7 +1,16 @@
 
 import numpy as np
-from temgymbasic.functions import circular_beam, point_beam, axial_point_beam, x_axial_point_beam
+import copy
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+from temgymbasic.functions import circular_beam, point_beam, axial_point_beam, x_axial_point_beam, \
+    beam_slice, apply_matrix, get_pixel_coords, get_image_from_rays, blocked_at_dtype, \
+    alive_after, transfer_matrix, to_numpy, get_array_namespace, beam_moments, ring_beam_points, \
+    ring_beam_coords, ring_beam_rays, rotate_ring_rays
 from temgymbasic.gui import ModelGui, ExperimentGui
+from temgymbasic.matrix_tree import MatrixProductTree
+from temgymbasic.lens_polynomial import LensPowerPolynomial
+from temgymbasic import numba_backend
 
 '''This class create the model composed of the specified components, and handles all of the computation
 that transmits the rays through each component.'''
@@ -11,14 +20,23 @@ class Model():
     multiplication and function updates to calculate their positions throughout
     the column.
     '''
+    # Tiles of fewer rays than this are propagated in one pass of the column for both axes, even
+    # if the column is separable, as each pass costs a kernel call per plane (see get_ray_axes)
+    separable_axes_min_rays = 2**15
+
     def __init__(self, components, beam_z=1, num_rays=16, beam_type='point', 
                  gun_beam_semi_angle=0, beam_tilt_x=0, beam_tilt_y=0, beam_radius = 0.125,
-                 detector_size = 0.5, detector_pixels = 128, experiment = None):
+                 detector_size = 0.5, detector_pixels = 128, experiment = None,
+                 compact_rays = False, dtype = np.float64, num_workers = 1, tile_size = 2**15,
+                 keep_planes = 'all', drop_blocked_rays = False, defer_blocking = False,
+                 backend = 'numpy', array_namespace = None):
         '''
         Parameters
         ----------
         components : list
-            List of components to electron microscope component to input into the model
+            List of components to electron microscope component to input into the model. The z
+            of every component is read at each step, so components can be moved, and they can be
+            inserted or removed with insert_component and remove_component
         beam_z : int, optional
             Sets the initial height of the beam, by default 1
         num_rays : int, optional
@@ -52,6 +70,60 @@ class Model():
                 in the model.
                 - '4DSTEM' sets up the conditions for a basic 4DSTEM experiment with an overfocused beam
                 projecting an image of the sample at each scan position.
+        compact_rays : bool, optional
+            Store the rays without the row of ones, so that the ray matrix is of shape
+            (steps, 4, num rays) instead of (steps, 5, num rays). The offset column of every
+            matrix is then added to the rays directly, by default False
+        dtype : data-type, optional
+            Floating point precision of the rays. np.float32 halves the memory traffic of large
+            beams, and check_precision() reports how far the pixel coordinates are from a
+            np.float64 reference, by default np.float64
+        num_workers : int, optional
+            Number of threads which propagate the rays. With more than one worker the tiles of rays
+            are sent through the column in parallel on a thread pool. The results are identical
+            to a single worker, by default 1
+        tile_size : int, optional
+            Number of rays in a tile. Each tile is sent through the whole column on its own, so it
+            should be small enough that the rays of a tile stay in the cache of a core,
+            by default 2**15
+        keep_planes : str or list, optional
+            Planes of the column which are kept in the ray matrix (self.r):
+                    - 'all' keeps every plane.
+                    - 'endpoints' keeps only the gun and the detector.
+                    - a list of component names keeps the gun, the detector and the planes of
+                    those components.
+            Blocked rays are still found at every aperture and biprism. Use component_r_idx and
+            component_rays to find the planes of components in self.r. The 3D view of the GUI needs
+            every plane, by default 'all'
+        drop_blocked_rays : bool, optional
+            Drop the rays blocked by each aperture and biprism, so that only the rays which are
+            still travelling are propagated to the planes below it. Each plane then holds its
+            rays in its first columns, and self.ray_idcs has the index of the gun ray of every
+            column (or None if the plane holds every ray). Use get_full_plane, get_full_r and
+            get_allowed_rays to read planes in the order of the gun rays, by default False
+        defer_blocking : bool, optional
+            Only find the blocked rays when they are needed (by get_blocked_at, alive_after,
+            allowed_ray_bools and the functions that use them), instead of after every step.
+            Blocking never changes the path of a ray, so a step then only propagates the rays, and
+            consumers that only need the geometry of the rays never pay for it. Blocked rays are
+            always found during a step if they are dropped (see drop_blocked_rays), by default False
+        backend : str, optional
+            Choose how the rays are traced:
+                    - 'numpy' propagates whole planes of rays one component at a time.
+                    - 'numba' traces each ray through the whole column in a compiled kernel, testing
+                    the stops as it goes, with the rays split between num_workers threads.
+                    trace_chunked then adds the rays straight to the detector image without storing
+                    any plane. The NumPy path is used if numba is not installed, if rays are dropped
+                    (see drop_blocked_rays), or if a component can't be traced by the kernel,
+                    by default 'numpy'
+        array_namespace : module, optional
+            Array API namespace of the rays (self.r) and the codes of the blocked rays, such as
+            array_api_strict, or another array library which follows the array API standard. Rays
+            of another namespace than numpy are traced with the array API versions of the component
+            kernels (Component.transfer and Component.blocked_array), and every step builds new
+            planes instead of writing them in place. The beam is generated and the detector images
+            are filled with numpy. Dropping blocked rays (drop_blocked_rays) and the numba backend
+            need numpy, by default None, which is numpy
         
         '''        
         self.components = components
@@ -69,7 +141,21 @@ class Model():
         self.beam_tilt_x = beam_tilt_x
         self.beam_tilt_y = beam_tilt_y
         self.experiment = experiment
+        self.compact_rays = compact_rays
+        self.dtype = np.dtype(dtype)
+        self.num_workers = num_workers
+        self.tile_size = tile_size
+        self.keep_planes = keep_planes
+        self.drop_blocked_rays = drop_blocked_rays
+        self.defer_blocking = defer_blocking
+        self.backend = backend
+        self.xp = np if array_namespace is None else array_namespace
+
+        if self.xp is not np and self.drop_blocked_rays:
+            raise ValueError('Blocked rays can only be dropped from numpy rays')
         
+        self.variable_lenses = []
+
         if self.experiment == '4DSTEM':
             
             if self.components[0].type != 'Double Deflector':
@@ -90,6 +176,7 @@ class Model():
                 self.semiconv = 0.01
                 self.set_beam_radius_from_semiconv(self.semiconv)
                 self.set_obj_lens_f_from_overfocus(self.overfocus)
+                self.set_variable_lenses([self.obj_lens.name])
                 
                 self.scan_pixel_x = 0
                 self.scan_pixel_y = 0
@@ -100,6 +187,8 @@ class Model():
         self.set_z_positions()
         
         self.z_distances = np.diff(self.z_positions)
+        self.first_stale_plane = 1
+        self.update_propagation_matrices()
         
         #Make the matrix of rays that depends on the beam conditions input into the model.
         self.generate_rays()
@@ -113,31 +202,226 @@ class Model():
     def set_z_positions(self):
         '''Create the z position list of all components in the model
         '''        
-        self.z_positions = []
-        
-        #Input the initial beam_z as the first z_position
-        self.z_positions.append(self.beam_z)
+        self.z_positions, self.plane_components, self.component_plane_idcs = \
+            self.get_plane_layout(self.components)
         
-        #We need to loop through all components and where there is a double deflector,
-        #we need to add an extra z_position to the matrix
-        double_deflectors = 0
+        # A removed sample leaves no sample plane
+        for attribute in ['sample_plane_idx', 'sample_r_idx', 'sample_idx']:
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+
         for idx, component in enumerate(self.components):
-            if component.type == 'Double Deflector':
-                self.z_positions.append(component.z_up)
-                component.index = idx
-                self.z_positions.append(component.z_low)
-                component.index = idx + 1
-                double_deflectors += 1
-            else:
-                self.z_positions.append(component.z)
-                component.index = idx + double_deflectors
-                
+            # Index of the last plane of the component in the ray matrix, minus one for the gun
+            num_component_planes = len(component.plane_z_positions())
+            component.index = self.component_plane_idcs[idx] + num_component_planes - 2
+            # Model which holds the blocked rays of the component (see Component.blocked_ray_idcs)
+            component.model = self
+
             if component.type == 'Sample':
-                self.sample_r_idx = idx + double_deflectors + 1
+                self.sample_plane_idx = self.component_plane_idcs[idx]
+                self.sample_r_idx = self.sample_plane_idx
                 self.sample_idx = idx
+
+    def update_z_positions(self):
+        '''Read the z positions of the planes from the components (and of the gun from beam_z), so
+        that the z of a component is a live parameter like any other. If a component has moved,
+        z_positions and z_distances are replaced, and only the gaps on either side of it get new
+        propagation matrices (see update_propagation_matrices). The components must stay in the
+        order of the column; use insert_component and remove_component to change it. A plane
+        which has moved above the plane before it raises a ValueError.
+        '''
+        z_positions = [self.beam_z] + [component.plane_z_positions()[plane]
+                                       for component, plane in self.plane_components] + [0]
+
+        if z_positions != self.z_positions:
+            z_distances = np.diff(z_positions)
+            out_of_order = np.flatnonzero(z_distances > 0)
+            if len(out_of_order) > 0:
+                gap = out_of_order[0]
+                names = ['Gun'] + [component.name for component, _ in self.plane_components] + \
+                    ['Detector']
+                raise ValueError('{} (z = {}) is above {} (z = {}); use remove_component and '
+                                 'insert_component to change the order of the column'.format(
+                                     names[gap+1], z_positions[gap+1], names[gap],
+                                     z_positions[gap]))
+
+            self.z_positions = z_positions
+            self.z_distances = z_distances
+
+    def insert_component(self, component, index = None):
+        '''Insert a component into the column, without building the model again. The rays
+        and the planes above the component are kept, and only the planes below it are
+        propagated again at the next step (see update_layout).
+
+        Parameters
+        ----------
+        component : Component
+            Component to insert
+        index : int, optional
+            Index of the component in self.components, by default the index that keeps the
+            components in order of their z down the column
+        '''
+        if index is None:
+            z = component.plane_z_positions()[0]
+            index = next((idx for idx, other in enumerate(self.components)
+                          if other.plane_z_positions()[0] < z), len(self.components))
+
+        old_components = list(self.components)
+        self.components.insert(index, component)
+        self.update_layout(old_components, index)
+
+    def remove_component(self, name):
+        '''Remove a component from the column, without building the model again. The rays
+        and the planes above the component are kept, and only the planes below it are
+        propagated again at the next step (see update_layout).
+
+        Parameters
+        ----------
+        name : str
+            Name of the component. If several components have the name, the first is removed
+
+        Returns
+        -------
+        Component
+            The removed component
+        '''
+        names = [component.name for component in self.components]
+        if name not in names:
+            raise ValueError('The model has no component named {}'.format(name))
+
+        index = names.index(name)
+        old_components = list(self.components)
+        component = self.components.pop(index)
+
+        # Lenses and planes chosen by the name of the component are forgotten with it
+        if names.count(name) == 1:
+            self.variable_lenses = [lens for lens in self.variable_lenses if lens != name]
+            if not isinstance(self.keep_planes, str):
+                self.keep_planes = [plane for plane in self.keep_planes if plane != name]
+
+        self.update_layout(old_components, index)
+
+        return component
+
+    def update_layout(self, old_components, first_component_idx):
+        '''Update the planes of the model after components have been inserted or removed. The
+        planes above the first changed component are the same as before, so their rays (in
+        self.r and in the blocking workspace) are kept, and the rays are not generated again.
+        The codes of the blocked rays are moved to the new indices of the components, and the
+        planes below the change are propagated (and their blocked rays found) at the next step.
+        The GL geometry of the components is not touched.
+
+        Parameters
+        ----------
+        old_components : list
+            Components of the column before the change
+        first_component_idx : int
+            Index of the first component of self.components which is not at the same index
+            in old_components
+        '''
+        old_r = self.r
+        old_blocking_r = getattr(self, 'blocking_r', None)
+        old_blocking_planes = self.blocking_planes
+        traced = self.r is getattr(self, 'traced_r', None)
+        traced_versions = dict(zip([id(component) for component in old_components],
+                                   getattr(self, 'traced_versions', [])))
+        beam_generated = self.get_beam_parameters() == self.beam_parameters
+
+        self.set_z_positions()
+        self.steps = len(self.z_positions)
+        self.z_distances = np.diff(self.z_positions)
+        self.set_kept_planes()
+        first_plane = self.component_plane_idcs[first_component_idx] \
+            if first_component_idx < len(self.components) else self.steps - 1
+
+        # The kept planes above the first plane of the change are the first planes of self.r in
+        # both layouts. The ray matrix is a view of a buffer with room for a few more planes, so
+        # that planes are added or removed below them without copying the rays
+        num_kept_above = bisect.bisect_left(self.r_planes, first_plane)
+        if len(self.r_planes) != old_r.shape[0]:
+            buffer = getattr(self, 'plane_buffer', None)
+            num_kept = len(self.r_planes)
+            if self.xp is not np:
+                self.r = self.xp.ones((num_kept,) + tuple(old_r.shape[1:]), dtype=old_r.dtype)
+                self.r[:num_kept_above, ...] = old_r[:num_kept_above, ...]
+            elif buffer is not None and old_r.base is buffer and num_kept <= buffer.shape[0]:
+                self.r = buffer[:num_kept]
+            else:
+                self.plane_buffer = np.empty((num_kept + 2,) + old_r.shape[1:], dtype=old_r.dtype)
+                self.r = self.plane_buffer[:num_kept]
+                self.r[:num_kept_above] = old_r[:num_kept_above]
+
+            # The kernels only write the positions and slopes
+            if self.r.shape[1] == 5:
+                self.r[num_kept_above:, 4, ...] = 1
+
+        if old_blocking_r is not None:
+            self.blocking_r = np.ones((len(self.blocking_planes),) + old_blocking_r.shape[1:],
+                                      dtype=old_blocking_r.dtype)
+            for blocking_idx, idx in enumerate(self.blocking_planes):
+                if idx < first_plane:
+                    self.blocking_r[blocking_idx] = old_blocking_r[old_blocking_planes.index(idx)]
+
+        # Codes of the components below the change move with them. Codes from the first changed
+        # component down are found again, so a ray blocked by a removed component keeps a code
+        # which is at least the index of the first changed component
+        blocked_at = to_numpy(self.blocked_at).astype(np.int64)
+        shift = len(self.components) - len(old_components)
+        changed = blocked_at >= first_component_idx
+        blocked_at[changed] = np.maximum(blocked_at[changed] + shift, first_component_idx)
+        blocked_at = blocked_at.astype(blocked_at_dtype(len(self.components)))
+        self.blocked_at = blocked_at if self.xp is np else self.xp.asarray(blocked_at)
+
+        self.ray_idcs = self.ray_idcs[:first_plane] + [None]*(self.steps - first_plane)
+        self.first_stale_plane = min(self.first_stale_plane, first_plane)
+        self.first_stale_blocking_plane = min(self.first_stale_blocking_plane, first_plane)
+
+        # Inserted components have never been traced, so the next step starts at their planes
+        if traced:
+            self.traced_r = self.r
+            self.traced_versions = [traced_versions.get(id(component), -1)
+                                    for component in self.components]
+        if beam_generated:
+            self.beam_parameters = self.get_beam_parameters()
+
+    def get_plane_layout(self, components):
+        '''Find the planes of a list of components, without changing the model
+
+        Parameters
+        ----------
+        components : list
+            Components of the column, in order
+
+        Returns
+        -------
+        z_positions : list
+            Z position of every plane of the ray matrix, from the gun to the detector
+        plane_components : list
+            Component and plane number of the component of every plane between the gun and the
+            detector
+        component_plane_idcs : list
+            Index of the first plane of every component in the ray matrix
+        '''
+        #Input the initial beam_z as the first z_position
+        z_positions = [self.beam_z]
+        
+        # Every component tells us the z positions of its planes (a double deflector has two).
+        # We also store the component and plane number of every plane, and the first plane of every
+        # component, so that rays can be propagated plane by plane from any component.
+        plane_components = []
+        component_plane_idcs = []
+
+        for component in components:
+            component_plane_idcs.append(len(z_positions))
+
+            for plane, z in enumerate(component.plane_z_positions()):
+                z_positions.append(z)
+                plane_components.append((component, plane))
                 
         #Add the position of the detector
-        self.z_positions.append(0)
+        z_positions.append(0)
+
+        return z_positions, plane_components, component_plane_idcs
     
     def set_obj_lens_f_from_overfocus(self, overfocus):
         if overfocus <= 0:    
@@ -145,10 +429,43 @@ class Model():
         
         self.overfocus = overfocus
         
-        #Lens f is always a negative number, and overfocus for now is always a positive number
-        self.obj_lens.f = -1*(self.obj_lens.z-self.sample.z-self.overfocus)
+        self.obj_lens.f = self.obj_lens_f_from_overfocus(overfocus)
         self.obj_lens.set_matrix()
         
+    def obj_lens_f_from_overfocus(self, overfocus):
+        '''Focal length of the objective lens of a 4DSTEM experiment for an overfocus
+
+        Parameters
+        ----------
+        overfocus : float or ndarray
+            Distance of the crossover above the sample
+
+        Returns
+        -------
+        float or ndarray
+            Focal length of the objective lens
+        '''
+        # Lens f is always a negative number, and overfocus for now is always a positive number
+        return -1*(self.obj_lens.z-self.sample.z-overfocus)
+
+    def overfocus_system_matrices(self, overfocus):
+        '''Cumulative transfer matrices of every plane of a 4DSTEM experiment for a series of
+        overfocus values, evaluated from the lens power polynomial of the objective lens without
+        changing the model (see lens_system_matrices)
+
+        Parameters
+        ----------
+        overfocus : float or ndarray
+            Distances of the crossover above the sample
+
+        Returns
+        -------
+        ndarray
+            Matrices of shape (..., planes, 5, 5), for overfocus of shape (...)
+        '''
+        f = self.obj_lens_f_from_overfocus(overfocus)
+        return self.lens_system_matrices({self.obj_lens.name: {'f': f}})
+
     def set_beam_radius_from_semiconv(self, semiconv):
         
         self.semiconv = semiconv
@@ -172,14 +489,19 @@ class Model():
         '''Generate electron rays
         '''        
         #Make our 3D matrix of rays. This matrix is of shape (steps, 5, num rays), where
-        #steps is defined by the number of components.
+        # steps is defined by the number of components, unless only some planes are kept.
         
         self.steps = len(self.z_positions)
+        self.set_kept_planes()
         
-        self.r = np.zeros((self.steps, 5, self.num_rays),
-                          dtype=np.float64)  # x, theta_x, y, theta_y, 1
+        if self.compact_rays:
+            self.r = np.zeros((len(self.r_planes), 4, self.num_rays),
+                              dtype=self.dtype)  # x, theta_x, y, theta_y
+        else:
+            self.r = np.zeros((len(self.r_planes), 5, self.num_rays),
+                              dtype=self.dtype)  # x, theta_x, y, theta_y, 1
         
-        self.r[:, 4, :] = np.ones(self.num_rays)
+            self.r[:, 4, :] = np.ones(self.num_rays)
 
         if self.beam_type == 'paralell':
             self.r, self.spot_indices = circular_beam(self.r, self.beam_radius)
@@ -192,224 +514,2653 @@ class Model():
 
         self.r[:, 1, :] += self.beam_tilt_x
         self.r[:, 3, :] += self.beam_tilt_y
+
+        # Index of the first component that blocks each ray, where the number of
+        # components is the code of rays which reach the detector
+        self.blocked_at = np.full(self.num_rays, len(self.components),
+                                  dtype=blocked_at_dtype(len(self.components)))
+        if self.xp is not np:
+            self.r, self.blocked_at = self.xp.asarray(self.r), self.xp.asarray(self.blocked_at)
+        self.ray_idcs = [None]*self.steps
+        self.first_stale_blocking_plane = 1
+
+        # New rays need to be propagated through the whole column
+        self.beam_parameters = self.get_beam_parameters()
+        self.first_stale_plane = 1
+
+    def get_beam_parameters(self):
+        '''Parameters of the model that are used to generate the rays
+
+        Returns
+        -------
+        tuple
+            Beam parameters
+        '''
+        return (self.num_rays, self.beam_type, self.gun_beam_semi_angle, self.beam_radius,
+                self.beam_tilt_x, self.beam_tilt_y, len(self.z_positions), self.dtype)
     
     #Add the matrices of each component to a list
     def update_component_matrix(self):
         '''Update the list of all component matrices, each matrix of which has 
         been set by the component upon it's creation.
         '''        
+        # Matrices are stored as float64 so that the matrix multiplication with the rays
+        # can go straight to BLAS without a type conversion on every step
         self.components_matrix = []
-        for idx, component in enumerate(self.components):
-            if component.type == 'Double Deflector':
-                self.components_matrix.append(component.up_matrix)
-                self.components_matrix.append(component.low_matrix)
-            else:
-                self.components_matrix.append(component.matrix)
-    
-    #Perform the matrix multiplication of the rays with each component in the model
-    def update_rays_stepwise(self):
-        '''Perform the neccessary matrix multiplications and function multiplications
-        to propagate the beam through the column
-        '''        
-        #Do the matrix multiplication of the first rays with the distance between the initial beam z 
-        #and the first component
-        self.r[1, :, :] = np.matmul(self.propagate(self.z_distances[0]), self.r[0, :, :])
-        
-        idx = 1
-        
-        #For every component, loop through it and perform the matrix multiplication
         for component in self.components:
-            if component.type == 'Biprism':
-                x = abs(self.r[idx, 0, :])
-                y = abs(self.r[idx, 2, :])
-                
-                if component.theta != 0:
-                    x_hit_biprism = np.where(x < component.width)[0]
-                    y_hit_biprism = np.where(y < component.radius)[0]
+            for matrix in component.plane_matrices():
+                self.components_matrix.append(np.asarray(matrix, dtype=np.float64))
 
-                elif component.theta == 0:
-                    x_hit_biprism = np.where(x < component.radius)[0]
-                    y_hit_biprism = np.where(y < component.width)[0]
+        # Whether the x and y axes of the rays are independent, and whether anything kicks
+        # them in y, which get_ray_axes reads on every propagation
+        matrices = np.array(self.components_matrix).reshape(-1, 5, 5)
+        self.separable_axes = not (np.any(matrices[:, 0:2, 2:4]) or np.any(matrices[:, 2:4, 0:2]))
+        self.y_kicks = bool(np.any(matrices[:, 2:4, 4]))
 
-                blocked_idcs = list(set(x_hit_biprism).intersection(y_hit_biprism))
+    def update_propagation_matrices(self):
+        '''Cache the propagation matrix of every gap between two planes of the model. The
+        matrices are only rebuilt when the z layout of the model (z_distances) changes, which
+        is read from the components first (see update_z_positions), and then only for the gaps
+        which have changed.
+        '''
+        self.update_z_positions()
+        z_distances = np.asarray(self.z_distances, dtype=np.float64)
+        old_z_distances = getattr(self, 'propagation_z_distances', None)
 
-                component.blocked_ray_idcs = blocked_idcs
+        if old_z_distances is not None and np.array_equal(old_z_distances, z_distances):
+            return
 
-                self.r[idx, 1, :] = self.r[idx, 1, :] + \
-                    np.sign(self.r[idx, 0, :])*component.matrix[1, 4]
-                self.r[idx, 3, :] = self.r[idx, 3, :] + \
-                    np.sign(self.r[idx, 2, :])*component.matrix[3, 4]
-                self.r[idx+1, :, :] = np.matmul(self.propagate(self.z_distances[idx]), self.r[idx, :, :])
-                idx += 1
+        # Gaps which have not changed keep their matrices. If planes have been inserted or
+        # removed, only the gaps above the first change are the same gaps
+        propagation_matrices = np.empty((len(z_distances), 5, 5), dtype=np.float64)
+        if old_z_distances is None:
+            changed_gaps = np.arange(len(z_distances))
+        elif old_z_distances.shape == z_distances.shape:
+            changed_gaps = np.flatnonzero(old_z_distances != z_distances)
+            propagation_matrices[:] = self.propagation_matrices
+        else:
+            common = min(len(old_z_distances), len(z_distances))
+            changed_common_gaps = np.flatnonzero(old_z_distances[:common] != z_distances[:common])
+            first_changed_gap = next(iter(changed_common_gaps), common)
+            changed_gaps = np.arange(first_changed_gap, len(z_distances))
+            propagation_matrices[:first_changed_gap] = self.propagation_matrices[:first_changed_gap]
 
-            elif component.type == 'Aperture':
-                
-                #Special vectorised function for the aperture
-                xp, yp = self.r[idx, 0, :], self.r[idx, 2, :]
-                xc, yc = component.x, component.y
-                distance = np.sqrt((xp-xc)**2 + (yp-yc)**2)
-
-                blocked_ray_bools = np.logical_and(
-                    distance >= component.aperture_radius_inner, distance < component.aperture_radius_outer)
-                component.blocked_ray_idcs = np.where(blocked_ray_bools)[0]
-
-                self.r[idx+1, :, :] = np.matmul(self.propagate(self.z_distances[idx]), self.r[idx, :, :])
-                idx += 1
-            elif component.type == 'Double Deflector':
-                self.r[idx, :, :] = np.matmul(component.up_matrix, self.r[idx, :, :])
-                self.r[idx+1, :, :] = np.matmul(self.propagate(self.z_distances[idx]), self.r[idx, :, :])
-                idx += 1
-
-                self.r[idx, :, :] = np.matmul(component.low_matrix, self.r[idx, :, :])
-                self.r[idx+1, :, :] = np.matmul(self.propagate(self.z_distances[idx]), self.r[idx, :, :])
-                idx += 1
-            else:
-                #Every other function has a single matrix, so just need to do straightforward matrix multiplication
-                self.r[idx, :, :] = np.matmul(component.matrix, self.r[idx, :, :])
-                self.r[idx+1, :, :] = np.matmul(self.propagate(self.z_distances[idx]), self.r[idx, :, :])
-                idx += 1
+        for gap in changed_gaps:
+            propagation_matrices[gap] = self.propagate(z_distances[gap])
 
-    def update_parameters_from_gui(self):
-        '''Update the GUI
-        '''        
-        #This code updates the GUI sliders if it exists
-        self.num_rays = 2**(self.gui.rayslider.value())
-        self.gun_beam_semi_angle = self.gui.beamangleslider.value()*1e-2
-        self.beam_radius = self.gui.beamwidthslider.value()*self.beam_radius_init
-        
-        self.allowed_ray_idcs = np.arange(self.num_rays)
+        # Rays below the first gap which has changed need to be propagated again
+        if old_z_distances is None or len(changed_gaps) == 0:
+            self.first_stale_plane = 1
+        else:
+            self.first_stale_plane = min(self.first_stale_plane, changed_gaps[0] + 1)
 
-        
-        self.beam_tilt_x = self.gui.xangleslider.value()*np.pi*1e-3
-        self.beam_tilt_y = self.gui.yangleslider.value()*np.pi*1e-3
+        self.propagation_z_distances = z_distances.copy()
+        self.propagation_matrices = propagation_matrices
 
-        if self.gui.checkBoxAxial.isChecked():
-            self.beam_type = 'axial'
-        if self.gui.checkBoxParalell.isChecked():
-            self.beam_type = 'paralell'
-        if self.gui.checkBoxPoint.isChecked():
-            self.beam_type = 'point'
-            
-        if self.experiment == '4DSTEM':
-            self.scan_pixels = 2**(self.experiment_gui.scanpixelsslider.value())
-            self.scanpixelsize = self.sample.width/self.scan_pixels
-            self.cameralength = self.sample.z
-            self.set_experiment_labels()
+    def get_ray_buffer(self, r = None):
+        '''Get a preallocated workspace of shape (2, 5, num rays) (or (2, 4, num rays) for compact
+        rays) that is used to apply component matrices in place, so that stepping does not allocate
+        new arrays. The first half holds the rays arriving at a plane, and the second half the rays
+        leaving planes which are not kept in the ray matrix. Tiles of rays share the workspace of
+        the first tile, and smaller planes share the workspace of larger ones.
 
-        self.set_model_labels()
+        Parameters
+        ----------
+        r : ndarray, optional
+            Rays of one plane (or of a tile of one plane) which the workspace is used for,
+            by default self.r[0]
 
-        #After updating parameters, we need to regenerate rays. 
-        self.generate_rays()
-        
-    def update_scan_coil_ratio(self):
-        
-        sample_size = self.components[self.sample_idx].sample_size
-        scan_position_x = sample_size/(2*self.scan_pixels)+(self.scan_pixel_x/self.scan_pixels)*sample_size - sample_size/2
-        scan_position_y = sample_size/(2*self.scan_pixels)+(self.scan_pixel_y/self.scan_pixels)*sample_size - sample_size/2
-    
-        #Distance to front focal plane from bottom deflector
-        dist_to_ffp = abs(self.scan_coils.z_low-(self.obj_lens.z+abs(self.obj_lens.f)))
-        dist_to_lens = abs(self.scan_coils.z_low-self.obj_lens.z)
-        
-        self.scan_coils.defratiox = -1-1*self.scan_coils.dist/dist_to_ffp
-        self.scan_coils.defratioy = -1-1*self.scan_coils.dist/dist_to_ffp
-        
-        #upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
-        self.scan_coils.updefx = scan_position_x/(self.scan_coils.dist+dist_to_lens*self.scan_coils.defratiox+dist_to_lens)
-        self.scan_coils.lowdefx = self.scan_coils.defratiox*self.scan_coils.updefx
-        
-        self.scan_coils.updefy = scan_position_y/(self.scan_coils.dist+dist_to_lens*self.scan_coils.defratiox+dist_to_lens)
-        self.scan_coils.lowdefy = self.scan_coils.defratioy*self.scan_coils.updefy
-        
-        self.scan_coils.set_matrices()
-        
-        self.descan_coils.defratiox = (-1-1*self.scan_coils.dist/dist_to_ffp)
-        self.descan_coils.defratioy = (-1-1*self.scan_coils.dist/dist_to_ffp)
-        
-        #upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
-        self.descan_coils.updefx = -self.scan_coils.updefx*(self.scan_coils.dist+self.scan_coils.defratiox*dist_to_lens+dist_to_lens)/self.descan_coils.dist
-        self.descan_coils.lowdefx = -self.descan_coils.updefx
-        
-        self.descan_coils.updefy = -self.scan_coils.updefy*(self.scan_coils.dist+self.scan_coils.defratiox*dist_to_lens+dist_to_lens)/self.descan_coils.dist
-        self.descan_coils.lowdefy = -self.descan_coils.updefy
-        
-        self.descan_coils.set_matrices()
-        
-    def update_scan_position(self):
-        
-        self.scan_pixel_x +=1
+        Returns
+        -------
+        ndarray
+            Workspace array with the same ray shape and dtype as r
+        '''
+        r = self.r[0] if r is None else r
 
-        if self.scan_pixel_x == self.scan_pixels:
-            self.scan_pixel_x = 0
-            self.scan_pixel_y += 1
-            if self.scan_pixel_y == self.scan_pixels:
-                self.scan_pixel_y = 0
+        buffer = getattr(self, 'ray_buffer', None)
+        if (buffer is None or buffer.shape[1] != r.shape[0] or buffer.shape[2] < r.shape[1]
+                or buffer.dtype != r.dtype):
+            self.ray_buffer = np.empty((2,) + r.shape, dtype=r.dtype)
 
-    def set_model_labels(self):
-        '''Set labels of the model inside the GUI
-        '''        
-        self.gui.raylabel.setText(
-            str(self.num_rays))
-        self.gui.beamanglelabel.setText(
-            str(round(self.gun_beam_semi_angle, 2)))
-        self.gui.beamwidthlabel.setText(
-            str(round(self.beam_radius, 5)))
+        return self.ray_buffer[:, :, :r.shape[1]]
 
-        self.gui.xanglelabel.setText(
-            str('Beam Tilt X (Radians) = ' + "{:.3f}".format(self.beam_tilt_x))
-        )
-        self.gui.yanglelabel.setText(
-            str('Beam Tilt Y (Radians) = ' + "{:.3f}".format(self.beam_tilt_y))
-        )
-        
-    def set_experiment_labels(self):
-        '''Set labels of the model inside the GUI
-        '''        
-        self.experiment_gui.scanpixelslabel.setText(
-            str(self.scan_pixels))
-        self.experiment_gui.overfocuslabel.setText(
-            str('Overfocus = ' + str(round(self.overfocus, 4))))
-        self.experiment_gui.semiconvlabel.setText(
-            str('Semiconv = ' + str(round(self.semiconv, 4))))
-        self.experiment_gui.scanpixelsizelabel.setText(
-            str('Scan pixel size = ' + str(round(self.scanpixelsize, 4))))
-        self.experiment_gui.cameralengthlabel.setText(
-            str('Camera length = ' + str(round(self.cameralength, 4))))
+    def set_kept_planes(self):
+        '''Find the planes which are kept in the ray matrix from keep_planes, and the planes
+        of components that stop rays which are not kept, but are still needed to find
+        the blocked rays.
+        '''
+        if isinstance(self.keep_planes, str) and self.keep_planes == 'all':
+            r_planes = list(range(self.steps))
+        elif isinstance(self.keep_planes, str) and self.keep_planes == 'endpoints':
+            r_planes = [0, self.steps - 1]
+        else:
+            r_planes = [0, self.steps - 1]
+            for name in self.keep_planes:
+                component_idcs = [idx for idx, component in enumerate(self.components)
+                                  if component.name == name]
+                if len(component_idcs) == 0:
+                    raise ValueError('The model has no component named {}'.format(name))
+                for idx in component_idcs:
+                    first_plane = self.component_plane_idcs[idx]
+                    num_planes = len(self.components[idx].plane_z_positions())
+                    r_planes.extend(range(first_plane, first_plane + num_planes))
+            r_planes = sorted(set(r_planes))
 
-    def step(self):
-        '''Master function that updates the matrices and perfroms ray propagation
+        # Index in self.r of every plane of the column, or -1 if it is not kept
+        self.r_planes = r_planes
+        self.r_plane_idcs = np.full(self.steps, -1)
+        self.r_plane_idcs[r_planes] = np.arange(len(r_planes))
+
+        self.blocking_planes = [
+            idx for idx, (component, _) in enumerate(self.plane_components, start = 1)
+            if component.stops_rays and self.r_plane_idcs[idx] == -1]
+
+        if hasattr(self, 'sample_plane_idx') and self.r_plane_idcs[self.sample_plane_idx] != -1:
+            self.sample_r_idx = self.r_plane_idcs[self.sample_plane_idx]
+        elif hasattr(self, 'sample_r_idx'):
+            del self.sample_r_idx
+
+    def get_plane_arrays(self, r = None, blocking_r = None):
+        '''Get the array of the rays of every plane of the column. Planes which are not kept in
+        the ray matrix are None, apart from planes of components that stop rays, which are kept
+        in a separate workspace so that the blocked rays can be found.
+
+        Parameters
+        ----------
+        r : ndarray, optional
+            Ray matrix of the kept planes, by default self.r
+        blocking_r : ndarray, optional
+            Rays of the planes in self.blocking_planes, by default a workspace of the model
 
         Returns
         -------
-        r : ndarray
-            Returns the array of ray positions
-        '''        
-        #This method performs the computation of updating the matrices to their gui slider 
-        #paramaters, and of moving the rays throgh the model.
-        self.update_component_matrix()
-        self.update_rays_stepwise()
+        list
+            Array of the rays of each plane, or None
+        '''
+        r = self.r if r is None else r
 
-        return self.r
-    
-    #Propagation matrix used by the model to propagate rays between components
-    def propagate(self, z):
-        '''Propagation matrix
+        if blocking_r is None:
+            blocking_r = getattr(self, 'blocking_r', None)
+            shape = (len(self.blocking_planes),) + r.shape[1:]
+            if blocking_r is None or blocking_r.shape != shape or blocking_r.dtype != r.dtype:
+                self.blocking_r = np.ones(shape, dtype=r.dtype)
+                # Planes of the new workspace have not been propagated
+                self.first_stale_plane = 1
+            blocking_r = self.blocking_r
+
+        planes = [None]*self.steps
+        for plane_r, idx in zip(r, self.r_planes):
+            planes[idx] = plane_r
+        for plane_r, idx in zip(blocking_r, self.blocking_planes):
+            planes[idx] = plane_r
+
+        return planes
+
+    def plane_r_idx(self, idx):
+        '''Index in self.r of a plane of the column
 
         Parameters
         ----------
-        z : float
-            Distance to propagate rays
+        idx : int
+            Index of the plane in the column, from the gun (0) to the detector (steps-1)
+
+        Returns
+        -------
+        int
+            Index of the plane in self.r
+        '''
+        r_idx = self.r_plane_idcs[idx]
+        if r_idx == -1:
+            raise ValueError('Plane {} is not kept in the ray matrix (see keep_planes)'.format(idx))
+
+        return int(r_idx)
+
+    def component_r_idx(self, name, plane = 0):
+        '''Index in self.r of the plane of a component
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        plane : int, optional
+            Plane of the component (a double deflector has two), by default 0
+
+        Returns
+        -------
+        int
+            Index of the plane in self.r
+        '''
+        return find_component_r_idx(self.components, self.component_plane_idcs,
+                                    self.r_plane_idcs, name, plane)
+
+    def component_rays(self, name, plane = 0):
+        '''Rays leaving a component
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        plane : int, optional
+            Plane of the component (a double deflector has two), by default 0
 
         Returns
         -------
         ndarray
-            Propagation matrix
-        '''        
+            Rays of the plane of the component in self.r
+        '''
+        return self.r[self.component_r_idx(name, plane)]
 
-        matrix = np.array([[1, z, 0, 0, 0],
-                           [0, 1, 0, 0, 0],
-                           [0, 0, 1, z, 0],
-                           [0, 0, 0, 1, 0],
-                           [0, 0, 0, 0, 1]])
+    def propagate_rays(self, rays, idx, out, axes = (0, 2)):
+        '''Propagate rays across the gap below plane idx. Only the positions change, so this
+        is two multiply-adds per ray instead of a dense matrix multiplication.
 
-        return matrix
+        Parameters
+        ----------
+        rays : ndarray
+            Rays leaving plane idx, of shape (5, num rays) or (4, num rays)
+        idx : int
+            Index of the plane in the ray matrix which the rays leave
+        out : ndarray
+            Array of the same shape as rays, but not the same memory, where the rays
+            arriving at plane idx+1 are written
+        axes : tuple, optional
+            Position rows of the axes to propagate, by default (0, 2)
+        '''
+        z = rays.dtype.type(self.propagation_z_distances[idx])
+
+        # The position rows of the axes are every other row, so all axes are updated at once
+        positions = slice(axes[0], axes[-1] + 1, 2)
+        slopes = slice(axes[0] + 1, axes[-1] + 2, 2)
+        np.copyto(out[slopes], rays[slopes])
+        np.multiply(rays[slopes], z, out=out[positions])
+        out[positions] += rays[positions]
+
+    def get_ray_axes(self, gun_rays = None):
+        '''Find how the x and y axes of the rays can be propagated. If no component couples
+        x and y (see update_component_matrix), and the tiles of rays are large enough that
+        a smaller working set pays for a second pass (separable_axes_min_rays), each axis is
+        propagated on its own over two rows of the ray matrix. If in addition the rays have no
+        y component and nothing in the column deflects them in y (such as the 'x_axial' beam
+        used for matplotlib diagrams), only the x axis is propagated.
+
+        Parameters
+        ----------
+        gun_rays : ndarray, optional
+            Rays at the gun which are propagated, by default self.r[0]
+
+        Returns
+        -------
+        list
+            Groups of position rows which are propagated together in one pass of the column
+        '''
+        gun_rays = self.r[0] if gun_rays is None else gun_rays
+
+        if not self.separable_axes:
+            return [(0, 2)]
+
+        if not self.y_kicks and not np.any(gun_rays[2:4]):
+            return [(0,)]
+
+        if min(gun_rays.shape[1], self.tile_size) < self.separable_axes_min_rays:
+            return [(0, 2)]
+
+        return [(0,), (2,)]
+
+    def get_thread_pool(self):
+        '''Get the thread pool which propagates tiles of rays, which is created again if the
+        number of workers has changed
+
+        Returns
+        -------
+        ThreadPoolExecutor
+            Thread pool with num_workers threads
+        '''
+        pool = getattr(self, 'thread_pool', None)
+        if pool is None or self.thread_pool_workers != self.num_workers:
+            if pool is not None:
+                pool.shutdown()
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.num_workers)
+            self.thread_pool_workers = self.num_workers
+
+        return self.thread_pool
+
+    def propagate_ray_matrix(self, planes, start = 1, stop = None):
+        '''Propagate rays through the column in place, without finding blocked rays.
+        The propagation matrices must be up to date (see update_propagation_matrices). If the
+        model has more than one worker, tiles of rays are propagated in parallel.
+
+        Parameters
+        ----------
+        planes : list or ndarray
+            Array of the rays of every plane of the column, or None for planes which are not
+            kept (see get_plane_arrays). A ray matrix of every plane of shape (steps, 5, num rays)
+            or (steps, 4, num rays) can also be given. The plane above start must be filled
+        start : int, optional
+            Index of the first plane to fill, by default 1
+        stop : int, optional
+            Index of the last plane to fill, by default the detector
+        '''        
+        planes = list(planes)
+        stop = self.steps - 1 if stop is None else stop
+        ray_axes = self.get_ray_axes(planes[0])
+
+        # Rays which are only propagated in x keep zero y positions and slopes
+        if ray_axes == [(0,)]:
+            for plane_r in planes[start:stop+1]:
+                if plane_r is not None:
+                    plane_r[2:4] = 0
+
+        # Every tile goes through all planes of the column before the next tile is started,
+        # so the rays of a tile stay in cache
+        num_rays = planes[start-1].shape[1]
+        if 0 < num_rays <= self.tile_size:
+            tiles = [planes]
+        else:
+            tiles = [[plane_r[:, tile_start:tile_start + self.tile_size]
+                      if plane_r is not None else None for plane_r in planes]
+                     for tile_start in range(0, num_rays, self.tile_size)]
+
+        if self.num_workers > 1 and len(tiles) > 1:
+            # Each tile has its own workspace, so the threads share nothing they write to
+            list(self.get_thread_pool().map(
+                lambda tile: self.propagate_ray_tile(tile, start, ray_axes, stop = stop), tiles))
+        else:
+            buffer = self.get_ray_buffer(tiles[0][start-1]) if num_rays > 0 else None
+            for tile in tiles:
+                tile_buffer = buffer[:, :, :tile[start-1].shape[1]]
+                self.propagate_ray_tile(tile, start, ray_axes, tile_buffer, stop)
+
+    def propagate_ray_tile(self, planes, start, ray_axes, buffer = None, stop = None):
+        '''Propagate the rays of the planes of the column (or of a tile of them) in place
+
+        Parameters
+        ----------
+        planes : list
+            Array of the rays of every plane of the column, or None for planes which are not kept.
+            The plane above start must be filled
+        start : int
+            Index of the first plane to fill
+        ray_axes : list
+            Groups of position rows which are propagated together, from get_ray_axes
+        buffer : ndarray, optional
+            Workspace of shape (2,) + the shape of one plane, by default a new array
+        stop : int, optional
+            Index of the last plane to fill, by default the detector
+        '''
+        # Rays are propagated into a workspace, and each component kernel writes straight from
+        # the workspace into its plane of the ray matrix (or into the second half of the workspace
+        # if the plane is not kept), so no other arrays are allocated here.
+        if buffer is None:
+            buffer = np.empty((2,) + planes[start-1].shape, dtype=planes[start-1].dtype)
+        rays, scratch = buffer
+        stop = self.steps - 1 if stop is None else stop
+        
+        # One pass of the column per group of axes
+        for axes in ray_axes:
+            # Propagate the rays in the plane above the first plane we need to update
+            if start < self.steps - 1:
+                self.propagate_rays(planes[start-1], start-1, rays, axes)
+            elif start == self.steps - 1:
+                self.propagate_rays(planes[start-1], start-1, planes[start], axes)
+
+            # For every plane, let its component transfer the rays and propagate them to the next
+            # plane
+            for idx in range(start, min(stop + 1, self.steps - 1)):
+                component, plane = self.plane_components[idx-1]
+                out = planes[idx] if planes[idx] is not None else scratch
+                component.apply(rays, out, plane, axes)
+
+                if idx == stop:
+                    break
+                elif idx + 1 < self.steps - 1:
+                    self.propagate_rays(out, idx, rays, axes)
+                else:
+                    self.propagate_rays(out, idx, planes[idx+1], axes)
+
+    # Perform the matrix multiplication of the rays with each component in the model
+    def update_rays_stepwise(self, start = 1):
+        '''Perform the neccessary matrix multiplications and function multiplications
+        to propagate the beam through the column
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first plane of the column to propagate again. Planes above it
+            are reused as they are, by default 1, which propagates the whole column
+        '''
+        self.update_propagation_matrices()
+        self.fit_blocked_at()
+
+        if self.xp is not np:
+            # Rays of other array namespaces are traced into new arrays
+            self.propagate_namespace(max(min(start, self.first_stale_plane), 1))
+        else:
+            planes = self.get_plane_arrays()
+
+            # Start from the closest plane above which is kept
+            start = max(min(start, self.first_stale_plane), 1)
+            while planes[start-1] is None:
+                start -= 1
+
+            if self.drop_blocked_rays:
+                self.propagate_alive_rays(planes, start)
+            else:
+                # Planes which only hold the rays that passed the components above them are
+                # propagated again from the gun
+                if self.ray_idcs[start-1] is not None:
+                    start = 1
+                self.ray_idcs[start:] = [None]*(self.steps - start)
+
+                column = self.get_numba_column()
+                if column is not None:
+                    # The kernel finds the blocked rays as it traces them
+                    self.propagate_numba(column, planes, start)
+                else:
+                    self.propagate_ray_matrix(planes, start)
+
+                    # Find which rays are blocked once both axes of every plane are known, unless
+                    # this is deferred until the blocked rays are needed
+                    self.first_stale_blocking_plane = min(self.first_stale_blocking_plane, start)
+                    if not self.defer_blocking:
+                        self.update_blocked_rays(planes)
+
+        # Record what has been propagated, so the next step can start from the first change
+        self.first_stale_plane = self.steps
+        self.traced_r = self.r
+        self.traced_versions = [component.version for component in self.components]
+        self.record_gun_rays()
+
+    def fit_blocked_at(self):
+        '''Allocate the codes of the blocked rays again if the ray matrix has been replaced by one
+        with another number of rays, such as a few rays set by hand
+        '''
+        num_rays = self.r.shape[-1]
+        if self.blocked_at.shape[0] == num_rays:
+            return
+
+        blocked_at = np.full(num_rays, len(self.components),
+                             dtype=blocked_at_dtype(len(self.components)))
+        self.blocked_at = blocked_at if self.xp is np else self.xp.asarray(blocked_at)
+        self.ray_idcs = [None]*self.steps
+        self.first_stale_blocking_plane = 1
+
+    def record_gun_rays(self):
+        '''Keep a copy of the gun rays (self.r[0]) which have been propagated, so that a step
+        finds edits of them in place (see gun_rays_changed)
+        '''
+        gun_r = self.r[0, ...]
+        self.traced_gun_r = gun_r.copy() if self.xp is np else self.xp.asarray(gun_r, copy = True)
+
+    def gun_rays_changed(self):
+        '''Check whether the gun rays (self.r[0]) differ from those which were last propagated,
+        such as after model.r[0, 1, :] += 0.01
+
+        Returns
+        -------
+        bool
+            True if the gun rays have changed since the last step
+        '''
+        traced_gun_r = getattr(self, 'traced_gun_r', None)
+        gun_r = self.r[0, ...]
+        if traced_gun_r is None or traced_gun_r.shape != gun_r.shape:
+            return True
+
+        return not bool(self.xp.all(gun_r == traced_gun_r))
+
+    def propagate_namespace(self, start = 1):
+        '''Propagate rays through the column with the array API kernels of the components, for
+        rays of another array namespace than numpy (see array_namespace). The kept planes below
+        start are traced into new arrays, and the ray matrix is stacked from them, as the array API
+        does not require in place updates of arrays.
+
+        Parameters
+        ----------
+        start : int, optional
+            Index of the first plane to fill, by default 1
+        '''
+        # Planes whose blocked rays have not been found yet are traced again, from the closest
+        # plane above which is kept
+        start = min(start, self.first_stale_blocking_plane)
+        while self.r_plane_idcs[start-1] == -1:
+            start -= 1
+        if start >= self.steps:
+            return
+
+        if start < self.steps - 1:
+            first_component_idx = bisect.bisect_right(self.component_plane_idcs, start) - 1
+        else:
+            first_component_idx = len(self.components)
+
+        planes, self.blocked_at = self.trace_namespace(
+            self.r[self.plane_r_idx(start-1), ...], start, self.blocked_at, first_component_idx)
+        self.r = self.xp.stack([planes[idx] if idx >= start else self.r[r_idx, ...]
+                                for r_idx, idx in enumerate(self.r_planes)])
+        self.first_stale_blocking_plane = self.steps
+
+    def trace_namespace(self, rays, start, blocked_at, first_component_idx, keep_planes = None):
+        '''Trace rays of any array namespace from the plane above start to the detector with the
+        array API kernels of the components, and code the first component that blocks each ray
+
+        Parameters
+        ----------
+        rays : ndarray
+            Rays leaving the plane above start
+        start : int
+            Index of the first plane to trace
+        blocked_at : ndarray
+            Index of the first component which blocks each ray, in the namespace of the rays
+        first_component_idx : int
+            Index of the first component whose codes are found again
+        keep_planes : list, optional
+            Indices of the planes whose rays are returned, by default the kept planes
+            (self.r_planes)
+
+        Returns
+        -------
+        planes : list
+            Rays of every plane of keep_planes, and of the plane above start, or None
+        blocked_at : ndarray
+            New array of the codes of the blocked rays
+        '''
+        xp = get_array_namespace(rays)
+        keep_planes = set(self.r_planes if keep_planes is None else keep_planes)
+        num_components = len(self.components)
+
+        blocked_at = xp.where(blocked_at >= first_component_idx,
+                              xp.full_like(blocked_at, num_components), blocked_at)
+
+        planes = [None]*self.steps
+        planes[start-1] = rays
+        for idx in range(start, self.steps):
+            rays = transfer_matrix(self.propagation_matrices[idx-1], rays)
+
+            if idx < self.steps - 1:
+                component, plane = self.plane_components[idx-1]
+                rays = component.transfer(rays, plane)
+
+                blocked = component.blocked(rays, plane)
+                if blocked is not None:
+                    component_idx = bisect.bisect_right(self.component_plane_idcs, idx) - 1
+                    blocked_at = xp.where(blocked & (blocked_at == num_components),
+                                          xp.full_like(blocked_at, component_idx), blocked_at)
+
+            if idx in keep_planes:
+                planes[idx] = rays
+
+        return planes, blocked_at
+
+    def get_numba_column(self):
+        '''Describe the column for the kernels of the numba backend
+
+        Returns
+        -------
+        NumbaColumn or None
+            Description of the column, or None if the NumPy path is used (see backend)
+        '''
+        if self.backend != 'numba' or self.drop_blocked_rays or self.xp is not np:
+            return None
+
+        return numba_backend.compile_column(self.plane_components, self.component_plane_idcs,
+                                            self.propagation_z_distances, self.dtype)
+
+    def propagate_numba(self, column, planes, start = 1):
+        '''Trace rays through the column in place with the numba backend, and code the first
+        component that blocks each ray
+
+        Parameters
+        ----------
+        column : NumbaColumn
+            Description of the column, from get_numba_column
+        planes : list
+            Arrays of the rays of every plane of the column, from get_plane_arrays. The plane
+            above start must be filled
+        start : int, optional
+            Index of the first plane to fill, by default 1
+        '''
+        # Planes whose blocked rays have not been found yet are traced again
+        start = min(start, self.first_stale_blocking_plane)
+        while planes[start-1] is None:
+            start -= 1
+        if start >= self.steps:
+            return
+
+        # Codes of the blocked rays are found again from the component of the start plane
+        if start < self.steps - 1:
+            first_component_idx = bisect.bisect_right(self.component_plane_idcs, start) - 1
+        else:
+            first_component_idx = len(self.components)
+
+        blocking_plane_idcs = np.full(self.steps, -1)
+        blocking_plane_idcs[self.blocking_planes] = np.arange(len(self.blocking_planes))
+
+        numba_backend.trace_planes(column, self.r, self.r_plane_idcs, self.blocking_r,
+                                   blocking_plane_idcs, start, self.blocked_at, first_component_idx,
+                                   self.num_workers, self.tile_size)
+        self.first_stale_blocking_plane = self.steps
+
+    def propagate_alive_rays(self, planes, start = 1):
+        '''Propagate rays through the column in place, and drop the rays blocked at the plane of
+        every component that stops rays, so that the planes below it are only computed for the rays
+        which are still travelling. These rays are held in the first columns of each plane, and
+        the index of their gun rays is stored in self.ray_idcs.
+
+        Parameters
+        ----------
+        planes : list
+            Arrays of the rays of every plane of the column, from get_plane_arrays. The plane
+            above start must be filled
+        start : int, optional
+            Index of the first plane to fill, by default 1
+        '''
+        if start >= self.steps:
+            return
+
+        # The codes of the rays above start must be up to date before they are dropped. Codes from
+        # start down are found again below, and the planes there have not been propagated yet.
+        if self.first_stale_blocking_plane < start:
+            self.update_blocked_rays(planes)
+
+        num_components = len(self.components)
+        if start < self.steps - 1:
+            first_component_idx = bisect.bisect_right(self.component_plane_idcs, start) - 1
+            self.blocked_at[self.blocked_at >= first_component_idx] = num_components
+
+        source_idx = start - 1
+        idcs = self.ray_idcs[source_idx]
+        source = planes[source_idx] if idcs is None else planes[source_idx][:, :len(idcs)]
+
+        while True:
+            # Rays blocked at the plane the segment starts from are not propagated any further
+            if source_idx > 0 and self.plane_components[source_idx-1][0].stops_rays:
+                component_idx = bisect.bisect_right(self.component_plane_idcs, source_idx) - 1
+                gun_idcs = np.arange(planes[0].shape[-1]) if idcs is None else idcs
+                alive = self.blocked_at[gun_idcs] > component_idx
+                if not np.all(alive):
+                    source = source[:, alive]
+                    idcs = gun_idcs[alive]
+
+            num_rays = planes[0].shape[-1] if idcs is None else len(idcs)
+
+            # Each segment ends at the next plane which stops rays, or at the detector
+            stop = next((idx for idx in range(source_idx + 1, self.steps - 1)
+                         if self.plane_components[idx-1][0].stops_rays), self.steps - 1)
+
+            segment = [planes[0]] + [None]*(self.steps - 1)
+            segment[source_idx] = source
+            for idx in range(source_idx + 1, stop + 1):
+                segment[idx] = planes[idx][:, :num_rays] if planes[idx] is not None else None
+                self.ray_idcs[idx] = idcs
+
+            self.propagate_ray_matrix(segment, source_idx + 1, stop)
+
+            if stop == self.steps - 1:
+                break
+
+            component, plane = self.plane_components[stop-1]
+            component_idx = bisect.bisect_right(self.component_plane_idcs, stop) - 1
+            gun_idcs = np.arange(planes[0].shape[-1]) if idcs is None else idcs
+            self.blocked_at[gun_idcs[component.blocked(segment[stop], plane)]] = component_idx
+
+            source_idx, source = stop, segment[stop]
+
+        self.first_stale_blocking_plane = self.steps
+
+    def get_full_plane(self, idx, fill_value = np.nan):
+        '''Rays of a plane of the column in the order of the gun rays. If blocked rays are dropped
+        (see drop_blocked_rays), rays which did not reach the plane are set to fill_value.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the plane in the column, which must be kept in the ray matrix or stop rays
+        fill_value : float, optional
+            Value of the rays which did not reach the plane, by default np.nan
+
+        Returns
+        -------
+        ndarray
+            Rays of the plane, of shape (5, num rays) or (4, num rays), which must not be
+            modified if every ray reached the plane
+        '''
+        plane_r = self.get_plane_arrays()[idx]
+        if plane_r is None:
+            raise ValueError('Plane {} is not kept in the ray matrix (see keep_planes)'.format(idx))
+
+        idcs = self.ray_idcs[idx]
+        if idcs is None:
+            return plane_r
+
+        full_plane_r = np.full(plane_r.shape, fill_value, dtype=plane_r.dtype)
+        full_plane_r[:, idcs] = plane_r[:, :len(idcs)]
+        if full_plane_r.shape[0] == 5:
+            full_plane_r[4] = 1
+
+        return full_plane_r
+
+    def get_full_r(self, fill_value = np.nan):
+        '''Ray matrix with every kept plane in the order of the gun rays (see get_full_plane)
+
+        Parameters
+        ----------
+        fill_value : float, optional
+            Value of the rays which did not reach a plane, by default np.nan
+
+        Returns
+        -------
+        ndarray
+            Ray matrix of the same shape as self.r, which is self.r if every ray reached every plane
+        '''
+        if all(self.ray_idcs[idx] is None for idx in self.r_planes):
+            return self.r
+
+        return np.stack([self.get_full_plane(idx, fill_value) for idx in self.r_planes])
+
+    def get_allowed_rays(self, idx):
+        '''Rays at a plane of the column of the rays which reach the detector, in the order of
+        the gun rays
+
+        Parameters
+        ----------
+        idx : int
+            Index of the plane in the column, which must be kept in the ray matrix or stop rays
+
+        Returns
+        -------
+        ndarray
+            Rays of shape (5, num allowed rays) or (4, num allowed rays)
+        '''
+        plane_r = self.get_plane_arrays()[idx]
+        if plane_r is None:
+            raise ValueError('Plane {} is not kept in the ray matrix (see keep_planes)'.format(idx))
+
+        allowed_ray_bools = self.allowed_ray_bools()
+        idcs = self.ray_idcs[idx]
+        if idcs is None:
+            return plane_r[:, allowed_ray_bools]
+
+        return plane_r[:, :len(idcs)][:, allowed_ray_bools[idcs]]
+
+    def find_blocked_rays(self, planes, blocked_at, start = 1):
+        '''Code the first component that blocks each ray, from the planes of the components
+        which stop rays. Rays blocked by components above the start plane keep their code.
+
+        Parameters
+        ----------
+        planes : list
+            Arrays of the rays of every plane, from get_plane_arrays
+        blocked_at : ndarray
+            Index of the first component which blocks each ray, which is updated in place
+        start : int, optional
+            Index of the first plane of the column which has changed, by default 1
+        '''
+        if start >= self.steps - 1:
+            return
+
+        # Codes from the component of the start plane onwards are found again
+        first_component_idx = bisect.bisect_right(self.component_plane_idcs, start) - 1
+        stops = [(bisect.bisect_right(self.component_plane_idcs, idx) - 1, idx)
+                 for idx in range(self.component_plane_idcs[first_component_idx], self.steps-1)
+                 if self.plane_components[idx-1][0].stops_rays]
+
+        # Every stop is tested against a tile of rays before the next tile is started, so the
+        # rays of a tile are read from each plane once and the masks stay in cache
+        num_rays = blocked_at.shape[0]
+        tiles = [slice(tile_start, min(tile_start + self.tile_size, num_rays))
+                 for tile_start in range(0, num_rays, self.tile_size)]
+
+        if self.num_workers > 1 and len(tiles) > 1:
+            list(self.get_thread_pool().map(
+                lambda tile: self.find_blocked_tile(
+                    planes, blocked_at, first_component_idx, stops, tile), tiles))
+        else:
+            workspace = self.get_blocking_workspace(
+                min(num_rays, self.tile_size), planes[0].dtype, blocked_at.dtype)
+            for tile in tiles:
+                self.find_blocked_tile(
+                    planes, blocked_at, first_component_idx, stops, tile, workspace)
+
+    def get_blocking_workspace(self, num_rays, dtype, code_dtype):
+        '''Workspace of the blocking kernels of one tile of rays
+
+        Parameters
+        ----------
+        num_rays : int
+            Number of rays in the tile
+        dtype : data-type
+            Floating point type of the rays
+        code_dtype : data-type
+            Integer type of the blocked at codes
+
+        Returns
+        -------
+        tuple
+            Float array of shape (2, num rays), two boolean arrays of shape (num rays) and
+            an array of codes of shape (num rays)
+        '''
+        return (np.empty((2, num_rays), dtype=dtype), np.empty(num_rays, dtype=bool),
+                np.empty(num_rays, dtype=bool), np.empty(num_rays, dtype=code_dtype))
+
+    def find_blocked_tile(self, planes, blocked_at, first_component_idx, stops, tile,
+                          workspace = None):
+        '''Code the first component that blocks each ray of a tile, testing every stop of the
+        column in one pass
+
+        Parameters
+        ----------
+        planes : list
+            Arrays of the rays of every plane, from get_plane_arrays
+        blocked_at : ndarray
+            Index of the first component which blocks each ray, which is updated in place
+        first_component_idx : int
+            Index of the first component whose codes are found again
+        stops : list
+            Index of the component and of the plane of every plane which stops rays, from the
+            first component down
+        tile : slice
+            Rays of the tile
+        workspace : tuple, optional
+            Workspace from get_blocking_workspace, by default a new one
+        '''
+        num_rays = tile.stop - tile.start
+        if workspace is None:
+            workspace = self.get_blocking_workspace(num_rays, planes[0].dtype, blocked_at.dtype)
+        floats, blocked, inside, codes = [array[..., :num_rays] for array in workspace]
+
+        # Stops are tested from the bottom of the column up, so the first stop that blocks
+        # a ray writes its code last
+        codes[:] = len(self.components)
+        for component_idx, idx in reversed(stops):
+            component, plane = self.plane_components[idx-1]
+            component.find_blocked(planes[idx][:, tile], blocked, plane, (floats, inside))
+            np.putmask(codes, blocked, component_idx)
+
+        # Rays blocked above the first component keep their code
+        tile_blocked_at = blocked_at[tile]
+        np.putmask(tile_blocked_at, tile_blocked_at >= first_component_idx, len(self.components))
+        np.minimum(tile_blocked_at, codes, out=tile_blocked_at)
+
+    def update_blocked_rays(self, planes = None):
+        '''Find the blocked rays of the planes which have been propagated since the blocked
+        rays were last found (see defer_blocking)
+
+        Parameters
+        ----------
+        planes : list, optional
+            Arrays of the rays of every plane, by default from get_plane_arrays
+        '''
+        if self.first_stale_blocking_plane < self.steps - 1:
+            planes = self.get_plane_arrays() if planes is None else planes
+            self.find_blocked_rays(planes, self.blocked_at, self.first_stale_blocking_plane)
+
+        self.first_stale_blocking_plane = self.steps
+
+    def get_blocked_at(self):
+        '''Index of the first component that blocks each ray of the last step, or the number of
+        components for rays that reach the detector. Blocked rays which were deferred are found
+        first.
+
+        Returns
+        -------
+        ndarray
+            Array of codes of shape (num rays)
+        '''
+        self.update_blocked_rays()
+
+        return self.blocked_at
+
+    def alive_after(self, component_idx):
+        '''Rays of the last step which pass a component, and every component above it
+
+        Parameters
+        ----------
+        component_idx : int or ndarray
+            Index of the component in the model (-1 for the gun), or an array of indices
+
+        Returns
+        -------
+        ndarray
+            Boolean array of shape (num rays), or (len(component_idx), num rays) for an array of
+            indices, which is True for the rays that are still travelling after the component
+        '''
+        return alive_after(self.get_blocked_at(), component_idx)
+
+    def allowed_ray_bools(self):
+        '''Rays of the last step which are not blocked by any component
+
+        Returns
+        -------
+        ndarray
+            Boolean array which is True for rays which reach the detector
+        '''
+        return self.get_blocked_at() == len(self.components)
+
+    def find_first_stale_plane(self):
+        '''Find the first plane in the ray matrix that needs to be propagated again, from
+        the versions of the components, the gun rays and the planes invalidated since the last
+        step
+
+        Returns
+        -------
+        int
+            Index of the first plane in the ray matrix which is out of date
+        '''
+        versions = [component.update_version() for component in self.components]
+
+        # If the ray matrix has been replaced, or its gun rays edited in place, none of it has
+        # been propagated. The rays can then not be moved along the kicks either
+        if self.r is not getattr(self, 'traced_r', None) or self.gun_rays_changed():
+            self.first_stale_plane = 1
+            return 1
+
+        for component_plane_idx, version, traced_version in zip(
+                self.component_plane_idcs, versions, self.traced_versions):
+            if version != traced_version:
+                return min(component_plane_idx, self.first_stale_plane)
+
+        return self.first_stale_plane
+
+    def update_system_matrices(self):
+        '''Compile the column into a cumulative ray transfer matrix for every plane, so that
+        self.r[idx] = system_matrices[idx] @ self.r[0]. The products are cached, and only
+        recomputed when a component matrix or the z layout of the model changes. If the model has
+        variable lenses (see set_variable_lenses), they are evaluated from the lens power
+        polynomial.
+        '''
+        self.update_propagation_matrices()
+        components_matrix = np.stack(self.components_matrix)
+
+        if getattr(self, 'system_components_matrix', None) is not None and \
+                getattr(self, 'system_z_distances', None) is self.propagation_z_distances and \
+                np.array_equal(self.system_components_matrix, components_matrix):
+            return
+
+        self.system_components_matrix = components_matrix
+        self.system_z_distances = self.propagation_z_distances
+
+        if self.variable_lenses:
+            self.system_matrices = self.update_lens_polynomial().evaluate(self.lens_powers())
+            return
+
+        # Every plane holds the rays after its component has acted, and the detector
+        # has no component, so it only needs the final propagation
+        self.system_matrices = np.empty((self.steps, 5, 5), dtype=np.float64)
+        self.system_matrices[0] = np.eye(5)
+        for idx in range(1, self.steps):
+            transfer = self.propagation_matrices[idx-1] @ self.system_matrices[idx-1]
+            if idx < self.steps - 1:
+                transfer = components_matrix[idx-1] @ transfer
+            self.system_matrices[idx] = transfer
+
+    def set_variable_lenses(self, names = None):
+        '''Choose the lenses whose focal lengths change often, such as the objective lens of a
+        focus slider or an overfocus sweep. The cumulative matrices of the column are then found
+        as a polynomial in the powers of these lenses (see LensPowerPolynomial), whose coefficients
+        are only found again when another component or the z layout changes. update_system_matrices,
+        step_planes, trace_batch and lens_system_matrices then evaluate the matrices of every plane
+        directly from the powers, instead of multiplying the matrices of the column.
+
+        Parameters
+        ----------
+        names : list, optional
+            Names of the lenses, astigmatic lenses or quadrupoles which are variable, by default
+            every one in the model. An empty list turns the polynomial off
+        '''
+        lenses = {component.name: component for component in self.components}
+        if names is None:
+            names = [component.name for component in self.components if component.power_parameters]
+
+        for name in names:
+            if name not in lenses:
+                raise ValueError('The model has no component named {}'.format(name))
+            if not lenses[name].power_parameters:
+                raise ValueError('{} is not a lens'.format(name))
+
+        self.variable_lenses = list(names)
+        self.lens_polynomial = None
+
+    def update_lens_polynomial(self):
+        '''Find the coefficients of the cumulative matrices of the column as a polynomial in the
+        powers of the variable lenses, if any other component or the z layout has changed since
+        they were last found
+
+        Returns
+        -------
+        LensPowerPolynomial
+            Polynomial of the matrices of every plane
+        '''
+        self.update_propagation_matrices()
+
+        variable_planes = [self.component_plane_idcs[idx] - 1
+                           for idx, component in enumerate(self.components)
+                           if component.name in self.variable_lenses]
+        fixed_matrices = np.delete(np.stack(self.components_matrix), variable_planes, axis = 0)
+
+        polynomial = getattr(self, 'lens_polynomial', None)
+        if polynomial is not None and polynomial.variable_planes == variable_planes and \
+                self.lens_polynomial_z_distances is self.propagation_z_distances and \
+                np.array_equal(self.lens_polynomial_fixed_matrices, fixed_matrices):
+            return polynomial
+
+        self.lens_polynomial = LensPowerPolynomial(
+            self.propagation_matrices, np.stack(self.components_matrix),
+            {plane: self.plane_components[plane][0].power_matrices() for plane in variable_planes})
+        self.lens_polynomial_z_distances = self.propagation_z_distances
+        self.lens_polynomial_fixed_matrices = fixed_matrices
+
+        return self.lens_polynomial
+
+    def lens_powers(self, params = {}):
+        '''Powers (one over the focal lengths) of the variable lenses, in order down the column
+
+        Parameters
+        ----------
+        params : dict, optional
+            New focal lengths of some variable lenses, in the format of a parameter set of trace,
+            such as {'Objective Lens': {'f': -0.2}}. Focal lengths can be arrays, which are
+            broadcast together. By default the focal lengths of the model
+
+        Returns
+        -------
+        ndarray
+            Powers of shape (..., total powers)
+        '''
+        lenses = [component for component in self.components
+                  if component.name in self.variable_lenses]
+        for name, parameters in params.items():
+            if name not in self.variable_lenses:
+                raise ValueError('{} is not a variable lens of the model'.format(name))
+            for parameter in parameters:
+                if not any(parameter in lens.power_parameters
+                           for lens in lenses if lens.name == name):
+                    raise ValueError('{} is not a focal length of {}'.format(parameter, name))
+
+        powers = [1 / np.asarray(params.get(lens.name, {}).get(parameter, getattr(lens, parameter)),
+                                 dtype=np.float64)
+                  for lens in lenses for parameter in lens.power_parameters]
+
+        return np.stack(np.broadcast_arrays(*powers), axis = -1)
+
+    def lens_system_matrices(self, params = {}):
+        '''Cumulative transfer matrices of every plane of the column for some focal lengths of the
+        variable lenses (see set_variable_lenses), evaluated from the lens power polynomial without
+        changing the model. A focus series of any length is a single matrix product.
+
+        Parameters
+        ----------
+        params : dict, optional
+            New focal lengths of some variable lenses, such as
+            {'Objective Lens': {'f': np.linspace(-0.3, -0.1, 64)}} (see lens_powers), by default
+            the focal lengths of the model
+
+        Returns
+        -------
+        ndarray
+            Matrices of shape (..., planes, 5, 5), such that
+            r[idx] = matrices[..., idx, :, :] @ r[0]
+        '''
+        if not self.variable_lenses:
+            raise ValueError('The model has no variable lenses (see set_variable_lenses)')
+
+        self.update_component_matrix()
+
+        return self.update_lens_polynomial().evaluate(self.lens_powers(params))
+
+    def update_matrix_tree(self):
+        '''Keep the ordered propagation and component matrices of the column in a segment tree
+        of partial products. Only the leaves of matrices which changed since the last update are
+        replaced, so changing one component costs O(log n) matrix products.
+        '''
+        self.update_propagation_matrices()
+
+        # Leaves alternate between propagation and component matrices, starting and
+        # ending with a propagation to the first component and to the detector
+        num_leaves = 2*len(self.components_matrix) + 1
+        tree = getattr(self, 'matrix_tree', None)
+
+        if tree is None or tree.num_leaves != num_leaves:
+            leaves = np.empty((num_leaves, 5, 5), dtype=np.float64)
+            leaves[0::2] = self.propagation_matrices
+            if len(self.components_matrix) > 0:
+                leaves[1::2] = self.components_matrix
+
+            self.matrix_tree = MatrixProductTree(leaves)
+            self.matrix_tree_z_distances = self.propagation_z_distances
+            return
+
+        if self.matrix_tree_z_distances is not self.propagation_z_distances:
+            for idx, matrix in enumerate(self.propagation_matrices):
+                if not np.array_equal(tree.leaf(2*idx), matrix):
+                    tree.update(2*idx, matrix)
+            self.matrix_tree_z_distances = self.propagation_z_distances
+
+        for idx, matrix in enumerate(self.components_matrix):
+            if not np.array_equal(tree.leaf(2*idx + 1), matrix):
+                tree.update(2*idx + 1, matrix)
+
+    def plane_matrix(self, idx):
+        '''Cumulative ray transfer matrix from the gun to a plane, queried from the matrix tree, or
+        from the system matrices if the model has variable lenses (see set_variable_lenses). Call
+        update_matrix_tree (or update_system_matrices) first if any component has changed.
+
+        Parameters
+        ----------
+        idx : int
+            Index of the plane in the ray matrix
+
+        Returns
+        -------
+        ndarray
+            Matrix such that self.r[idx] = matrix @ self.r[0]
+        '''
+        idx = idx % self.steps
+
+        if self.variable_lenses:
+            return self.system_matrices[idx]
+
+        # The detector has no component, so its product stops after the last propagation
+        if idx == self.steps - 1:
+            return self.matrix_tree.prefix(2*idx - 1)
+        else:
+            return self.matrix_tree.prefix(2*idx)
+
+    def step_planes(self, planes = None, blocking = True):
+        '''Compiled alternative to step. Every component in the column is affine (apart from the
+        biprism), so each plane is reached from the gun with a single matrix multiplication of
+        its cumulative matrix, which is queried from the matrix tree, or evaluated from the lens
+        power polynomial if the model has variable lenses. Only the requested planes of self.r are
+        filled - the others keep whatever values they had before.
+
+        Parameters
+        ----------
+        planes : list, optional
+            Indices of the planes of the column to compute, which must be kept in the ray matrix,
+            by default the sample plane (if the model keeps it) and the detector
+        blocking : bool, optional
+            Also compute the planes of apertures so that their blocked rays are updated,
+            by default True
+
+        Returns
+        -------
+        r : ndarray
+            Returns the array of ray positions
+        '''
+        self.update_component_matrix()
+        self.fit_blocked_at()
+
+        # Some components (such as the biprism) are not affine, so they can't be compiled
+        # into a matrix. Fall back to full ray propagation.
+        if not all(component.affine for component in self.components):
+            self.update_rays_stepwise()
+            return self.r
+
+        if self.variable_lenses:
+            self.update_system_matrices()
+        else:
+            self.update_matrix_tree()
+
+        if planes is None:
+            planes = [self.sample_plane_idx, -1] if hasattr(self, 'sample_r_idx') else [-1]
+
+        plane_arrays = self.get_plane_arrays()
+        for idx in planes:
+            apply_matrix(self.plane_matrix(idx), self.r[0], self.r[self.plane_r_idx(idx)])
+
+        if blocking:
+            for idx, (component, plane) in enumerate(self.plane_components, start = 1):
+                if component.stops_rays:
+                    apply_matrix(self.plane_matrix(idx), self.r[0], plane_arrays[idx])
+            self.find_blocked_rays(plane_arrays, self.blocked_at)
+            self.first_stale_blocking_plane = self.steps
+
+        # The planes which were not requested are now out of date, and the planes which were
+        # hold every ray
+        self.first_stale_plane = 1
+        self.ray_idcs = [None]*self.steps
+
+        return self.r
+
+    def get_kick_state(self):
+        '''Split the planes of the column into the kicks of the deflector channels (every parameter
+        of kick_parameters of every component) and everything else, read from the transfer matrices
+        of the components
+
+        Returns
+        -------
+        kicks : ndarray
+            Kick of every channel, in order down the column
+        free_matrices : ndarray
+            Transfer matrices of the planes of the components, with the kicks of the deflectors at
+            zero
+        '''
+        free_matrices = np.array([matrix for component in self.components
+                                  for matrix in component.plane_matrices()],
+                                 dtype=np.float64).reshape(-1, 5, 5)
+
+        kicks = []
+        for idx, component in enumerate(self.components):
+            if component.kick_parameters:
+                vectors = component.kick_vectors()
+                first_plane = self.component_plane_idcs[idx] - 1
+                planes = slice(first_plane, first_plane + vectors.shape[1])
+
+                # Kick vectors of different channels do not overlap, so each kick is a projection
+                kicks.extend(np.einsum('cpi,pi->c', vectors, free_matrices[planes, :, 4]) /
+                             np.einsum('cpi,cpi->c', vectors, vectors))
+                free_matrices[planes, :, 4][np.any(vectors != 0, axis = 0)] = 0
+
+        return np.array(kicks, dtype=np.float64), free_matrices
+
+    def update_kick_basis(self, free_matrices):
+        '''Find the response of the rays of every plane to a unit kick of every deflector channel,
+        if anything other than the kicks of the deflectors, or the z layout, has changed since it
+        was last found. Every component is affine, so the response is the same for every ray: a
+        change of the kicks moves the rays of each plane by sum(change * response).
+
+        Parameters
+        ----------
+        free_matrices : ndarray
+            Transfer matrices of the planes of the components without their kicks, from
+            get_kick_state
+
+        Returns
+        -------
+        ndarray
+            Response of every plane to every channel, of shape (channels, planes, 5)
+        '''
+        self.update_propagation_matrices()
+
+        if getattr(self, 'kick_basis', None) is not None and \
+                self.kick_basis_z_distances is self.propagation_z_distances and \
+                np.array_equal(self.kick_basis_free_matrices, free_matrices):
+            return self.kick_basis
+
+        # Kick of every channel at every plane of the components
+        plane_kicks = []
+        for idx, component in enumerate(self.components):
+            if component.kick_parameters:
+                vectors = component.kick_vectors()
+                channel_kicks = np.zeros((len(vectors), self.steps - 2, 5), dtype=np.float64)
+                first_plane = self.component_plane_idcs[idx] - 1
+                channel_kicks[:, first_plane:first_plane + vectors.shape[1]] = vectors
+                plane_kicks.append(channel_kicks)
+        if plane_kicks:
+            plane_kicks = np.concatenate(plane_kicks, axis = 0)
+        else:
+            plane_kicks = np.zeros((0, self.steps - 2, 5))
+
+        # Kicks are added after the matrix of their plane, and travel down the column from there
+        self.kick_basis = np.zeros((plane_kicks.shape[0], self.steps, 5), dtype=np.float64)
+        response = np.zeros((plane_kicks.shape[0], 5), dtype=np.float64)
+        for idx in range(1, self.steps):
+            response = response @ self.propagation_matrices[idx-1].T
+            if idx < self.steps - 1:
+                response = response @ free_matrices[idx-1].T + plane_kicks[:, idx-1]
+            self.kick_basis[:, idx] = response
+
+        self.kick_basis_z_distances = self.propagation_z_distances
+        self.kick_basis_free_matrices = free_matrices
+
+        return self.kick_basis
+
+    def only_kicks_changed(self, kicks, free_matrices):
+        '''Check whether the rays of the last step only differ from the column by the kicks of its
+        deflectors, so that they can be moved along their response to the kicks (see
+        update_rays_from_kicks)
+
+        Parameters
+        ----------
+        kicks : ndarray
+            Kicks of the deflector channels, from get_kick_state
+        free_matrices : ndarray
+            Transfer matrices of the planes without their kicks, from get_kick_state
+
+        Returns
+        -------
+        bool
+            True if the rays can be updated from the kicks
+        '''
+        # The rays must have been traced by a step which recorded the kicks, and not been
+        # invalidated or traced by anything else since. Components which are not deflectors may
+        # have changed parameters which are not in their matrix (such as an aperture radius).
+        return self.xp is np and not self.drop_blocked_rays and \
+            getattr(self, 'kick_traced_versions', None) is not None and \
+            self.kick_traced_versions is self.traced_versions and \
+            self.r is self.traced_r and self.first_stale_plane == self.steps and \
+            all(component.kick_parameters or component.version == version
+                for component, version in zip(self.components, self.traced_versions)) and \
+            self.traced_kick_z_distances is self.propagation_z_distances and \
+            len(kicks) == len(self.traced_kicks) and \
+            np.array_equal(self.traced_free_matrices, free_matrices) and \
+            all(component.affine for component in self.components) and \
+            self.get_numba_column() is None
+
+    def update_rays_from_kicks(self, kick_changes, free_matrices):
+        '''Move the rays of every plane of the last step by their response to a change of the kicks
+        of the deflectors, instead of propagating them again, and find the blocked rays of the
+        planes which have moved. Only valid if nothing else has changed since the last step (see
+        only_kicks_changed).
+
+        Parameters
+        ----------
+        kick_changes : ndarray
+            Change of the kick of every deflector channel since the last step
+        free_matrices : ndarray
+            Transfer matrices of the planes without their kicks, from get_kick_state
+        '''
+        response = np.tensordot(kick_changes, self.update_kick_basis(free_matrices), 1)
+
+        moved = np.flatnonzero(np.any(response != 0, axis = 1))
+        start = moved[0] if len(moved) > 0 else self.steps
+
+        # The kept planes and the workspace of the blocking planes are each shifted in one operation
+        planes = self.get_plane_arrays()
+        for r, plane_idcs in [(self.r, self.r_planes), (self.blocking_r, self.blocking_planes)]:
+            plane_idcs = np.asarray(plane_idcs, dtype=int)
+            first = np.searchsorted(plane_idcs, start)
+            if first < len(plane_idcs):
+                r[first:] += response[plane_idcs[first:], :r.shape[1], np.newaxis]
+
+        self.first_stale_blocking_plane = min(self.first_stale_blocking_plane, start)
+        if not self.defer_blocking:
+            self.update_blocked_rays(planes)
+
+        self.first_stale_plane = self.steps
+        self.traced_r = self.r
+        self.traced_versions = [component.version for component in self.components]
+
+    def check_precision(self):
+        '''Propagate the current rays of the model again in double precision, and compare
+        the pixel coordinates of the rays on the detector (and on the sample, if the model
+        has one) with those of the model. This shows whether a single precision model is
+        accurate enough for the resolution of its detector.
+
+        Returns
+        -------
+        dict
+            Maximum deviation in pixels of the ray coordinates from the np.float64
+            reference, for the 'detector' and 'sample' planes
+        '''
+        r = self.step()
+        blocked_at = self.get_blocked_at().copy()
+        ray_idcs = list(self.ray_idcs)
+        drop_blocked_rays = self.drop_blocked_rays
+
+        # Propagate the same gun rays through the column in double precision, keeping
+        # every ray in every plane
+        self.r = r.astype(np.float64)
+        self.drop_blocked_rays = False
+        self.update_rays_stepwise()
+        reference_r = self.r
+
+        # Put back the rays of the model, which are still up to date
+        self.r = r
+        self.traced_r = r
+        self.record_gun_rays()
+        self.blocked_at = blocked_at
+        self.first_stale_blocking_plane = self.steps
+        self.ray_idcs = ray_idcs
+        self.drop_blocked_rays = drop_blocked_rays
+
+        planes = {'detector': (self.steps - 1, self.detector_size, self.detector_pixels)}
+        if hasattr(self, 'sample_r_idx'):
+            sample = self.components[self.sample_idx]
+            planes['sample'] = (self.sample_plane_idx, sample.sample_size, sample.sample_pixels)
+
+        deviations = {}
+        for name, (plane_idx, size, pixels) in planes.items():
+            r_idx = self.plane_r_idx(plane_idx)
+            rays, reference_rays = r[r_idx], reference_r[r_idx]
+
+            # Only compare the rays which reached the plane
+            if ray_idcs[plane_idx] is not None:
+                rays = rays[:, :len(ray_idcs[plane_idx])]
+                reference_rays = reference_rays[:, ray_idcs[plane_idx]]
+
+            coords = np.array(get_pixel_coords(rays[0], rays[2], size, pixels), dtype=np.float64)
+            reference_coords = np.array(get_pixel_coords(
+                reference_rays[0], reference_rays[2], size, pixels))
+            deviations[name] = float(np.abs(coords - reference_coords).max(initial=0))
+
+        return deviations
+
+    def get_gun_rays(self, start, stop):
+        '''Generate the rays [start, stop) of the beam of the model at the gun, without
+        generating the rest of the beam
+
+        Parameters
+        ----------
+        start : int
+            Index of the first ray
+        stop : int
+            Index after the last ray
+
+        Returns
+        -------
+        ndarray
+            Rays of shape (5, stop-start), or (4, stop-start) for compact rays
+        '''
+        rows = 4 if self.compact_rays else 5
+        rays = np.zeros((rows, stop-start), dtype=self.dtype)
+
+        beam_slice(rays, self.beam_type, self.num_rays, start, stop,
+                   self.gun_beam_semi_angle, self.beam_radius)
+        rays[1] += self.beam_tilt_x
+        rays[3] += self.beam_tilt_y
+        if rows == 5:
+            rays[4] = 1
+
+        return rays
+
+    def estimate_ray_memory(self, num_rays = None, num_planes = None):
+        '''Estimate the memory needed to trace a beam through the column: the ray matrix,
+        the propagation workspace and the temporary arrays of the image formation
+
+        Parameters
+        ----------
+        num_rays : int, optional
+            Number of rays in the beam, by default self.num_rays
+        num_planes : int, optional
+            Number of planes which are stored, by default the planes kept by the model and the
+            planes of components that stop rays
+
+        Returns
+        -------
+        int
+            Memory footprint in bytes
+        '''
+        num_rays = self.num_rays if num_rays is None else num_rays
+        if num_planes is None:
+            num_planes = len(self.r_planes) + len(self.blocking_planes)
+        rows = 4 if self.compact_rays else 5
+
+        # The workspace holds two planes, and the pixel coordinates, index arrays and masks
+        # of get_image_from_rays take about 16 values per ray
+        values_per_ray = (num_planes + 2)*rows + 16
+
+        return values_per_ray*self.dtype.itemsize*num_rays
+
+    def get_chunk_size(self, memory_budget, num_planes = None):
+        '''Largest number of rays which can be traced at once within a memory budget
+
+        Parameters
+        ----------
+        memory_budget : int
+            Memory budget in bytes
+        num_planes : int, optional
+            Number of planes which are stored, see estimate_ray_memory
+
+        Returns
+        -------
+        int
+            Number of rays in a chunk, which is at least one
+        '''
+        bytes_per_ray = self.estimate_ray_memory(1, num_planes)
+
+        return int(max(1, min(self.num_rays, memory_budget // bytes_per_ray)))
+
+    def is_rotationally_symmetric(self, components = None):
+        '''Whether every ray of a ring of the beam takes the same path through the column, rotated
+        about the optic axis. The beam must be a ring beam ('paralell' or 'point') without tilt, and
+        every component must commute with rotations about the optic axis (round lenses, apertures
+        centred on the optic axis, samples, or deflectors without a kick), see
+        Component.rotationally_symmetric
+
+        Parameters
+        ----------
+        components : list, optional
+            Components of the column, by default self.components
+
+        Returns
+        -------
+        bool
+        '''
+        components = self.components if components is None else components
+
+        return self.beam_type in ('paralell', 'point') and self.beam_tilt_x == 0 \
+            and self.beam_tilt_y == 0 \
+            and all(component.rotationally_symmetric() for component in components)
+
+    def ring_coords(self, start, stop):
+        '''Ring and angle of the rays [start, stop) of the ring beam of the model. Rays after the
+        last ring are at the gun in the centre of the beam, so they take the path of the first ring
+
+        Parameters
+        ----------
+        start : int
+            Index of the first ray
+        stop : int
+            Index after the last ray
+
+        Returns
+        -------
+        rings : ndarray
+            Index of the ring of each ray
+        t : ndarray
+            Angle of each ray on its ring
+        '''
+        rings, t = ring_beam_coords(ring_beam_points(self.num_rays), start, stop)
+        missing = stop - start - len(rings)
+
+        return np.pad(rings, (0, missing)), np.pad(t, (0, missing))
+
+    def trace_rings(self, planes):
+        '''Trace the first ray of each ring of the beam, at angle zero, through a rotationally
+        symmetric column (see is_rotationally_symmetric). Every other ray of the beam is one of
+        these rays rotated about the optic axis (see rotate_ring_rays), and is blocked by the
+        same component. The propagation matrices must be up to date.
+
+        Parameters
+        ----------
+        planes : list
+            Indices of the planes to return the rays of
+
+        Returns
+        -------
+        ring_r : ndarray
+            Rays of each ring in the planes, of shape (len(planes), 5, num rings) or
+            (len(planes), 4, num rings) for compact rays
+        ring_blocked_at : ndarray
+            Index of the first component which blocks the rays of each ring
+        '''
+        rows = 4 if self.compact_rays else 5
+        num_rings = len(ring_beam_points(self.num_rays))
+
+        # The rings are few, so the rays of every plane are kept
+        ring_r = np.zeros((self.steps, rows, num_rings), dtype=self.dtype)
+        if rows == 5:
+            ring_r[:, 4] = 1
+        ring_beam_rays(ring_r[0], self.beam_type, num_rings, np.arange(num_rings),
+                       np.zeros(num_rings), self.gun_beam_semi_angle, self.beam_radius)
+        self.propagate_ray_matrix(ring_r)
+
+        ring_blocked_at = np.full(num_rings, len(self.components),
+                                  dtype=blocked_at_dtype(len(self.components)))
+        self.find_blocked_rays(ring_r, ring_blocked_at)
+
+        return ring_r[planes], ring_blocked_at
+
+    def trace_chunked(self, memory_budget = 2**30, num_rays = None):
+        '''Trace the beam of the model through the column in chunks of rays that fit in a memory
+        budget, and merge the detector images of the chunks. The memory used does not depend on
+        the number of rays, so beams which are far too large for self.r can be traced. The rays
+        of the model (self.r) and the blocked rays of the components are not changed. If the column
+        is rotationally symmetric (see is_rotationally_symmetric), only one ray of each ring of
+        the beam is traced, and the rays of each chunk are rotated from them.
+
+        Parameters
+        ----------
+        memory_budget : int, optional
+            Memory budget in bytes for the rays of one chunk, by default 2**30
+        num_rays : int, optional
+            Number of rays in the beam, by default self.num_rays. The beam is generated
+            in the same way as the beam of the model
+
+        Returns
+        -------
+        detector_ray_image : ndarray
+            Ray image of where rays have hit the detector
+        detector_sample_image : ndarray
+            Sample image obtained by transferring ray which have hit the detector
+        blocked_ray_counts : ndarray
+            Number of rays blocked by each component of the model. Rays are counted by the first
+            component that blocks them
+        '''
+        model_num_rays = self.num_rays
+        if num_rays is not None:
+            self.num_rays = num_rays
+
+        try:
+            self.update_component_matrix()
+            self.update_propagation_matrices()
+
+            rows = 4 if self.compact_rays else 5
+
+            # Image the sample if there is one, otherwise only the rays on the detector
+            if hasattr(self, 'sample_plane_idx'):
+                sample = self.components[self.sample_idx]
+                sample_plane_idx, sample_size, sample_pixels, sample_image = \
+                    self.sample_plane_idx, sample.sample_size, sample.sample_pixels, sample.sample
+            else:
+                sample_plane_idx, sample_size, sample_pixels, sample_image = \
+                    0, 1, 1, np.zeros((10, 10))
+
+            # Only the gun, sample, detector and the planes of components that stop rays are stored,
+            # the numba kernel only needs the gun rays, and rays rotated from the rings of a
+            # symmetric column only need the sample and detector
+            symmetric = self.xp is np and self.is_rotationally_symmetric()
+            column = None if symmetric else self.get_numba_column()
+            ring_kernel = symmetric and self.backend == 'numba' and numba_backend.NUMBA_AVAILABLE
+            if symmetric:
+                num_points_kth_ring = ring_beam_points(self.num_rays)
+                ring_r, ring_blocked_at = self.trace_rings([sample_plane_idx, self.steps - 1])
+
+            if column is not None or ring_kernel:
+                chunk_planes = [0]
+            elif symmetric:
+                chunk_planes = [sample_plane_idx, self.steps - 1]
+            else:
+                chunk_planes = sorted(set([0, sample_plane_idx, self.steps - 1] + [
+                    idx for idx, (component, _) in enumerate(self.plane_components, start = 1)
+                    if component.stops_rays]))
+            chunk_size = self.get_chunk_size(memory_budget, len(chunk_planes))
+
+            detector_ray_image = np.zeros(
+                (self.detector_pixels, self.detector_pixels), dtype=np.uint8)
+            detector_sample_image = np.zeros((self.detector_pixels, self.detector_pixels))
+            blocked_ray_counts = np.zeros(len(self.components), dtype=np.int64)
+            blocked_at = np.full(chunk_size, len(self.components),
+                                 dtype=blocked_at_dtype(len(self.components)))
+
+            chunk_r = np.empty((len(chunk_planes), rows, chunk_size), dtype=self.dtype)
+            if rows == 5:
+                chunk_r[:, 4] = 1
+
+            for start in range(0, self.num_rays, chunk_size):
+                stop = min(start + chunk_size, self.num_rays)
+                chunk_blocked_at = blocked_at[:stop-start]
+
+                if ring_kernel:
+                    hits, sample_values, through_sample = numba_backend.trace_ring_image(
+                        ring_r[0], ring_r[1], ring_blocked_at, len(self.components),
+                        num_points_kth_ring, start, stop, self.detector_size, self.detector_pixels,
+                        sample_size, sample_pixels, sample_image, chunk_blocked_at,
+                        self.num_workers)
+                elif column is not None:
+                    chunk_r[0, :, :stop-start] = self.get_gun_rays(start, stop)
+                    hits, sample_values, through_sample = numba_backend.trace_image(
+                        column, chunk_r[0, :, :stop-start], sample_plane_idx, self.detector_size,
+                        self.detector_pixels, sample_size, sample_pixels, sample_image,
+                        chunk_blocked_at, self.num_workers, self.tile_size)
+
+                if column is not None or ring_kernel:
+                    blocked_ray_counts += np.bincount(
+                        chunk_blocked_at, minlength=len(self.components) + 1)[:-1]
+
+                    detector_sample_image[through_sample] = sample_values[through_sample]
+                    np.maximum(detector_ray_image, hits > 0, out=detector_ray_image)
+                    continue
+
+                if symmetric:
+                    r = [None]*self.steps
+                    for plane_r, idx in zip(chunk_r, chunk_planes):
+                        r[idx] = plane_r[:, :stop-start]
+
+                    rings, t = self.ring_coords(start, stop)
+                    # Images only need the positions of the rays
+                    rotate_ring_rays(ring_r, rings, t, chunk_r[:, :, :stop-start], slopes = False)
+                    np.take(ring_blocked_at, rings, out=chunk_blocked_at)
+                elif self.xp is not np:
+                    r, chunk_blocked_at = self.trace_namespace(
+                        self.xp.asarray(self.get_gun_rays(start, stop)), 1,
+                        self.xp.asarray(chunk_blocked_at), 0, [sample_plane_idx, self.steps - 1])
+                else:
+                    r = [None]*self.steps
+                    for plane_r, idx in zip(chunk_r, chunk_planes):
+                        r[idx] = plane_r[:, :stop-start]
+
+                    r[0][:] = self.get_gun_rays(start, stop)
+                    self.propagate_ray_matrix(r)
+
+                    self.find_blocked_rays(r, chunk_blocked_at)
+                blocked_ray_counts += np.bincount(
+                    to_numpy(chunk_blocked_at), minlength=len(self.components) + 1)[:-1]
+                allowed_ray_bools = chunk_blocked_at == len(self.components)
+
+                # Rays are masked on their own, as the array API only has boolean indexing by one
+                # mask
+                chunk_ray_image, chunk_sample_image, sample_pixel_coords, detector_pixel_coords = \
+                    get_image_from_rays(
+                        r[-1][0, ...][allowed_ray_bools], r[-1][2, ...][allowed_ray_bools],
+                        r[sample_plane_idx][0, ...][allowed_ray_bools],
+                        r[sample_plane_idx][2, ...][allowed_ray_bools], self.detector_size,
+                        self.detector_pixels, sample_size, sample_pixels, sample_image)
+
+                # Later rays overwrite the sample image where they hit the detector through the
+                # sample, as they do in a single image, and every pixel hit by a ray which missed
+                # the sample is set to zero once all chunks are done
+                on_sample = (sample_pixel_coords > 0) & (sample_pixel_coords < sample_pixels)
+                on_detector = (detector_pixel_coords > 0) & \
+                    (detector_pixel_coords < self.detector_pixels)
+                through_sample = np.all(on_sample, axis=1) & np.all(on_detector, axis=1)
+                pixels_y = detector_pixel_coords[through_sample, 1]
+                pixels_x = detector_pixel_coords[through_sample, 0]
+                detector_sample_image[pixels_y, pixels_x] = chunk_sample_image[pixels_y, pixels_x]
+
+                np.maximum(detector_ray_image, chunk_ray_image, out=detector_ray_image)
+
+            detector_sample_image[detector_ray_image > 0] = 0
+        finally:
+            self.num_rays = model_num_rays
+
+        return detector_ray_image, detector_sample_image, blocked_ray_counts
+
+    def trace(self, rays = None, params = None):
+        '''Trace rays through the column without changing the model or its components, so
+        that one model can be traced from many threads at once. Components with changed
+        parameters are copied, and the rays are propagated in workspaces of this call.
+
+        Parameters
+        ----------
+        rays : ndarray, optional
+            Rays at the gun, of shape (5, num rays) or (4, num rays), by default the gun
+            rays of the model (self.r[0])
+        params : dict, optional
+            Parameters to change for this trace, by component name, such as
+            {'Objective Lens': {'f': -0.2}, 'Scan Coils': {'updefx': 0.01}}, by default None
+
+        Returns
+        -------
+        TraceResult
+            Rays in every plane of the column that the model keeps, and the first component that
+            blocks each ray
+        '''
+        params = {} if params is None else params
+
+        names = [component.name for component in self.components]
+        for name in params:
+            if name not in names:
+                raise ValueError('The model has no component named {}'.format(name))
+
+        components = [component.with_parameters(params[component.name]) if component.name in params
+                      else component for component in self.components]
+
+        # A shallow copy of the model holds the column of this call, so the caches and
+        # workspaces it builds are not shared with the model. The thread pool is shared.
+        if self.num_workers > 1:
+            self.get_thread_pool()
+        column = copy.copy(self)
+        column.ray_buffer = None
+        column.components = components
+        column.z_positions, column.plane_components, column.component_plane_idcs = \
+            self.get_plane_layout(components)
+        column.steps = len(column.z_positions)
+        column.z_distances = np.diff(column.z_positions)
+        column.update_component_matrix()
+        column.update_propagation_matrices()
+
+        # Only the planes kept by the model are returned
+        rays = self.r[0] if rays is None else rays
+        r = np.ones((len(self.r_planes),) + rays.shape, dtype=self.dtype)
+        r[0] = rays
+        planes = column.get_plane_arrays(
+            r, np.ones((len(self.blocking_planes),) + rays.shape, dtype=self.dtype))
+        column.propagate_ray_matrix(planes)
+
+        blocked_at = np.full(
+            rays.shape[1], len(components), dtype=blocked_at_dtype(len(components)))
+        column.find_blocked_rays(planes, blocked_at)
+
+        return TraceResult(r, blocked_at, components, column.z_positions,
+                           column.component_plane_idcs, self.r_plane_idcs)
+
+    def trace_batch(self, params, rays = None, images = False):
+        '''Trace the same rays through K configurations of the column at once, such as a sweep of
+        focal lengths or deflections, without changing the model or its components. The cumulative
+        transfer matrices of every plane are built for all configurations, and the rays of every
+        kept plane are found with one batched einsum, of shape (K, planes, 5, num rays). If only
+        focal lengths of variable lenses change (see set_variable_lenses), the transfer matrices are
+        evaluated from the lens power polynomial. Columns with a component which is not affine
+        (a biprism) are traced one configuration at a time.
+
+        Parameters
+        ----------
+        params : list
+            K sets of parameters to change, each in the format of trace, such as
+            [{'Objective Lens': {'f': f}} for f in np.linspace(-0.3, -0.1, 64)]. Parameters
+            can not move the planes of the column
+        rays : ndarray, optional
+            Rays at the gun, of shape (5, num rays) or (4, num rays), by default the gun
+            rays of the model (self.r[0])
+        images : bool, optional
+            Also form the detector image of each configuration (see get_image_from_rays), by
+            default False
+
+        Returns
+        -------
+        BatchTraceResult
+            Rays in every plane of the column that the model keeps, of shape
+            (K, planes, 5, num rays), and the first component that blocks each ray of each
+            configuration
+        '''
+        names = [component.name for component in self.components]
+        for parameters in params:
+            for name in parameters:
+                if name not in names:
+                    raise ValueError('The model has no component named {}'.format(name))
+
+        batch_components = [[component.with_parameters(parameters[component.name])
+                             if component.name in parameters else component
+                             for component in self.components] for parameters in params]
+        for components in batch_components:
+            if self.get_plane_layout(components)[0] != self.z_positions:
+                raise ValueError('Parameters of a batch can not move the planes of the column')
+
+        rays = to_numpy(self.r[0, ...]) if rays is None else np.asarray(rays, dtype=self.dtype)
+        num_components = len(self.components)
+        self.update_propagation_matrices()
+
+        # Focal lengths of variable lenses are evaluated from the lens power polynomial
+        lens_params = all(
+            name in self.variable_lenses
+            and set(parameters) <= set(self.components[names.index(name)].power_parameters)
+            for parameters in params for name, parameters in parameters.items())
+
+        if all(component.affine for components in batch_components for component in components):
+            # Cumulative transfer matrix of every plane of every configuration
+            if self.variable_lenses and lens_params:
+                self.update_component_matrix()
+                system_matrices = self.update_lens_polynomial().evaluate(
+                    np.stack([self.lens_powers(parameters) for parameters in params]))
+            else:
+                plane_matrices = np.array([[np.asarray(matrix, dtype=np.float64)
+                                            for component in components
+                                            for matrix in component.plane_matrices()]
+                                           for components in batch_components])
+                system_matrices = np.empty((len(params), self.steps, 5, 5))
+                system_matrices[:, 0] = np.eye(5)
+                for idx in range(1, self.steps):
+                    system_matrices[:, idx] = \
+                        self.propagation_matrices[idx-1] @ system_matrices[:, idx-1]
+                    if idx < self.steps - 1:
+                        system_matrices[:, idx] = plane_matrices[:, idx-1] @ system_matrices[:, idx]
+
+            def trace_planes(plane_idcs):
+                matrices = system_matrices[:, plane_idcs].astype(self.dtype)
+                if rays.shape[0] == 5:
+                    return np.einsum('kpij,jn->kpin', matrices, rays, optimize=True)
+
+                return (np.einsum('kpij,jn->kpin', matrices[..., :4, :4], rays, optimize=True)
+                        + matrices[..., :4, 4:5])
+
+            r = trace_planes(self.r_planes)
+            blocking_r = trace_planes(self.blocking_planes)
+
+            # Stops are tested from the bottom of the column up, so each ray keeps the code of
+            # the first component which blocks it
+            blocked_at = np.full((len(params), rays.shape[1]), num_components,
+                                 dtype=blocked_at_dtype(num_components))
+            floats, blocked, inside, _ = self.get_blocking_workspace(
+                rays.shape[1], self.dtype, blocked_at.dtype)
+            stop_planes = [(idx, plane) for idx, (component, plane)
+                           in enumerate(self.plane_components, start = 1) if component.stops_rays]
+            for idx, plane in reversed(stop_planes):
+                component_idx = bisect.bisect_right(self.component_plane_idcs, idx) - 1
+                for k, components in enumerate(batch_components):
+                    if self.r_plane_idcs[idx] != -1:
+                        plane_rays = r[k, self.r_plane_idcs[idx]]
+                    else:
+                        plane_rays = blocking_r[k, self.blocking_planes.index(idx)]
+                    components[component_idx].find_blocked(
+                        plane_rays, blocked, plane, (floats, inside))
+                    np.putmask(blocked_at[k], blocked, component_idx)
+
+            sample_planes = None
+            if images and hasattr(self, 'sample_plane_idx'):
+                sample_planes = trace_planes([self.sample_plane_idx])
+        else:
+            results = [self.trace(rays, parameters) for parameters in params]
+            r = np.stack([result.r for result in results])
+            blocked_at = np.stack([result.blocked_at for result in results])
+            sample_planes = None
+            if images and hasattr(self, 'sample_plane_idx'):
+                sample_r_idx = self.plane_r_idx(self.sample_plane_idx)
+                sample_planes = np.stack([result.r[sample_r_idx] for result in results])[:, None]
+
+        detector_ray_images, detector_sample_images = None, None
+        if images:
+            if sample_planes is not None:
+                sample = self.components[self.sample_idx]
+                sample_size, sample_pixels, sample_image = \
+                    sample.sample_size, sample.sample_pixels, sample.sample
+            else:
+                sample_planes = np.broadcast_to(rays, (len(params), 1) + rays.shape)
+                sample_size, sample_pixels, sample_image = 1, 1, np.zeros((10, 10))
+
+            image_shape = (len(params), self.detector_pixels, self.detector_pixels)
+            detector_ray_images = np.zeros(image_shape, dtype=np.uint8)
+            detector_sample_images = np.zeros(image_shape)
+            for k in range(len(params)):
+                allowed_ray_bools = blocked_at[k] == num_components
+                detector_ray_images[k], detector_sample_images[k], _, _ = get_image_from_rays(
+                    r[k, -1, 0, allowed_ray_bools], r[k, -1, 2, allowed_ray_bools],
+                    sample_planes[k, 0, 0, allowed_ray_bools],
+                    sample_planes[k, 0, 2, allowed_ray_bools], self.detector_size,
+                    self.detector_pixels, sample_size, sample_pixels, sample_image)
+
+        return BatchTraceResult(r, blocked_at, batch_components, self.z_positions,
+                                self.component_plane_idcs, self.r_plane_idcs, detector_ray_images,
+                                detector_sample_images)
+
+    def propagate_moments(self):
+        '''Propagate the second moment matrix of the beam (see beam_moments) through the column,
+        instead of the rays. The column is affine, so the moments of every plane are exactly
+        M @ moments @ M.T for the cumulative transfer matrix M of the plane, and the centroid, RMS
+        size, divergence and emittance of the beam are found without tracing any rays, whatever
+        the number of rays. Apertures are not applied, so the moments are those of the whole beam.
+
+        Returns
+        -------
+        BeamMoments
+            Moments of the beam at every plane of the column
+        '''
+        if not all(component.affine for component in self.components):
+            raise ValueError('Beam moments can only be propagated through affine components')
+
+        self.update_component_matrix()
+        self.update_system_matrices()
+
+        gun_moments = beam_moments(self.beam_type, self.gun_beam_semi_angle, self.beam_radius,
+                                   self.beam_tilt_x, self.beam_tilt_y)
+
+        moments = self.system_matrices @ gun_moments @ self.system_matrices.transpose(0, 2, 1)
+        return BeamMoments(moments, self.z_positions)
+
+    def backward_gun_rays(self):
+        '''Gun ray of the centre of every detector pixel, for a parallel or point beam. The column
+        is affine, so the detector positions are an invertible affine map of the free coordinates
+        of the gun rays: the positions of a parallel beam, or the slopes of a point beam. The
+        cumulative matrix of the detector is inverted to find the ray of every pixel.
+
+        Returns
+        -------
+        gun_rays : ndarray
+            Rays at the gun of shape (5, detector pixels**2), in the order of the pixels of a
+            detector image (rows of y, then x)
+        inside_beam : ndarray
+            Boolean array which is True for the rays which are inside the beam of the model
+        '''
+        if not all(component.affine for component in self.components):
+            raise ValueError('Only columns of affine components can be traced backwards')
+        if self.beam_type not in ['paralell', 'point']:
+            raise ValueError('Only paralell and point beams can be traced backwards')
+
+        self.update_component_matrix()
+        self.update_system_matrices()
+
+        # Rays of a parallel beam start from any position with the slopes of the tilt, and rays of
+        # a point beam start from the origin with any slope
+        if self.beam_type == 'paralell':
+            free_rows, beam_radius = [0, 2], self.beam_radius
+        else:
+            free_rows, beam_radius = [1, 3], np.tan(self.gun_beam_semi_angle)
+        base_ray = np.array([0, self.beam_tilt_x, 0, self.beam_tilt_y, 1], dtype=np.float64)
+
+        detector_matrix = self.system_matrices[-1]
+        free_matrix = detector_matrix[np.ix_([0, 2], free_rows)]
+        tolerance = np.finfo(np.float64).eps*np.max(np.abs(free_matrix))**2
+        if abs(np.linalg.det(free_matrix)) <= tolerance:
+            raise ValueError(
+                'The detector is at an image of the gun, so it can not be traced backwards')
+
+        # Detector position of the centre of every pixel (the inverse of get_pixel_coords, with
+        # the y axis flipped)
+        pixels = self.detector_pixels
+        centres = (np.arange(pixels) + 1 - pixels/2)*self.detector_size/pixels
+        detector_x, detector_y = np.meshgrid(centres, -centres)
+        detector_positions = np.stack([detector_x.ravel(), detector_y.ravel()])
+
+        base_positions = (detector_matrix[[0, 2]] @ base_ray)[:, None]
+        free = np.linalg.solve(free_matrix, detector_positions - base_positions)
+        gun_rays = np.repeat(base_ray[:, None], free.shape[1], axis = 1)
+        gun_rays[free_rows] += free
+
+        return gun_rays, np.hypot(free[0], free[1]) <= beam_radius
+
+    def trace_backward(self):
+        '''Form the detector image of a parallel or point beam by tracing backwards, with one ray
+        for the centre of every detector pixel (see backward_gun_rays), instead of tracing a beam of
+        many rays forwards. The ray of every pixel is mapped to the sample plane by its cumulative
+        matrix to look up the sample once, and to the planes of the stops to check that it is not
+        blocked. Pixels are lit if their ray is inside the beam and reaches the detector, so the
+        image has no holes and no pixels overwritten by several rays. The pixels of the images are
+        the same as get_image_from_rays.
+
+        Returns
+        -------
+        detector_ray_image : ndarray
+            Image of the pixels which are lit by rays that do not hit the sample
+        detector_sample_image : ndarray
+            Sample image, with the intensity of the sample at the ray of every lit pixel
+        '''
+        gun_rays, lit = self.backward_gun_rays()
+
+        for idx, (component, plane) in enumerate(self.plane_components, start = 1):
+            if component.stops_rays:
+                lit &= ~component.blocked(self.system_matrices[idx] @ gun_rays, plane)
+
+        # Pixels on the first row and column of the detector are outside it in get_image_from_rays
+        pixels = self.detector_pixels
+        pixel_x, pixel_y = np.meshgrid(np.arange(pixels), np.arange(pixels))
+        lit &= (pixel_x.ravel() > 0) & (pixel_y.ravel() > 0)
+
+        detector_ray_image = np.zeros((pixels, pixels), dtype=np.uint8)
+        detector_sample_image = np.zeros((pixels, pixels))
+
+        hits_sample = np.zeros(lit.shape, dtype=bool)
+        if hasattr(self, 'sample_plane_idx'):
+            sample = self.components[self.sample_idx]
+            sample_rays = self.system_matrices[self.sample_plane_idx] @ gun_rays
+            sample_pixel_coords = np.round(np.stack(get_pixel_coords(
+                sample_rays[0], sample_rays[2], sample.sample_size, sample.sample_pixels,
+                flip_y=True))).astype(np.int32)
+            on_sample = (sample_pixel_coords > 0) & (sample_pixel_coords < sample.sample_pixels)
+            hits_sample = lit & np.all(on_sample, axis = 0)
+
+            detector_sample_image.ravel()[hits_sample] = sample.sample[
+                sample_pixel_coords[1, hits_sample], sample_pixel_coords[0, hits_sample]]
+
+        detector_ray_image.ravel()[lit & ~hits_sample] = 1
+
+        return detector_ray_image, detector_sample_image
+
+    def jacobian(self, parameters = None, planes = None):
+        '''Derivatives of the rays of some planes with respect to parameters of the components,
+        such as the focal length of a lens, the kicks of a deflector, a scan rotation or the
+        deflection of a biprism, in one pass of the gun rays down the column (forward mode). The
+        derivatives are exact instead of finite differences. Each parameter adds a derivative at
+        the planes of its component (see Component.parameter_tangents), which is linear in the
+        rays, so it is carried to the requested planes by the cumulative matrix between them. The
+        kick of a biprism only depends on the side of the wire of each ray, so its matrix, whose
+        last column does not act on derivatives, carries them as well. Derivatives are found for
+        every ray, including rays which are blocked (see allowed_ray_bools).
+
+        Parameters
+        ----------
+        parameters : list, optional
+            (component name, parameter) of each parameter, such as [('Objective Lens', 'f')],
+            by default every parameter in differentiable_parameters of every component
+        planes : list, optional
+            Indices of the planes of the column, by default the detector
+
+        Returns
+        -------
+        ndarray
+            Derivatives of the rays of shape (planes, parameters, 5, num rays), or 4 rows with
+            compact rays. Row 4 is zero
+        '''
+        names = [component.name for component in self.components]
+        if parameters is None:
+            parameters = [(component.name, parameter) for component in self.components
+                          for parameter in component.differentiable_parameters]
+        for name, parameter in parameters:
+            if name not in names:
+                raise ValueError('The model has no component named {}'.format(name))
+            if parameter not in self.components[names.index(name)].differentiable_parameters:
+                raise ValueError(
+                    '{} can not be differentiated with respect to {}'.format(name, parameter))
+
+        plane_idcs = [idx % self.steps for idx in ([-1] if planes is None else planes)]
+
+        self.update_component_matrix()
+        self.update_propagation_matrices()
+
+        # Matrix from each plane to each requested plane, built up from the requested plane
+        transfers = np.zeros((len(plane_idcs), self.steps, 5, 5), dtype=np.float64)
+        for target_idx, target in enumerate(plane_idcs):
+            transfers[target_idx, target] = np.eye(5)
+            for idx in range(target, 0, -1):
+                step_matrix = self.propagation_matrices[idx-1]
+                if idx < self.steps - 1:
+                    step_matrix = self.components_matrix[idx-1] @ step_matrix
+                transfers[target_idx, idx-1] = transfers[target_idx, idx] @ step_matrix
+
+        gun_rays = to_numpy(self.r[0, ...])
+        rays = np.ones((5, gun_rays.shape[1]), dtype=np.float64)
+        rays[:gun_rays.shape[0]] = gun_rays
+        rays_in = np.ones_like(rays)
+
+        jacobian = np.zeros((len(plane_idcs), len(parameters), gun_rays.shape[0], rays.shape[1]),
+                            dtype=np.float64)
+
+        # Rays only need to be traced down to the last plane of a parameter above a requested plane
+        parameter_planes = [idx for idx, (component, _)
+                            in enumerate(self.plane_components, start = 1)
+                            if any(name == component.name for name, _ in parameters)]
+        last_target = max(plane_idcs, default = 0)
+        last_plane = max([idx for idx in parameter_planes if idx <= last_target], default = 0)
+
+        for idx in range(1, last_plane + 1):
+            self.propagate_rays(rays, idx-1, rays_in)
+            component, plane = self.plane_components[idx-1]
+
+            for parameter_idx, (name, parameter) in enumerate(parameters):
+                if name == component.name:
+                    tangents = component.parameter_tangents(parameter, rays_in, plane)
+                    for target_idx, target in enumerate(plane_idcs):
+                        if target >= idx:
+                            jacobian[target_idx, parameter_idx] += \
+                                (transfers[target_idx, idx] @ tangents)[:gun_rays.shape[0]]
+
+            component.apply(rays_in, rays, plane)
+
+        return jacobian
+
+    def ray_at(self, z):
+        '''Rays of the last step at any z position of the column, such as a crossover or a screen
+        without a component. Rays are propagated from the closest plane above each z which is kept,
+        through the component kernels of any planes in between that are not kept. Blocked rays are
+        included (unless they are dropped, see drop_blocked_rays, in which case they are NaN below
+        the component that blocks them), and z above the gun or below the detector is extrapolated
+        from the gun or detector.
+
+        Parameters
+        ----------
+        z : float or ndarray
+            Z position, or array of z positions. At the z of a component, the rays leaving the
+            component are returned
+
+        Returns
+        -------
+        ndarray
+            Rays of shape (5, num rays) (or (4, num rays) for compact rays), or of shape
+            (len(z), 5, num rays) for an array of z positions
+        '''
+        z_values = np.atleast_1d(np.asarray(z, dtype=np.float64))
+        z_positions = np.asarray(self.z_positions, dtype=np.float64)
+
+        self.update_propagation_matrices()
+        planes = self.get_plane_arrays()
+
+        # z decreases down the column, so the plane above a z is the last plane at or above it
+        planes_above = np.count_nonzero(z_positions[None, :] >= z_values[:, None], axis=1)
+        plane_idcs = np.clip(planes_above - 1, 0, self.steps - 1)
+
+        out = np.empty((len(z_values),) + self.r.shape[1:], dtype=self.r.dtype)
+        for idx in np.unique(plane_idcs):
+            rays = self.get_plane_rays(idx, planes)
+
+            selected = plane_idcs == idx
+            distances = (z_values[selected] - z_positions[idx]).astype(self.r.dtype)
+
+            out[selected] = rays
+            out[selected, 0] += distances[:, None]*rays[1]
+            out[selected, 2] += distances[:, None]*rays[3]
+
+            # Rays which are dropped by the component of the plane do not reach the z below it
+            blocked = self.rays_dropped_at_plane(idx)
+            if blocked is not None:
+                for out_idx in np.flatnonzero(selected)[distances < 0]:
+                    out[out_idx, :4, blocked] = np.nan
+
+        return out if np.ndim(z) > 0 else out[0]
+
+    def get_plane_rays(self, idx, planes = None):
+        '''Rays leaving a plane of the column, which are propagated from the closest kept plane
+        above it if the plane itself is not kept
+
+        Parameters
+        ----------
+        idx : int
+            Index of the plane in the column
+        planes : list, optional
+            Arrays of the rays of every plane, from get_plane_arrays
+
+        Returns
+        -------
+        ndarray
+            Rays of the plane, which must not be modified if the plane is kept
+        '''
+        planes = self.get_plane_arrays() if planes is None else planes
+
+        first_idx = idx
+        while planes[first_idx] is None:
+            first_idx -= 1
+
+        if self.ray_idcs[first_idx] is None:
+            rays = planes[first_idx]
+        else:
+            rays = self.get_full_plane(first_idx)
+        if first_idx < idx:
+            rays = rays.copy()
+            blocked = self.rays_dropped_at_plane(first_idx)
+            if blocked is not None:
+                rays[:4, blocked] = np.nan
+            buffer = np.empty_like(rays)
+            for plane_idx in range(first_idx + 1, idx + 1):
+                self.propagate_rays(rays, plane_idx - 1, buffer)
+                component, plane = self.plane_components[plane_idx - 1]
+                component.apply(buffer, rays, plane)
+
+        return rays
+
+    def rays_dropped_at_plane(self, idx):
+        '''Rays which are blocked by the component of a plane of the column, and are dropped from
+        the planes below it (see drop_blocked_rays)
+
+        Parameters
+        ----------
+        idx : int
+            Index of the plane in the column
+
+        Returns
+        -------
+        ndarray or None
+            Boolean array which is True for the rays dropped at the plane, or None if no rays
+            are dropped there
+        '''
+        if not self.drop_blocked_rays or idx == 0 or idx == self.steps - 1:
+            return None
+
+        component, _ = self.plane_components[idx - 1]
+        if not component.stops_rays:
+            return None
+
+        component_idx = bisect.bisect_right(self.component_plane_idcs, idx) - 1
+        return self.get_blocked_at() == component_idx
+
+    def update_parameters_from_gui(self):
+        '''Update the GUI
+        '''        
+        #This code updates the GUI sliders if it exists
+        self.num_rays = 2**(self.gui.rayslider.value())
+        self.gun_beam_semi_angle = self.gui.beamangleslider.value()*1e-2
+        self.beam_radius = self.gui.beamwidthslider.value()*self.beam_radius_init
+        
+        self.allowed_ray_idcs = np.arange(self.num_rays)
+
+        
+        self.beam_tilt_x = self.gui.xangleslider.value()*np.pi*1e-3
+        self.beam_tilt_y = self.gui.yangleslider.value()*np.pi*1e-3
+
+        if self.gui.checkBoxAxial.isChecked():
+            self.beam_type = 'axial'
+        if self.gui.checkBoxParalell.isChecked():
+            self.beam_type = 'paralell'
+        if self.gui.checkBoxPoint.isChecked():
+            self.beam_type = 'point'
+            
+        if self.experiment == '4DSTEM':
+            self.scan_pixels = 2**(self.experiment_gui.scanpixelsslider.value())
+            self.scanpixelsize = self.sample.width/self.scan_pixels
+            self.cameralength = self.sample.z
+            self.set_experiment_labels()
+
+        self.set_model_labels()
+
+        # After updating parameters, we need to regenerate rays if the beam has changed.
+        if self.get_beam_parameters() != self.beam_parameters:
+            self.generate_rays()
+        
+    def update_scan_coil_ratio(self):
+        
+        sample_size = self.components[self.sample_idx].sample_size
+        scan_position_x = sample_size/(2*self.scan_pixels)+(self.scan_pixel_x/self.scan_pixels)*sample_size - sample_size/2
+        scan_position_y = sample_size/(2*self.scan_pixels)+(self.scan_pixel_y/self.scan_pixels)*sample_size - sample_size/2
+    
+        #Distance to front focal plane from bottom deflector
+        dist_to_ffp = abs(self.scan_coils.z_low-(self.obj_lens.z+abs(self.obj_lens.f)))
+        dist_to_lens = abs(self.scan_coils.z_low-self.obj_lens.z)
+        
+        self.scan_coils.defratiox = -1-1*self.scan_coils.dist/dist_to_ffp
+        self.scan_coils.defratioy = -1-1*self.scan_coils.dist/dist_to_ffp
+        
+        #upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
+        self.scan_coils.updefx = scan_position_x/(self.scan_coils.dist+dist_to_lens*self.scan_coils.defratiox+dist_to_lens)
+        self.scan_coils.lowdefx = self.scan_coils.defratiox*self.scan_coils.updefx
+        
+        self.scan_coils.updefy = scan_position_y/(self.scan_coils.dist+dist_to_lens*self.scan_coils.defratiox+dist_to_lens)
+        self.scan_coils.lowdefy = self.scan_coils.defratioy*self.scan_coils.updefy
+        
+        self.scan_coils.set_matrices()
+        
+        self.descan_coils.defratiox = (-1-1*self.scan_coils.dist/dist_to_ffp)
+        self.descan_coils.defratioy = (-1-1*self.scan_coils.dist/dist_to_ffp)
+        
+        #upper_deflection = x_specimen/(scan_coil_distance + distance_to_lens*deflector_ratio+distance_to_lens)
+        self.descan_coils.updefx = -self.scan_coils.updefx*(self.scan_coils.dist+self.scan_coils.defratiox*dist_to_lens+dist_to_lens)/self.descan_coils.dist
+        self.descan_coils.lowdefx = -self.descan_coils.updefx
+        
+        self.descan_coils.updefy = -self.scan_coils.updefy*(self.scan_coils.dist+self.scan_coils.defratiox*dist_to_lens+dist_to_lens)/self.descan_coils.dist
+        self.descan_coils.lowdefy = -self.descan_coils.updefy
+        
+        self.descan_coils.set_matrices()
+        
+    def update_scan_position(self):
+        
+        self.scan_pixel_x +=1
+
+        if self.scan_pixel_x == self.scan_pixels:
+            self.scan_pixel_x = 0
+            self.scan_pixel_y += 1
+            if self.scan_pixel_y == self.scan_pixels:
+                self.scan_pixel_y = 0
+
+    def set_model_labels(self):
+        '''Set labels of the model inside the GUI
+        '''        
+        self.gui.raylabel.setText(
+            str(self.num_rays))
+        self.gui.beamanglelabel.setText(
+            str(round(self.gun_beam_semi_angle, 2)))
+        self.gui.beamwidthlabel.setText(
+            str(round(self.beam_radius, 5)))
+
+        self.gui.xanglelabel.setText(
+            str('Beam Tilt X (Radians) = ' + "{:.3f}".format(self.beam_tilt_x))
+        )
+        self.gui.yanglelabel.setText(
+            str('Beam Tilt Y (Radians) = ' + "{:.3f}".format(self.beam_tilt_y))
+        )
+        
+    def set_experiment_labels(self):
+        '''Set labels of the model inside the GUI
+        '''        
+        self.experiment_gui.scanpixelslabel.setText(
+            str(self.scan_pixels))
+        self.experiment_gui.overfocuslabel.setText(
+            str('Overfocus = ' + str(round(self.overfocus, 4))))
+        self.experiment_gui.semiconvlabel.setText(
+            str('Semiconv = ' + str(round(self.semiconv, 4))))
+        self.experiment_gui.scanpixelsizelabel.setText(
+            str('Scan pixel size = ' + str(round(self.scanpixelsize, 4))))
+        self.experiment_gui.cameralengthlabel.setText(
+            str('Camera length = ' + str(round(self.cameralength, 4))))
+
+    def step(self):
+        '''Master function that updates the matrices and perfroms ray propagation
+
+        Returns
+        -------
+        r : ndarray
+            Returns the array of ray positions
+        '''        
+        #This method performs the computation of updating the matrices to their gui slider 
+        #paramaters, and of moving the rays throgh the model.
+        # Only the planes below the first component that has changed since the last step
+        # are propagated again.
+        self.update_component_matrix()
+        self.update_propagation_matrices()
+        start = self.find_first_stale_plane()
+
+        # Nothing has changed since the last step, so the rays and the kicks they were traced
+        # with are still those of the column
+        if start == self.steps:
+            return self.r
+
+        # If only kicks of deflectors have changed (a deflector slider, a wobbler or the scan
+        # coils), the rays are moved along their response to the kicks instead
+        kicks, free_matrices = self.get_kick_state()
+        if self.only_kicks_changed(kicks, free_matrices):
+            self.update_rays_from_kicks(kicks - self.traced_kicks, free_matrices)
+        else:
+            self.update_rays_stepwise(start)
+
+        self.traced_kicks, self.traced_free_matrices = kicks, free_matrices
+        self.traced_kick_z_distances = self.propagation_z_distances
+        self.kick_traced_versions = self.traced_versions
+
+        return self.r
+    
+    #Propagation matrix used by the model to propagate rays between components
+    def propagate(self, z):
+        '''Propagation matrix
+
+        Parameters
+        ----------
+        z : float
+            Distance to propagate rays
+
+        Returns
+        -------
+        ndarray
+            Propagation matrix
+        '''        
+
+        matrix = np.array([[1, z, 0, 0, 0],
+                           [0, 1, 0, 0, 0],
+                           [0, 0, 1, z, 0],
+                           [0, 0, 0, 1, 0],
+                           [0, 0, 0, 0, 1]])
+
+        return matrix
+
+
+def find_component_r_idx(components, component_plane_idcs, r_plane_idcs, name, plane = 0):
+    '''Find the index in a ray matrix of the plane of a component
+
+    Parameters
+    ----------
+    components : list
+        Components of the column
+    component_plane_idcs : list
+        Index of the first plane of every component in the column
+    r_plane_idcs : ndarray
+        Index in the ray matrix of every plane of the column, or -1 if it is not kept
+    name : str
+        Name of the component
+    plane : int, optional
+        Plane of the component (a double deflector has two), by default 0
+
+    Returns
+    -------
+    int
+        Index of the plane in the ray matrix
+    '''
+    for component, first_plane in zip(components, component_plane_idcs):
+        if component.name == name:
+            r_idx = r_plane_idcs[first_plane + plane]
+            if r_idx == -1:
+                raise ValueError('The planes of {} are not kept in the ray matrix '
+                                 '(see keep_planes)'.format(name))
+            return int(r_idx)
+
+    raise ValueError('The model has no component named {}'.format(name))
+
+
+class TraceResult():
+    '''Rays traced through a column by Model.trace
+    '''
+    def __init__(self, r, blocked_at, components, z_positions, component_plane_idcs, r_plane_idcs):
+        '''
+
+        Parameters
+        ----------
+        r : ndarray
+            Rays in every kept plane of the column, of shape (planes, 5, num rays) or
+            (planes, 4, num rays)
+        blocked_at : ndarray
+            Index of the first component which blocks each ray, or the number of components for
+            rays which reach the detector
+        components : list
+            Components of the column, with the parameters they were traced with
+        z_positions : list
+            Z position of every plane
+        component_plane_idcs : list
+            Index of the first plane of every component in the column
+        r_plane_idcs : ndarray
+            Index in r of every plane of the column, or -1 if it is not kept
+        '''
+        self.r = r
+        self.blocked_at = blocked_at
+        self.components = components
+        self.z_positions = z_positions
+        self.component_plane_idcs = component_plane_idcs
+        self.r_plane_idcs = r_plane_idcs
+
+    def component_rays(self, name, plane = 0):
+        '''Rays leaving a component
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        plane : int, optional
+            Plane of the component (a double deflector has two), by default 0
+
+        Returns
+        -------
+        ndarray
+            Rays of the plane of the component
+        '''
+        return self.r[find_component_r_idx(
+            self.components, self.component_plane_idcs, self.r_plane_idcs, name, plane)]
+
+    def allowed_ray_bools(self):
+        '''Rays which are not blocked by any component
+
+        Returns
+        -------
+        ndarray
+            Boolean array which is True for rays which reach the detector
+        '''
+        return self.blocked_at == len(self.components)
+
+    def alive_after(self, component_idx):
+        '''Rays which pass a component, and every component above it
+
+        Parameters
+        ----------
+        component_idx : int or ndarray
+            Index of the component in the column (-1 for the gun), or an array of indices
+
+        Returns
+        -------
+        ndarray
+            Boolean array of shape (num rays), or (len(component_idx), num rays) for an array of
+            indices, which is True for the rays that are still travelling after the component
+        '''
+        return alive_after(self.blocked_at, component_idx)
+
+
+class BatchTraceResult(TraceResult):
+    '''Rays traced through K configurations of a column by Model.trace_batch
+    '''
+    def __init__(self, r, blocked_at, batch_components, z_positions, component_plane_idcs,
+                 r_plane_idcs, detector_ray_images = None, detector_sample_images = None):
+        '''
+
+        Parameters
+        ----------
+        r : ndarray
+            Rays in every kept plane of every configuration, of shape (K, planes, 5, num rays) or
+            (K, planes, 4, num rays)
+        blocked_at : ndarray
+            Index of the first component which blocks each ray of each configuration, of shape
+            (K, num rays), or the number of components for rays which reach the detector
+        batch_components : list
+            Components of each configuration, with the parameters they were traced with
+        z_positions : list
+            Z position of every plane
+        component_plane_idcs : list
+            Index of the first plane of every component in the column
+        r_plane_idcs : ndarray
+            Index in r of every plane of the column, or -1 if it is not kept
+        detector_ray_images : ndarray, optional
+            Ray image of the detector of each configuration, of shape (K, pixels, pixels),
+            by default None
+        detector_sample_images : ndarray, optional
+            Sample image of the detector of each configuration, of shape (K, pixels, pixels),
+            by default None
+        '''
+        super().__init__(r, blocked_at, batch_components[0] if len(batch_components) > 0 else [],
+                         z_positions, component_plane_idcs, r_plane_idcs)
+        self.batch_components = batch_components
+        self.detector_ray_images = detector_ray_images
+        self.detector_sample_images = detector_sample_images
+
+    def component_rays(self, name, plane = 0):
+        '''Rays leaving a component in every configuration
+
+        Parameters
+        ----------
+        name : str
+            Name of the component
+        plane : int, optional
+            Plane of the component (a double deflector has two), by default 0
+
+        Returns
+        -------
+        ndarray
+            Rays of the plane of the component, of shape (K, 5, num rays) or (K, 4, num rays)
+        '''
+        return self.r[:, find_component_r_idx(
+            self.components, self.component_plane_idcs, self.r_plane_idcs, name, plane)]
+
+    def detector_rays(self):
+        '''Rays at the detector of every configuration
+
+        Returns
+        -------
+        ndarray
+            Rays of shape (K, 5, num rays) or (K, 4, num rays)
+        '''
+        return self.r[:, -1]
+
+
+class BeamMoments():
+    '''Second moments of a beam at every plane of a column, from Model.propagate_moments
+    '''
+    def __init__(self, moments, z_positions):
+        '''
+
+        Parameters
+        ----------
+        moments : ndarray
+            Second moment matrix E[r r^T] of the rays r = (x, tx, y, ty, 1) at every plane, of
+            shape (steps, 5, 5)
+        z_positions : list
+            Z position of every plane
+        '''
+        self.moments = moments
+        self.z_positions = z_positions
+
+    def covariance(self):
+        '''Covariance of the positions and slopes of the rays at every plane
+
+        Returns
+        -------
+        ndarray
+            Covariance matrix of (x, tx, y, ty), of shape (steps, 4, 4)
+        '''
+        mean = self.moments[:, :4, 4]
+
+        return self.moments[:, :4, :4] - mean[:, :, None]*mean[:, None, :]
+
+    def centroid(self):
+        '''Mean position of the rays at every plane
+
+        Returns
+        -------
+        ndarray
+            x and y of the centroid, of shape (steps, 2)
+        '''
+        return self.moments[:, [0, 2], 4]
+
+    def rms_size(self):
+        '''RMS size of the beam about its centroid at every plane
+
+        Returns
+        -------
+        ndarray
+            RMS size in x and y, of shape (steps, 2)
+        '''
+        covariance = self.covariance()
+
+        return np.sqrt(np.maximum(covariance[:, [0, 2], [0, 2]], 0))
+
+    def divergence(self):
+        '''RMS spread of the slopes of the rays about their mean at every plane
+
+        Returns
+        -------
+        ndarray
+            RMS divergence in x and y, of shape (steps, 2)
+        '''
+        covariance = self.covariance()
+
+        return np.sqrt(np.maximum(covariance[:, [1, 3], [1, 3]], 0))
+
+    def emittance(self):
+        '''RMS emittance of each axis, the square root of the determinant of the covariance of
+        the position and slope of the axis. It is the same at every plane of a column without
+        coupling between x and y.
+
+        Returns
+        -------
+        ndarray
+            RMS emittance in x and y, of shape (steps, 2)
+        '''
+        covariance = self.covariance()
+
+        return np.stack([np.sqrt(np.maximum(np.linalg.det(covariance[:, row:row+2, row:row+2]), 0))
+                         for row in [0, 2]], axis=1)
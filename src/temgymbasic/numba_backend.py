@@ -0,0 +1,526 @@
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+'''Optional numba backend of the model (Model(backend='numba')). Instead of propagating whole planes
+of rays one component at a time with NumPy, a compiled kernel carries a small tile of rays through
+every component of the column, testing the stops as it goes, and either writes the planes of the
+model or adds the rays straight to the detector image. Tiles are split between threads with prange,
+and every thread fills its own detector histogram, which are summed at the end. The model falls
+back to NumPy if numba is not installed, or if the column has a component that the kernel does not
+know (see Component.numba_kernel and Component.numba_stop).'''
+
+NUMBA_AVAILABLE = numba is not None
+
+# Kernels of the planes of a column
+KERNEL_MATRIX = 0
+KERNEL_BIPRISM = 1
+
+# Stops of the planes of a column
+STOP_NONE = 0
+STOP_APERTURE = 1
+STOP_RECTANGLE = 2
+
+
+class NumbaColumn():
+    '''Description of a column for the numba kernels, made of arrays of the kernel, matrix and stop
+    of every plane between the gun and the detector
+    '''
+    def __init__(self, kernels, matrices, stops, stop_parameters, stop_component_idcs, z_distances,
+                 num_components):
+        '''
+
+        Parameters
+        ----------
+        kernels : ndarray
+            Kernel of each plane, KERNEL_MATRIX or KERNEL_BIPRISM
+        matrices : ndarray
+            Ray transfer matrix of each plane, of shape (planes, 5, 5)
+        stops : ndarray
+            Stop of each plane, STOP_NONE, STOP_APERTURE or STOP_RECTANGLE
+        stop_parameters : ndarray
+            Parameters of the stop of each plane, of shape (planes, 4): the centre, inner and outer
+            radius of an aperture, or the half widths in x and y of a rectangle
+        stop_component_idcs : ndarray
+            Index of the component of each plane in the column
+        z_distances : ndarray
+            Distance from every plane to the next, from the gun to the detector
+        num_components : int
+            Number of components in the column, which is the code of rays that are not blocked
+        '''
+        self.kernels = kernels
+        self.matrices = matrices
+        self.stops = stops
+        self.stop_parameters = stop_parameters
+        self.stop_component_idcs = stop_component_idcs
+        self.z_distances = z_distances
+        self.num_components = num_components
+
+
+def compile_column(plane_components, component_plane_idcs, z_distances, dtype):
+    '''Describe a column for the numba kernels
+
+    Parameters
+    ----------
+    plane_components : list
+        Component and plane number of the component of every plane between the gun and the detector
+    component_plane_idcs : list
+        Index of the first plane of every component
+    z_distances : ndarray
+        Distance from every plane to the next, from the gun to the detector
+    dtype : data-type
+        Floating point type of the rays
+
+    Returns
+    -------
+    NumbaColumn or None
+        Description of the column, or None if numba is not installed or a component of the column
+        can't be traced by the kernels
+    '''
+    if not NUMBA_AVAILABLE:
+        return None
+
+    num_planes = len(plane_components)
+    kernels = np.zeros(num_planes, dtype=np.int64)
+    matrices = np.zeros((num_planes, 5, 5), dtype=dtype)
+    stops = np.zeros(num_planes, dtype=np.int64)
+    stop_parameters = np.zeros((num_planes, 4), dtype=dtype)
+    stop_component_idcs = np.zeros(num_planes, dtype=np.int64)
+
+    for idx, (component, plane) in enumerate(plane_components):
+        matrices[idx] = component.plane_matrices()[plane]
+        stop_component_idcs[idx] = np.searchsorted(component_plane_idcs, idx + 1, side='right') - 1
+
+        # Each component says which kernel and stop trace its planes
+        kernel = component.numba_kernel(plane)
+        stop = component.numba_stop(plane)
+        if kernel is None or stop is None:
+            return None
+
+        kernels[idx] = kernel
+        stops[idx], parameters = stop
+        if parameters is not None:
+            stop_parameters[idx] = parameters
+
+    return NumbaColumn(kernels, matrices, stops, stop_parameters, stop_component_idcs,
+                       np.asarray(z_distances, dtype=dtype), len(component_plane_idcs))
+
+
+@contextmanager
+def kernel_threads(num_workers):
+    '''Set the number of threads of the prange loops of the kernels while they run, and restore the
+    previous number afterwards, as numba's thread count is shared by everything else in the thread
+
+    Parameters
+    ----------
+    num_workers : int
+        Number of threads, which is limited to the threads numba has started
+
+    Yields
+    ------
+    int
+        Number of threads the kernels run on
+    '''
+    previous = numba.get_num_threads()
+    numba.set_num_threads(max(1, min(num_workers, numba.config.NUMBA_NUM_THREADS)))
+    try:
+        yield numba.get_num_threads()
+    finally:
+        numba.set_num_threads(previous)
+
+
+def trace_planes(column, r, r_plane_idcs, blocking_r, blocking_plane_idcs, start, blocked_at,
+                 first_component_idx, num_workers = 1, tile_size = 2**12):
+    '''Trace rays from the plane above start to the detector, writing every plane that is kept, and
+    code the first component that blocks each ray (see Model.find_blocked_rays)
+
+    Parameters
+    ----------
+    column : NumbaColumn
+        Description of the column, from compile_column
+    r : ndarray
+        Ray matrix of the kept planes, of shape (planes, 5, num rays) or (planes, 4, num rays)
+    r_plane_idcs : ndarray
+        Index in r of every plane of the column, or -1 if it is not kept
+    blocking_r : ndarray
+        Rays of the planes of components that stop rays which are not kept
+    blocking_plane_idcs : ndarray
+        Index in blocking_r of every plane of the column, or -1
+    start : int
+        Index of the first plane to fill. The plane above it must be filled
+    blocked_at : ndarray
+        Index of the first component which blocks each ray, which is updated in place
+    first_component_idx : int
+        Index of the first component whose codes are found again
+    num_workers : int, optional
+        Number of threads, by default 1
+    tile_size : int, optional
+        Number of rays which are traced together through every plane, by default 2**12
+    '''
+    with kernel_threads(num_workers):
+        _trace_planes(r, np.asarray(r_plane_idcs, dtype=np.int64), blocking_r,
+                      np.asarray(blocking_plane_idcs, dtype=np.int64), start,
+                      column.kernels, column.matrices, column.stops, column.stop_parameters,
+                      column.stop_component_idcs, column.z_distances, blocked_at,
+                      first_component_idx, column.num_components, tile_size)
+
+
+def trace_image(column, gun_rays, sample_plane_idx, detector_size, detector_pixels,
+                sample_size, sample_pixels, sample_image, blocked_at, num_workers = 1,
+                tile_size = 2**12):
+    '''Trace rays from the gun to the detector, and add each ray which is not blocked to the
+    detector image, as get_image_from_rays does with flip_y, without storing any plane
+
+    Parameters
+    ----------
+    column : NumbaColumn
+        Description of the column, from compile_column
+    gun_rays : ndarray
+        Rays at the gun, of shape (5, num rays) or (4, num rays)
+    sample_plane_idx : int
+        Index of the plane of the sample in the column, or 0 to take the sample coordinates at the
+        gun
+    detector_size : float
+        Edge length of the detector
+    detector_pixels : int
+        Pixel resolution of the detector
+    sample_size : float
+        Edge length of the sample
+    sample_pixels : int
+        Pixel resolution of the sample
+    sample_image : ndarray
+        Image intensities of the sample
+    blocked_at : ndarray
+        Array of shape (num rays) where the index of the first component which blocks each ray is
+        written
+    num_workers : int, optional
+        Number of threads, by default 1
+    tile_size : int, optional
+        Number of rays which are traced together through every plane, by default 2**12
+
+    Returns
+    -------
+    hits : ndarray
+        Number of rays which hit each pixel of the detector, but not the sample
+    sample_values : ndarray
+        Sample intensity of the last ray through the sample which hit each pixel of the detector
+    through_sample : ndarray
+        Boolean image which is True for the pixels of the detector hit by a ray through the sample
+    '''
+    with kernel_threads(num_workers) as num_threads:
+        dtype = gun_rays.dtype.type
+        detector_parameters = np.array(
+            [detector_size, detector_pixels, dtype(detector_pixels)/2, 1], dtype=dtype)
+        sample_parameters = np.array(
+            [sample_size, sample_pixels, dtype(sample_pixels)/2, 1], dtype=dtype)
+
+        # Every thread fills its own histograms, so no pixel is written by two threads at once
+        image_shape = (num_threads, detector_pixels, detector_pixels)
+        hits = np.zeros(image_shape, dtype=np.uint32)
+        last_sample_rays = np.full(image_shape, -1, dtype=np.int64)
+        last_sample_values = np.zeros(image_shape, dtype=np.float64)
+
+        _trace_image(gun_rays, column.kernels, column.matrices, column.stops,
+                     column.stop_parameters, column.stop_component_idcs, column.z_distances,
+                     column.num_components, sample_plane_idx, detector_parameters,
+                     sample_parameters, np.asarray(sample_image, dtype=np.float64), blocked_at,
+                     hits, last_sample_rays, last_sample_values, tile_size)
+
+    # Later rays overwrite the sample intensity of earlier rays, as they do in get_image_from_rays
+    last_thread = np.argmax(last_sample_rays, axis=0)
+    sample_values = np.take_along_axis(last_sample_values, last_thread[None], axis=0)[0]
+    through_sample = np.take_along_axis(last_sample_rays, last_thread[None], axis=0)[0] >= 0
+
+    return hits.sum(axis=0), sample_values, through_sample
+
+
+def trace_ring_image(sample_ring_r, detector_ring_r, ring_blocked_at, num_components,
+                     num_points_kth_ring, start, stop, detector_size, detector_pixels, sample_size,
+                     sample_pixels, sample_image, blocked_at, num_workers = 1):
+    '''Add the rays [start, stop) of a ring beam in a rotationally symmetric column to the detector
+    image, rotating each ray from the ray of its ring at angle zero (see Model.trace_rings and
+    rotate_ring_rays) at the sample and the detector, as trace_image does for traced rays
+
+    Parameters
+    ----------
+    sample_ring_r : ndarray
+        Rays of each ring at the sample, of shape (5, num rings) or (4, num rings)
+    detector_ring_r : ndarray
+        Rays of each ring at the detector, of shape (5, num rings) or (4, num rings)
+    ring_blocked_at : ndarray
+        Index of the first component which blocks the rays of each ring
+    num_components : int
+        Number of components of the column, which is the code of rays which are not blocked
+    num_points_kth_ring : ndarray
+        Array of the number of points on each ring of the beam
+    start : int
+        Index of the first ray
+    stop : int
+        Index after the last ray
+    detector_size : float
+        Edge length of the detector
+    detector_pixels : int
+        Pixel resolution of the detector
+    sample_size : float
+        Edge length of the sample
+    sample_pixels : int
+        Pixel resolution of the sample
+    sample_image : ndarray
+        Image intensities of the sample
+    blocked_at : ndarray
+        Array of shape (stop - start) where the index of the first component which blocks each ray
+        is written
+    num_workers : int, optional
+        Number of threads, by default 1
+
+    Returns
+    -------
+    hits : ndarray
+        Number of rays which hit each pixel of the detector, but not the sample
+    sample_values : ndarray
+        Sample intensity of the last ray through the sample which hit each pixel of the detector
+    through_sample : ndarray
+        Boolean image which is True for the pixels of the detector hit by a ray through the sample
+    '''
+    with kernel_threads(num_workers) as num_threads:
+        dtype = sample_ring_r.dtype.type
+        detector_parameters = np.array(
+            [detector_size, detector_pixels, dtype(detector_pixels)/2, 1], dtype=dtype)
+        sample_parameters = np.array(
+            [sample_size, sample_pixels, dtype(sample_pixels)/2, 1], dtype=dtype)
+        ring_starts = np.concatenate(([0], np.cumsum(num_points_kth_ring))).astype(np.int64)
+
+        image_shape = (num_threads, detector_pixels, detector_pixels)
+        hits = np.zeros(image_shape, dtype=np.uint32)
+        last_sample_rays = np.full(image_shape, -1, dtype=np.int64)
+        last_sample_values = np.zeros(image_shape, dtype=np.float64)
+
+        _trace_ring_image(np.ascontiguousarray(sample_ring_r[:4]),
+                          np.ascontiguousarray(detector_ring_r[:4]), ring_blocked_at, ring_starts,
+                          start, stop, num_components, detector_parameters, sample_parameters,
+                          np.asarray(sample_image, dtype=np.float64), blocked_at, hits,
+                          last_sample_rays, last_sample_values)
+
+    last_thread = np.argmax(last_sample_rays, axis=0)
+    sample_values = np.take_along_axis(last_sample_values, last_thread[None], axis=0)[0]
+    through_sample = np.take_along_axis(last_sample_rays, last_thread[None], axis=0)[0] >= 0
+
+    return hits.sum(axis=0), sample_values, through_sample
+
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _transfer(kernel, m, x, tx, y, ty):
+        '''Transfer a tile of rays in place through the kernel and matrix m of a plane'''
+        if kernel == KERNEL_BIPRISM:
+            for ray in range(x.shape[0]):
+                tx[ray] += np.sign(x[ray])*m[1, 4]
+                ty[ray] += np.sign(y[ray])*m[3, 4]
+            return
+
+        m00, m01, m02, m03, m04 = m[0, 0], m[0, 1], m[0, 2], m[0, 3], m[0, 4]
+        m10, m11, m12, m13, m14 = m[1, 0], m[1, 1], m[1, 2], m[1, 3], m[1, 4]
+        m20, m21, m22, m23, m24 = m[2, 0], m[2, 1], m[2, 2], m[2, 3], m[2, 4]
+        m30, m31, m32, m33, m34 = m[3, 0], m[3, 1], m[3, 2], m[3, 3], m[3, 4]
+        for ray in range(x.shape[0]):
+            x0, tx0, y0, ty0 = x[ray], tx[ray], y[ray], ty[ray]
+            x[ray] = m00*x0 + m01*tx0 + m02*y0 + m03*ty0 + m04
+            tx[ray] = m10*x0 + m11*tx0 + m12*y0 + m13*ty0 + m14
+            y[ray] = m20*x0 + m21*tx0 + m22*y0 + m23*ty0 + m24
+            ty[ray] = m30*x0 + m31*tx0 + m32*y0 + m33*ty0 + m34
+
+    @njit(cache=True)
+    def _propagate(z, x, tx, y, ty):
+        '''Propagate a tile of rays in place across the gap below a plane'''
+        for ray in range(x.shape[0]):
+            x[ray] = tx[ray]*z + x[ray]
+            y[ray] = ty[ray]*z + y[ray]
+
+    @njit(cache=True)
+    def _find_blocked(stop, parameters, component_idx, num_components, x, y, codes):
+        '''Code the rays of a tile which are stopped at a plane, and not by a component above it'''
+        if stop == STOP_APERTURE:
+            for ray in range(x.shape[0]):
+                if codes[ray] != num_components:
+                    continue
+                distance = np.hypot(x[ray] - parameters[0], y[ray] - parameters[1])
+                if distance >= parameters[2] and distance < parameters[3]:
+                    codes[ray] = component_idx
+        elif stop == STOP_RECTANGLE:
+            for ray in range(x.shape[0]):
+                if codes[ray] != num_components:
+                    continue
+                if abs(x[ray]) < parameters[0] and abs(y[ray]) < parameters[1]:
+                    codes[ray] = component_idx
+
+    @njit(cache=True)
+    def _pixel_inside(x, y, parameters):
+        '''Pixel coordinates of a ray (with the y axis flipped), and whether they are inside the
+        image'''
+        pixel_x = np.rint(x / parameters[0] * parameters[1] + parameters[2] - parameters[3])
+        pixel_y = np.rint(-y / parameters[0] * parameters[1] + parameters[2] - parameters[3])
+        inside = pixel_x > 0 and pixel_x < parameters[1] and pixel_y > 0 and pixel_y < parameters[1]
+
+        if inside:
+            return int(pixel_x), int(pixel_y), True
+
+        return 0, 0, False
+
+    @njit(parallel=True, cache=True)
+    def _trace_planes(r, r_plane_idcs, blocking_r, blocking_plane_idcs, start, kernels, matrices,
+                      stops, stop_parameters, stop_component_idcs, z_distances, blocked_at,
+                      first_component_idx, num_components, tile_size):
+        steps = r_plane_idcs.shape[0]
+        num_rays = r.shape[2]
+
+        # Each tile of rays is carried through every plane in arrays that stay in cache, and is only
+        # written to the planes that are stored
+        for tile in prange((num_rays + tile_size - 1) // tile_size):
+            tile_start = tile*tile_size
+            tile_stop = min(tile_start + tile_size, num_rays)
+
+            # Start from the rays of the plane above start
+            if r_plane_idcs[start-1] >= 0:
+                rays = r[r_plane_idcs[start-1], :, tile_start:tile_stop]
+            else:
+                rays = blocking_r[blocking_plane_idcs[start-1], :, tile_start:tile_stop]
+            x, tx, y, ty = rays[0].copy(), rays[1].copy(), rays[2].copy(), rays[3].copy()
+
+            codes = blocked_at[tile_start:tile_stop]
+            for ray in range(codes.shape[0]):
+                if codes[ray] >= first_component_idx:
+                    codes[ray] = num_components
+
+            for idx in range(start, steps):
+                _propagate(z_distances[idx-1], x, tx, y, ty)
+
+                if idx < steps - 1:
+                    _transfer(kernels[idx-1], matrices[idx-1], x, tx, y, ty)
+                    _find_blocked(stops[idx-1], stop_parameters[idx-1], stop_component_idcs[idx-1],
+                                  num_components, x, y, codes)
+
+                if r_plane_idcs[idx] >= 0:
+                    rays = r[r_plane_idcs[idx], :, tile_start:tile_stop]
+                elif blocking_plane_idcs[idx] >= 0:
+                    rays = blocking_r[blocking_plane_idcs[idx], :, tile_start:tile_stop]
+                else:
+                    continue
+                for ray in range(x.shape[0]):
+                    rays[0, ray] = x[ray]
+                    rays[1, ray] = tx[ray]
+                    rays[2, ray] = y[ray]
+                    rays[3, ray] = ty[ray]
+
+    @njit(parallel=True, cache=True)
+    def _trace_image(gun_rays, kernels, matrices, stops, stop_parameters, stop_component_idcs,
+                     z_distances, num_components, sample_plane_idx, detector_parameters,
+                     sample_parameters, sample_image, blocked_at, hits, last_sample_rays,
+                     last_sample_values, tile_size):
+        steps = z_distances.shape[0] + 1
+        num_rays = gun_rays.shape[1]
+        num_threads = hits.shape[0]
+
+        # Each thread takes a contiguous block of rays, in order, so the last ray to write a pixel
+        # of its histograms is the last ray of the block
+        for thread in prange(num_threads):
+            thread_stop = (thread + 1)*num_rays//num_threads
+            for tile_start in range(thread*num_rays//num_threads, thread_stop, tile_size):
+                tile_stop = min(tile_start + tile_size, thread_stop)
+
+                x = gun_rays[0, tile_start:tile_stop].copy()
+                tx = gun_rays[1, tile_start:tile_stop].copy()
+                y = gun_rays[2, tile_start:tile_stop].copy()
+                ty = gun_rays[3, tile_start:tile_stop].copy()
+                sample_x, sample_y = x.copy(), y.copy()
+                codes = blocked_at[tile_start:tile_stop]
+                codes[:] = num_components
+
+                for idx in range(1, steps):
+                    _propagate(z_distances[idx-1], x, tx, y, ty)
+
+                    if idx < steps - 1:
+                        _transfer(kernels[idx-1], matrices[idx-1], x, tx, y, ty)
+                        _find_blocked(stops[idx-1], stop_parameters[idx-1],
+                                      stop_component_idcs[idx-1], num_components, x, y, codes)
+                        if idx == sample_plane_idx:
+                            sample_x[:] = x
+                            sample_y[:] = y
+
+                for ray in range(codes.shape[0]):
+                    if codes[ray] != num_components:
+                        continue
+
+                    pixel_x, pixel_y, on_detector = _pixel_inside(
+                        x[ray], y[ray], detector_parameters)
+                    if not on_detector:
+                        continue
+
+                    sample_pixel_x, sample_pixel_y, on_sample = _pixel_inside(
+                        sample_x[ray], sample_y[ray], sample_parameters)
+                    if on_sample:
+                        last_sample_rays[thread, pixel_y, pixel_x] = tile_start + ray
+                        last_sample_values[thread, pixel_y, pixel_x] = \
+                            sample_image[sample_pixel_y, sample_pixel_x]
+                    else:
+                        hits[thread, pixel_y, pixel_x] += 1
+
+    @njit(cache=True)
+    def _rotate_ring_position(ring_r, ring, cos_t, sin_t):
+        '''Position of a ray rotated from the ray of its ring at angle zero, as rotate_ring_rays
+        finds it'''
+        x, y = ring_r[0, ring], ring_r[2, ring]
+        if y == 0:
+            return x*cos_t, x*sin_t
+
+        return x*cos_t - y*sin_t, x*sin_t + y*cos_t
+
+    @njit(parallel=True, cache=True)
+    def _trace_ring_image(sample_ring_r, detector_ring_r, ring_blocked_at, ring_starts, start, stop,
+                          num_components, detector_parameters, sample_parameters, sample_image,
+                          blocked_at, hits, last_sample_rays, last_sample_values):
+        num_rays = stop - start
+        num_threads = hits.shape[0]
+        last_ring = ring_starts.shape[0] - 2
+
+        for thread in prange(num_threads):
+            # The cosine and sine of each ray are rounded to the type of the rays, as in
+            # rotate_ring_rays
+            rotation = np.empty(2, dtype=sample_ring_r.dtype)
+            ring = 0
+            thread_start = start + thread*num_rays//num_threads
+            thread_stop = start + (thread + 1)*num_rays//num_threads
+            for ray_idx in range(thread_start, thread_stop):
+                # Rays after the last ring are in the centre of the beam, like the first ring
+                if ray_idx >= ring_starts[-1]:
+                    ring, t = 0, 0.0
+                else:
+                    while ring < last_ring and ring_starts[ring + 1] <= ray_idx:
+                        ring += 1
+                    ring_size = ring_starts[ring + 1] - ring_starts[ring]
+                    t = (ray_idx - ring_starts[ring])*(2*np.pi/ring_size)
+
+                ray = ray_idx - start
+                blocked_at[ray] = ring_blocked_at[ring]
+                if ring_blocked_at[ring] != num_components:
+                    continue
+
+                rotation[0], rotation[1] = np.cos(t), np.sin(t)
+                x, y = _rotate_ring_position(detector_ring_r, ring, rotation[0], rotation[1])
+                pixel_x, pixel_y, on_detector = _pixel_inside(x, y, detector_parameters)
+                if not on_detector:
+                    continue
+
+                x, y = _rotate_ring_position(sample_ring_r, ring, rotation[0], rotation[1])
+                sample_pixel_x, sample_pixel_y, on_sample = _pixel_inside(x, y, sample_parameters)
+                if on_sample:
+                    last_sample_rays[thread, pixel_y, pixel_x] = ray
+                    last_sample_values[thread, pixel_y, pixel_x] = \
+                        sample_image[sample_pixel_y, sample_pixel_x]
+                else:
+                    hits[thread, pixel_y, pixel_x] += 1
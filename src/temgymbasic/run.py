@@ -358,7 +358,6 @@ class LinearTEMCtrl:
             if self.timer.isActive() and self.model.experiment == '4DSTEM' and self.scan_started == True:
                 self.model.update_scan_position()
                 self.model.update_scan_coil_ratio()
-                self.model.generate_rays()
                 
                 if self.model.scan_pixel_y == self.model.scan_pixels & self.model.scan_pixel_x == self.model.scan_pixels:
                     self.timer.stop()
@@ -368,7 +367,6 @@ class LinearTEMCtrl:
                 for component in self.model.components:
                     component.update_parameters_from_gui()
             elif self.timer.isActive():
-                self.model.generate_rays()
                 for component in self.model.components:
                     component.update_parameters_from_gui()
             else:
@@ -381,9 +379,11 @@ class LinearTEMCtrl:
             
             if self.model.experiment == '4DSTEM':
                 #Create detector image of rays
+                detector_rays = self.model.get_allowed_rays(-1)
+                sample_rays = self.model.get_allowed_rays(self.model.sample_plane_idx)
                 detector_ray_image, detector_sample_image, _, _ = get_image_from_rays(
-                    self.model.r[-1, 0, allowed_rays], self.model.r[-1, 2, allowed_rays], 
-                    self.model.r[self.model.sample_r_idx, 0, allowed_rays], self.model.r[self.model.sample_r_idx, 2, allowed_rays], 
+                    detector_rays[0], detector_rays[2],
+                    sample_rays[0], sample_rays[2],
                     self.model.detector_size, self.model.detector_pixels,
                     self.model.components[self.model.sample_idx].sample_size, self.model.components[self.model.sample_idx].sample_pixels,
                     self.model.components[self.model.sample_idx].sample
@@ -392,9 +392,11 @@ class LinearTEMCtrl:
                 self.viewer.spot_img.setImage(detector_sample_image*255)
             else:
                 #Create detector image of rays
+                detector_rays = self.model.get_allowed_rays(-1)
+                gun_rays = self.model.get_allowed_rays(0)
                 detector_ray_image, detector_sample_image, _, _ = get_image_from_rays(
-                    self.model.r[-1, 0, allowed_rays], self.model.r[-1, 2, allowed_rays], 
-                    self.model.r[0, 0, allowed_rays], self.model.r[0, 2, allowed_rays], 
+                    detector_rays[0], detector_rays[2],
+                    gun_rays[0], gun_rays[2],
                     self.model.detector_size, self.model.detector_pixels,
                     1, 1,
                     np.zeros((10, 10))
@@ -488,7 +490,8 @@ def show_matplotlib(model, name = 'model.svg', component_lw = 4, edge_lw = 1, la
         Matplotlib axis object of the figure
     '''    
     #Step the rays through the model to get the ray positions throughout the column
-    rays = model.step()
+    model.step()
+    rays = model.get_full_r()
 
     #Collect their x, y & z coordinates
     x, y, z = rays[:, 0, :], rays[:, 2, :], model.z_positions
@@ -517,8 +520,8 @@ def show_matplotlib(model, name = 'model.svg', component_lw = 4, edge_lw = 1, la
     #Set starting index of component so that we can plot rays from one component to the next
     idx = 1
 
-    #Generate a list of the allowed rays, so we can block them when they hit an aperture
-    allowed_rays = range(model.num_rays)
+    # Generate an array of the allowed rays, so we can block them when they hit an aperture
+    allowed_rays = np.arange(model.num_rays)
     
     #Set colors of rays
     ray_color = 'dimgray'
@@ -539,8 +542,8 @@ def show_matplotlib(model, name = 'model.svg', component_lw = 4, edge_lw = 1, la
     
     #Loop through components, and for each type of component plot rays in the correct ray,
     #and increment the index correctly
-    for component in model.components:
-        if allowed_rays != []:
+    for component_idx, component in enumerate(model.components):
+        if len(allowed_rays) > 0:
             if highlight_edges == True:
                 ax.plot(x[idx-1:idx+1, edge_rays], z[idx-1:idx+1],
                         color='k', linewidth=edge_lw, alpha=1, zorder=2)
@@ -614,7 +617,7 @@ def show_matplotlib(model, name = 'model.svg', component_lw = 4, edge_lw = 1, la
                     color='k', alpha=0.8, linewidth=component_lw+2, zorder=998)
             idx += 1
 
-            if allowed_rays != []:
+            if len(allowed_rays) > 0:
                 if highlight_edges == True:
                     ax.plot(x[idx-1:idx+1, edge_rays], z[idx-1:idx+1],
                             color='k', linewidth=edge_lw, alpha=1, zorder=2)
@@ -682,25 +685,21 @@ def show_matplotlib(model, name = 'model.svg', component_lw = 4, edge_lw = 1, la
 
             idx += 1
 
-        allowed_rays = list(set(allowed_rays).difference(
-            set(component.blocked_ray_idcs)))
-        allowed_rays.sort()
+        allowed_rays = np.flatnonzero(model.alive_after(component_idx))
 
         if len(allowed_rays) > 0:
-            edge_rays = [allowed_rays[0], allowed_rays[-1]]
-            new_edges = np.where(np.diff(allowed_rays) != 1)[0].tolist()
-
-            for new_edge in new_edges:
-                edge_rays.extend(
-                    [allowed_rays[new_edge], allowed_rays[new_edge+1]])
-
-            edge_rays.sort()
+            # The edges of the beam are the first and last allowed rays, and the rays on
+            # either side of every gap of blocked rays
+            new_edges = np.flatnonzero(np.diff(allowed_rays) != 1)
+            edge_rays = np.sort(np.concatenate((
+                allowed_rays[[0, -1]], allowed_rays[new_edges], allowed_rays[new_edges+1]
+            ))).tolist()
 
         else:
             break
         
     #We need to repeat the code once more for the rays at the end
-    if allowed_rays != []:
+    if len(allowed_rays) > 0:
         if highlight_edges == True:
             ax.plot(x[idx-1:idx+1, edge_rays], z[idx-1:idx+1],
                     color='k', linewidth=edge_lw, alpha=1, zorder=2)
@@ -0,0 +1,110 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import make_test_sample, get_image_from_rays
+
+import numpy as np
+
+'''The columns and models which the tests share. pytest runs the tests with this directory on the
+path, so they import from here with "from _common import make_models".'''
+
+sample = make_test_sample()
+
+
+def make_tem_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.08),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Quadrupole(name = 'Condenser Stig', z = 2.2),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, updefx = 0.01),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Aperture(name = 'Objective Aperture', z = 1.0, aperture_radius_inner = 0.05),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 0.8),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+
+def make_biprism_components():
+    return [comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.5),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Biprism(name = 'Biprism', z = 1.0, deflection = 0.05, theta = np.pi/2),
+            comp.Deflector(name = 'Image Shift', z = 0.6, defx = 0.01, defy = -0.02),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+
+def make_4dstem_components(sample_z = 1.2):
+    return [comp.DoubleDeflector(name = 'Scan Coils', z_up = 2.0, z_low = 1.9),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = sample_z),
+            comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.8, z_low = 0.7)]
+
+
+columns = {'tem': make_tem_components, 'biprism': make_biprism_components}
+model_kwargs = [{}, {'compact_rays': True}, {'keep_planes': ['Sample']}, {'dtype': np.float32}]
+
+
+def make_model(make_components, num_rays = 2**12 + 3, **kwargs):
+    '''Model of a column with a point beam, where the keyword arguments are those of Model'''
+    return Model(make_components(), beam_z = 3.0, beam_type = 'point', num_rays = num_rays,
+                 gun_beam_semi_angle = 0.15, detector_pixels = 256, **kwargs)
+
+
+def make_models(make_components, options, num_rays = 2**12 + 3, **kwargs):
+    '''One model of the column for each dict of keyword arguments in options, which are given
+    to Model as well as kwargs'''
+    return [make_model(make_components, num_rays, **option, **kwargs) for option in options]
+
+
+def set_params(model, params):
+    '''Change the parameters of the components of model, given by component name in the format
+    of Model.trace'''
+    for component in model.components:
+        for attribute, value in params.get(component.name, {}).items():
+            setattr(component, attribute, value)
+        component.update_matrices()
+
+
+def assert_same_as_full_trace(model, reference):
+    '''Step model, and check its rays and blocked rays against propagating the whole column of
+    reference, a model of the same column with the same changes'''
+    model.step()
+    reference.update_component_matrix()
+    reference.update_rays_stepwise()
+    atol = 1e-12 if model.dtype == np.float64 else 1e-5
+    assert np.allclose(model.get_full_r(), reference.get_full_r(), atol = atol, equal_nan = True)
+    assert np.array_equal(model.get_blocked_at(), reference.get_blocked_at())
+
+
+def full_trace_images(model):
+    '''Propagate the whole column of model, and form the images which trace_chunked merges from
+    its chunks: the ray image, the sample image and the number of rays blocked by each component'''
+    model.update_rays_stepwise()
+    allowed_ray_bools = model.allowed_ray_bools()
+    detector_rays = model.r[-1][:, allowed_ray_bools]
+    sample_rays = model.r[model.plane_r_idx(model.sample_plane_idx)][:, allowed_ray_bools]
+    sample = model.components[model.sample_idx]
+
+    ray_image, sample_image, _, _ = get_image_from_rays(
+        detector_rays[0], detector_rays[2], sample_rays[0], sample_rays[2], model.detector_size,
+        model.detector_pixels, sample.sample_size, sample.sample_pixels, sample.sample)
+    sample_image[ray_image > 0] = 0
+    blocked_ray_counts = np.bincount(model.get_blocked_at(),
+                                     minlength = len(model.components) + 1)[:-1]
+
+    return ray_image, sample_image, blocked_ray_counts
+
+
+def legacy_planes(model):
+    '''Rays of every plane of an affine column from the gun rays of the model, stepped as the
+    original loop did, with a new propagation matrix for every gap and a new array for every
+    matrix multiplication. The z of the planes are read from the components, and blocked rays
+    are not removed.'''
+    z_positions = [model.beam_z] + [component.plane_z_positions()[plane]
+                                    for component, plane in model.plane_components] + [0]
+    z_distances = np.diff(z_positions)
+
+    r = [np.asarray(model.r[0], dtype=np.float64)]
+    r.append(np.matmul(model.propagate(z_distances[0]), r[0]))
+    for idx, (component, plane) in enumerate(model.plane_components, start = 1):
+        r[idx] = np.matmul(component.plane_matrices()[plane], r[idx])
+        r.append(np.matmul(model.propagate(z_distances[idx]), r[idx]))
+
+    return np.stack(r)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+array_api_strict = pytest.importorskip('array_api_strict')
+
+from temgymbasic.functions import get_image_from_rays, to_numpy
+from _common import columns, model_kwargs, make_models as make_common_models
+
+'''Conformance tests of tracing with other array namespaces than numpy (Model(array_namespace=...)).
+array_api_strict only has the functions of the array API standard, so a column that traces with it
+only uses the standard, and it must give the same planes of rays, codes of blocked rays and detector
+images as numpy.'''
+
+
+def make_models(make_components, num_rays = 2**12 + 3, **kwargs):
+    return make_common_models(make_components, [{}, {'array_namespace': array_api_strict}],
+                              num_rays, **kwargs)
+
+
+def assert_same_step(models, start = 1):
+    for model in models:
+        model.update_rays_stepwise(start)
+    atol = 1e-12 if models[0].dtype == np.float64 else 1e-5
+    assert np.allclose(models[0].r, to_numpy(models[1].r), atol = atol)
+    assert np.array_equal(models[0].get_blocked_at(), to_numpy(models[1].get_blocked_at()))
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_step(column, kwargs):
+    models = make_models(columns[column], **kwargs)
+    assert models[1].xp is array_api_strict
+    assert_same_step(models)
+
+    # Change a component part way down the column, and step again from its plane
+    for model in models:
+        model.components[-1].f = -0.25
+        model.update_component_matrix()
+    assert_same_step(models, models[0].component_plane_idcs[-1])
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_image(column, kwargs):
+    numpy_model, namespace_model = models = make_models(columns[column], **kwargs)
+    sample = namespace_model.components[namespace_model.sample_idx]
+
+    images = []
+    for model in models:
+        model.update_rays_stepwise()
+        allowed_ray_bools = model.allowed_ray_bools()
+        detector_rays = model.r[-1, ...]
+        sample_rays = model.r[model.plane_r_idx(model.sample_plane_idx), ...]
+        images.append(get_image_from_rays(
+            detector_rays[0, ...][allowed_ray_bools], detector_rays[2, ...][allowed_ray_bools],
+            sample_rays[0, ...][allowed_ray_bools], sample_rays[2, ...][allowed_ray_bools],
+            model.detector_size, model.detector_pixels, sample.sample_size, sample.sample_pixels,
+            sample.sample))
+    for image, namespace_image in zip(*images):
+        assert np.array_equal(image, namespace_image)
+
+    # Chunks of a quarter of the beam, so that images of several chunks are merged
+    memory_budget = namespace_model.estimate_ray_memory(namespace_model.num_rays // 4)
+    for image, namespace_image in zip(numpy_model.trace_chunked(memory_budget),
+                                      namespace_model.trace_chunked(memory_budget)):
+        assert np.array_equal(image, namespace_image)
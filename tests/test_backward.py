@@ -0,0 +1,89 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import get_image_from_rays
+from _common import sample, columns, make_models
+
+import numpy as np
+import pytest
+
+'''Tests of Model.trace_backward(), which forms the detector image of a parallel or point beam
+with one ray for the centre of every detector pixel (Model.backward_gun_rays). The gun rays of the
+pixels must hit the centres of the pixels, and the backward images must be the forward images of
+those rays.'''
+
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.2),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.8),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, updefx = 0.01),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Lens(name = 'Objective Lens', z = 1.0, f = -0.15),
+            comp.Aperture(name = 'Objective Aperture', z = 0.8, aperture_radius_inner = 0.05),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 0.7, fx = -2.0, fy = -2.2),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+
+beams = {'paralell': {'beam_radius': 0.15}, 'point': {'gun_beam_semi_angle': 0.05}}
+
+
+def make_model(beam_type):
+    return Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = 2**10,
+                 detector_pixels = 64, **beams[beam_type])
+
+
+def assert_same_as_forward(model):
+    ray_image, sample_image = model.trace_backward()
+    assert np.count_nonzero((ray_image > 0) | (sample_image != 0)) > 0
+
+    # The gun rays of the pixels, traced forwards, hit the centre of every pixel
+    gun_rays, inside_beam = model.backward_gun_rays()
+    result = model.trace(gun_rays)
+    pixels = model.detector_pixels
+    centres = (np.arange(pixels) + 1 - pixels/2)*model.detector_size/pixels
+    assert np.allclose(result.r[-1, 0], np.tile(centres, pixels), atol = 1e-12)
+    assert np.allclose(result.r[-1, 2], np.repeat(-centres, pixels), atol = 1e-12)
+
+    rays = result.allowed_ray_bools() & inside_beam
+    sample_component = model.components[model.sample_idx]
+    forward_ray_image, forward_sample_image, _, _ = get_image_from_rays(
+        result.r[-1, 0, rays], result.r[-1, 2, rays], result.r[model.sample_plane_idx, 0, rays],
+        result.r[model.sample_plane_idx, 2, rays], model.detector_size, model.detector_pixels,
+        sample_component.sample_size, sample_component.sample_pixels, sample_component.sample)
+    assert np.array_equal(ray_image, forward_ray_image)
+    assert np.array_equal(sample_image, forward_sample_image)
+
+
+@pytest.mark.parametrize('beam_type', beams)
+def test_trace_backward(beam_type):
+    assert_same_as_forward(make_model(beam_type))
+
+
+@pytest.mark.parametrize('beam_type', beams)
+def test_changes(beam_type):
+    model = make_model(beam_type)
+    model.trace_backward()
+
+    model.components[-1].f = -0.12
+    model.components[-1].set_matrix()
+    assert_same_as_forward(model)
+
+    # The beam of the model, as there are no rays to edit
+    if beam_type == 'paralell':
+        model.beam_radius = 0.1
+    else:
+        model.gun_beam_semi_angle = 0.03
+    model.beam_tilt_x = 0.005
+    assert_same_as_forward(model)
+
+    model.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    assert_same_as_forward(model)
+
+
+def test_invalid_columns():
+    # A biprism is not affine
+    with pytest.raises(ValueError):
+        make_models(columns['biprism'], [{}])[0].trace_backward()
+
+    model = Model(make_components(), beam_z = 3.0, beam_type = 'axial', num_rays = 2**10)
+    with pytest.raises(ValueError):
+        model.trace_backward()
@@ -0,0 +1,114 @@
+from temgymbasic import components as comp
+from temgymbasic.functions import get_image_from_rays
+from _common import columns, model_kwargs, make_models, set_params
+
+import numpy as np
+import pytest
+
+'''Tests of Model.trace_batch(), which traces the same rays through many configurations of the
+column at once. The rays, blocked rays and detector images of each configuration must be those of
+a model which is changed to the configuration and stepped, whether the configurations are traced
+with cumulative matrices, with the lens power polynomial of variable lenses, or one at a time for
+a column which is not affine.'''
+
+focal_lengths = np.linspace(-0.3, -0.15, 8)
+sweeps = {'objective': [{'Objective Lens': {'f': f}} for f in focal_lengths],
+          'tilt': [{'Beam Tilt': {'updefx': kick}, 'Objective Lens': {'f': f}}
+                   for kick, f in zip(np.linspace(-0.02, 0.02, 8), focal_lengths)]}
+
+
+def sweep_steps(model, params):
+    '''Rays, blocked rays and detector images of the model changed to each set of parameters'''
+    r, blocked_at, ray_images, sample_images = [], [], [], []
+    sample = model.components[model.sample_idx]
+    for parameters in params:
+        set_params(model, parameters)
+        model.update_rays_stepwise()
+
+        allowed_ray_bools = model.allowed_ray_bools()
+        sample_rays = model.r[model.plane_r_idx(model.sample_plane_idx)]
+        ray_image, sample_image, _, _ = get_image_from_rays(
+            model.r[-1, 0, allowed_ray_bools], model.r[-1, 2, allowed_ray_bools],
+            sample_rays[0, allowed_ray_bools], sample_rays[2, allowed_ray_bools],
+            model.detector_size, model.detector_pixels, sample.sample_size, sample.sample_pixels,
+            sample.sample)
+
+        r.append(model.r.copy())
+        blocked_at.append(model.get_blocked_at().copy())
+        ray_images.append(ray_image)
+        sample_images.append(sample_image)
+
+    return np.stack(r), np.stack(blocked_at), np.stack(ray_images), np.stack(sample_images)
+
+
+def assert_same_as_steps(result, reference, params):
+    r, blocked_at, ray_images, sample_images = sweep_steps(reference, params)
+    atol = 1e-12 if reference.dtype == np.float64 else 1e-5
+    assert result.r.shape == r.shape
+    assert np.allclose(result.r, r, atol = atol)
+    assert np.array_equal(result.blocked_at, blocked_at)
+    if result.detector_ray_images is not None:
+        assert np.array_equal(result.detector_ray_images, ray_images)
+        assert np.array_equal(result.detector_sample_images, sample_images)
+
+
+@pytest.mark.parametrize('kwargs', [kwargs for kwargs in model_kwargs
+                                    if kwargs.get('dtype') != np.float32])
+@pytest.mark.parametrize('variable_lenses', [[], ['Objective Lens']])
+@pytest.mark.parametrize('sweep', sweeps)
+def test_trace_batch(sweep, variable_lenses, kwargs):
+    model, reference = make_models(columns['tem'], [kwargs, kwargs], 2**10)
+    model.set_variable_lenses(variable_lenses)
+    model.step()
+    r = model.r.copy()
+
+    result = model.trace_batch(sweeps[sweep], images = True)
+    assert_same_as_steps(result, reference, sweeps[sweep])
+
+    # The model is not changed
+    assert np.array_equal(model.r, r)
+    assert model.find_first_stale_plane() == model.steps
+
+
+def test_single_precision():
+    model, reference = make_models(columns['tem'], [{'dtype': np.float32}]*2, 2**10)
+    result = model.trace_batch(sweeps['objective'])
+    assert result.r.dtype == np.float32
+    assert_same_as_steps(result, reference, sweeps['objective'])
+
+
+def test_not_affine():
+    model, reference = make_models(columns['biprism'], [{}, {}], 2**10)
+    result = model.trace_batch(sweeps['objective'], images = True)
+    assert_same_as_steps(result, reference, sweeps['objective'])
+
+
+@pytest.mark.parametrize('variable_lenses', [[], ['Objective Lens']])
+def test_changes(variable_lenses):
+    model, reference = make_models(columns['tem'], [{}, {}], 2**10)
+    model.set_variable_lenses(variable_lenses)
+    model.step()
+    params = sweeps['objective']
+
+    for m in [model, reference]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_steps(model.trace_batch(params, images = True), reference, params)
+
+    rays = model.r[0].copy()
+    rays[1] += 0.01
+    reference.r[0, 1, :] += 0.01
+    assert_same_as_steps(model.trace_batch(params, rays, images = True), reference, params)
+
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    reference.r[0, 1, :] -= 0.01
+    assert_same_as_steps(model.trace_batch(params, images = True), reference, params)
+
+
+def test_invalid_parameters():
+    model = make_models(columns['tem'], [{}], 2**10)[0]
+    with pytest.raises(ValueError):
+        model.trace_batch([{'Intermediate Lens': {'f': -0.2}}])
+    with pytest.raises(ValueError):
+        model.trace_batch([{'Objective Lens': {'z': 1.4}}])
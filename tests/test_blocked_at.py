@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import get_image_from_rays
+from _common import sample, make_tem_components, make_model
+
+'''Tests of the codes of the blocked rays (Model.blocked_at), the index of the first component
+which blocks each ray, or the number of components for rays which reach the detector. They must
+follow the ray matrix when it is replaced by one with another number of rays.'''
+
+
+def make_rays(model, x):
+    '''Gun rays of a ray matrix of the model with a ray at each x position, parallel to the axis'''
+    r = np.zeros((len(model.r_planes), model.r.shape[1], len(x)), dtype=model.dtype)
+    if r.shape[1] == 5:
+        r[:, 4, :] = 1
+    r[:, 0, :] = x
+    return r
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compact_rays': True}, {'drop_blocked_rays': True},
+                                    {'defer_blocking': True}, {'keep_planes': ['Sample']}])
+def test_replaced_ray_count(kwargs):
+    model = make_model(make_tem_components, **kwargs)
+    model.step()
+
+    # The ray at x = 0.1 misses the condenser aperture, the first component
+    model.r = make_rays(model, [0.0, 0.1, -0.001])
+    r = model.step()
+    assert model.get_blocked_at().shape == (3,)
+    assert np.array_equal(model.get_blocked_at(), [len(model.components), 0,
+                                                   len(model.components)])
+
+    # Blocked rays are not in every plane if they are dropped
+    result = model.trace(r[0])
+    allowed_ray_bools = result.allowed_ray_bools()
+    assert np.allclose(model.get_full_r()[..., allowed_ray_bools], result.r[..., allowed_ray_bools])
+    assert np.array_equal(model.get_blocked_at(), result.blocked_at)
+
+    # And back to a beam of as many rays as before
+    model.generate_rays()
+    model.step()
+    assert model.get_blocked_at().shape == (model.num_rays,)
+
+
+def test_fourdstem_example_custom_rays():
+    # The custom rays of live_calibration_examples/fourdstem_example_no_gui.py
+    components = [comp.DoubleDeflector(name = 'Scan Coils', z_up = 0.3, z_low = 0.25),
+                  comp.Lens(name = 'Lens', z = 0.20),
+                  comp.Sample(name = 'Sample', sample = sample, z = 0.15,
+                              width = sample.shape[0]*0.000001),
+                  comp.DoubleDeflector(name = 'Descan Coils', z_up = 0.1, z_low = 0.05)]
+    model = Model(components, beam_z = 0.4, beam_type = 'paralell', num_rays = 2**15,
+                  experiment = '4DSTEM', detector_pixels = 256, detector_size = 256*0.000050)
+    model.scan_pixel_size = 0.000001
+    model.set_obj_lens_f_from_overfocus(0.001)
+    model.set_beam_radius_from_semiconv(0.020)
+    model.step()
+
+    model.r = np.zeros((model.steps, 5, 3))
+    model.r[:, 4, :] = np.ones(3)
+    model.r[:, 0, 1] = model.beam_radius*np.cos(np.pi/4)
+    model.r[:, 2, 1] = model.beam_radius*np.sin(np.pi/4)
+    model.r[:, 0, 2] = model.beam_radius*np.cos(-3*np.pi/4)
+    model.r[:, 2, 2] = model.beam_radius*np.sin(-3*np.pi/4)
+    model.step()
+
+    assert np.array_equal(model.allowed_ray_bools(), [True, True, True])
+    assert np.allclose(model.r[-1], model.trace(model.r[0]).r[-1])
+
+    sample_component = model.components[model.sample_idx]
+    detector_ray_image, _, _, _ = get_image_from_rays(
+        model.r[-1, 0, :], model.r[-1, 2, :], model.r[model.sample_r_idx, 0, :],
+        model.r[model.sample_r_idx, 2, :], model.detector_size, model.detector_pixels,
+        sample_component.sample_size, sample_component.sample_pixels, sample_component.sample)
+    assert detector_ray_image.sum() <= 3
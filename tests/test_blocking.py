@@ -0,0 +1,91 @@
+from temgymbasic import components as comp
+from _common import sample, columns, make_models, assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of finding the blocked rays of a column (Model.find_blocked_rays), which tests every
+stop against a tile of rays in one fused pass, and of Model(defer_blocking=True), which only
+finds the blocked rays when they are asked for. The codes of the blocked rays must be those of
+testing each stop against its whole plane.'''
+
+
+def make_stops_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.08),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Aperture(name = 'Selected Area Aperture', z = 2.0, aperture_radius_inner = 0.05),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Biprism(name = 'Biprism', z = 1.3, deflection = 0.01, width = 0.001),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Aperture(name = 'Objective Aperture', z = 1.0, aperture_radius_inner = 0.05),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+
+stop_columns = dict(columns, stops = make_stops_components)
+
+
+def find_blocked_rays_per_stop(model):
+    # Every stop is tested against all rays of its plane
+    blocked_at = np.full(model.r.shape[-1], len(model.components))
+    planes = model.get_plane_arrays()
+    for component_idx, component in enumerate(model.components):
+        if component.stops_rays:
+            blocked = component.blocked(planes[model.component_plane_idcs[component_idx]])
+            blocked_at[blocked & (blocked_at > component_idx)] = component_idx
+
+    return blocked_at
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'keep_planes': 'endpoints'}, {'tile_size': 2**9}])
+@pytest.mark.parametrize('column', stop_columns)
+def test_fused_blocking(column, kwargs):
+    model = make_models(stop_columns[column], [kwargs])[0]
+    model.step()
+    assert np.array_equal(model.get_blocked_at(), find_blocked_rays_per_stop(model))
+    assert np.any(model.get_blocked_at() < len(model.components))
+
+
+@pytest.mark.parametrize('column', stop_columns)
+def test_deferred_blocking(column):
+    deferred, model = make_models(stop_columns[column], [{'defer_blocking': True}, {}])
+    for m in [deferred, model]:
+        m.step()
+
+    # The blocked rays are only found when they are asked for
+    assert deferred.first_stale_blocking_plane < deferred.steps
+    assert np.array_equal(deferred.get_blocked_at(), model.get_blocked_at())
+    assert deferred.first_stale_blocking_plane == deferred.steps
+    assert np.array_equal(deferred.allowed_ray_bools(), model.allowed_ray_bools())
+
+
+@pytest.mark.parametrize('column', stop_columns)
+def test_changes(column):
+    deferred, reference = make_models(stop_columns[column], [{'defer_blocking': True}, {}])
+    deferred.step()
+
+    for m in [deferred, reference]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_full_trace(deferred, reference)
+
+    for m in [deferred, reference]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(deferred, reference)
+
+    for m in [deferred, reference]:
+        m.insert_component(comp.Aperture(name = 'Field Aperture', z = 0.5,
+                                         aperture_radius_inner = 0.02))
+    assert_same_as_full_trace(deferred, reference)
+
+    # The blocked rays of a step which are not asked for are found with those of the next step,
+    # which starts further down the column
+    for m in [deferred, reference]:
+        lens = m.components[[component.name for component in m.components].index(
+            'Objective Lens')]
+        lens.f = -0.25
+        lens.set_matrix()
+    deferred.step()
+    for m in [deferred, reference]:
+        m.components[-1].f = -0.3
+        m.components[-1].set_matrix()
+    assert_same_as_full_trace(deferred, reference)
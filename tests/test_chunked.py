@@ -0,0 +1,69 @@
+from temgymbasic import components as comp
+from _common import columns, make_model, make_models, make_4dstem_components, \
+    assert_same_as_full_trace, full_trace_images
+
+import numpy as np
+import pytest
+
+'''Tests of Model.trace_chunked(), which traces the beam of a model in chunks of rays and merges
+their images. The images must be those of propagating the whole beam at once, and the rays of the
+model must not be changed.'''
+
+# The 4DSTEM column without scan or descan is rotationally symmetric, so it is traced from rings
+chunked_columns = dict(columns, symmetric = make_4dstem_components)
+
+
+def assert_same_images(model, reference, num_rays = None):
+    num_rays = model.num_rays if num_rays is None else num_rays
+
+    # Chunks of a quarter of the beam, so that images of several chunks are merged
+    memory_budget = model.estimate_ray_memory(num_rays // 4, 1)
+    for chunked_image, image in zip(model.trace_chunked(memory_budget, num_rays),
+                                    full_trace_images(reference)):
+        assert np.array_equal(chunked_image, image)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compact_rays': True}])
+@pytest.mark.parametrize('column', chunked_columns)
+def test_trace_chunked(column, kwargs):
+    model, reference = make_models(chunked_columns[column], [kwargs, kwargs])
+    assert model.is_rotationally_symmetric() == (column == 'symmetric')
+    assert model.get_chunk_size(model.estimate_ray_memory(model.num_rays // 4, 1), 1) == \
+        model.num_rays // 4
+    assert_same_images(model, reference)
+
+
+@pytest.mark.parametrize('column', chunked_columns)
+def test_changes(column):
+    model, reference = make_models(chunked_columns[column], [{}, {}])
+    model.step()
+    r = model.r.copy()
+    assert_same_images(model, reference)
+
+    # The rays of the model are not changed, and are still up to date
+    assert np.array_equal(model.r, r, equal_nan = True)
+    assert model.find_first_stale_plane() == model.steps
+
+    for m in [model, reference]:
+        lens = [component for component in m.components if component.type == 'Lens'][-1]
+        lens.f = -0.25
+        lens.set_matrix()
+    assert_same_images(model, reference)
+
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    assert_same_images(model, reference)
+
+    # The model is stepped from its own rays, whose edits are not lost by a chunked trace
+    for m in [model, reference]:
+        m.r[0, 1, :] += 0.01
+    model.trace_chunked()
+    assert_same_as_full_trace(model, reference)
+
+
+@pytest.mark.parametrize('column', chunked_columns)
+def test_num_rays(column):
+    model = make_model(chunked_columns[column])
+    reference = make_model(chunked_columns[column], num_rays = 2**13 + 7)
+    assert_same_images(model, reference, reference.num_rays)
+    assert model.num_rays == 2**12 + 3
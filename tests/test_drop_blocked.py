@@ -0,0 +1,81 @@
+from temgymbasic import components as comp
+from _common import columns, make_models, assert_same_as_full_trace
+
+import bisect
+import numpy as np
+import pytest
+
+'''Tests of dropping blocked rays during propagation (Model(drop_blocked_rays=True)). Each plane
+holds only the rays which reach it, which must be the rays of a model which keeps every ray, and
+the blocked rays and the rays which reach the detector must be the same.'''
+
+
+def assert_same_as_all_rays(model, all_rays):
+    all_rays.step()
+    blocked_at = all_rays.get_blocked_at()
+    assert np.array_equal(model.get_blocked_at(), blocked_at)
+    assert np.allclose(model.get_allowed_rays(-1), all_rays.get_allowed_rays(-1), atol = 1e-12)
+
+    # A ray reaches every plane down to the component that blocks it, and the detector if it is
+    # not blocked. The positions and slopes of the rays which do not reach a plane are NaN.
+    for r_idx, idx in enumerate(model.r_planes):
+        component_idx = bisect.bisect_right(model.component_plane_idcs, idx) - 1
+        if idx == model.steps - 1:
+            component_idx = len(model.components)
+        reached = blocked_at >= component_idx
+        assert np.allclose(model.get_full_plane(idx)[:4],
+                           np.where(reached, all_rays.r[r_idx, :4], np.nan), atol = 1e-12,
+                           equal_nan = True)
+
+
+def change_aperture(model, radius):
+    for component in model.components:
+        if component.name == 'Condenser Aperture':
+            component.aperture_radius_inner = radius
+
+
+# Only the TEM column has a condenser aperture, whose radius sets how many rays pass it
+@pytest.mark.parametrize('column, radius', [('tem', 0.1), ('tem', 0.03), ('tem', 0.003),
+                                            ('biprism', None)])
+def test_drop_blocked_rays(column, radius):
+    model, all_rays = make_models(columns[column], [{'drop_blocked_rays': True}, {}])
+    if radius is not None:
+        for m in [model, all_rays]:
+            change_aperture(m, radius)
+    model.step()
+    assert_same_as_all_rays(model, all_rays)
+
+    # Planes below a stop only hold the rays that pass it
+    num_passed = np.count_nonzero(model.allowed_ray_bools())
+    assert model.ray_idcs[-1] is None or len(model.ray_idcs[-1]) == num_passed
+
+
+@pytest.mark.parametrize('column', columns)
+def test_changes(column):
+    model, reference, all_rays = make_models(
+        columns[column], [{'drop_blocked_rays': True}, {'drop_blocked_rays': True}, {}])
+    model.step()
+
+    for m in [model, reference, all_rays]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_rays(model, all_rays)
+
+    for m in [model, reference, all_rays]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_rays(model, all_rays)
+
+    for m in [model, reference, all_rays]:
+        m.insert_component(comp.Aperture(name = 'Selected Area Aperture', z = 0.5,
+                                         aperture_radius_inner = 0.02))
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_rays(model, all_rays)
+
+    # Rays blocked by an aperture which is opened are propagated again
+    for m in [model, reference, all_rays]:
+        m.components[[component.name for component in m.components].index(
+            'Selected Area Aperture')].aperture_radius_inner = 0.2
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_rays(model, all_rays)
@@ -0,0 +1,73 @@
+import pytest
+
+from _common import columns, model_kwargs, make_models, assert_same_as_full_trace
+
+'''Tests of incremental stepping (Model.step), which only propagates the planes below the first
+change since the last step. After a change of a parameter or of the gun rays, the rays of a step
+must be those of propagating the whole column again.'''
+
+
+def change_lens(model, f):
+    model.components[-1].f = f
+    model.components[-1].set_matrix()
+
+
+def change_deflector(model, kick):
+    for component in model.components:
+        if component.name == 'Beam Tilt':
+            component.updefx = kick
+            component.set_matrices()
+        elif component.name == 'Image Shift':
+            component.defx = kick
+            component.set_matrix()
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_parameter_change(column, kwargs):
+    model, reference = make_models(columns[column], [kwargs, kwargs])
+    model.step()
+
+    # Nothing is propagated again until something changes
+    assert model.find_first_stale_plane() == model.steps
+    for f in [-0.25, -0.3]:
+        for m in [model, reference]:
+            change_lens(m, f)
+        assert model.find_first_stale_plane() == model.component_plane_idcs[-1]
+        assert_same_as_full_trace(model, reference)
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_gun_ray_edit(column, kwargs):
+    model, reference = make_models(columns[column], [kwargs, kwargs])
+    model.step()
+
+    # Edits of the gun rays in place are found by the next step
+    for m in [model, reference]:
+        m.r[0, 1, :] += 0.01
+    assert model.find_first_stale_plane() == 1
+    assert_same_as_full_trace(model, reference)
+    assert model.find_first_stale_plane() == model.steps
+
+    # The rays are not moved along the kicks of a changed deflector, as they have new gun rays
+    for m in [model, reference]:
+        m.r[0, 3, :] -= 0.01
+        change_deflector(m, 0.02)
+    assert_same_as_full_trace(model, reference)
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs + [{'defer_blocking': True},
+                                                   {'drop_blocked_rays': True}])
+def test_stop_change(kwargs):
+    model, reference = make_models(columns['tem'], [kwargs, kwargs])
+    model.step()
+
+    # The radius of an aperture is not in its matrix, but it changes the version of the
+    # component, and the rays it blocks are found again
+    version = model.components[6].update_version()
+    for m in [model, reference]:
+        m.components[6].aperture_radius_inner = 0.02
+    assert model.components[6].update_version() == version + 1
+    assert model.find_first_stale_plane() == model.component_plane_idcs[6]
+    assert_same_as_full_trace(model, reference)
@@ -0,0 +1,110 @@
+from temgymbasic import components as comp
+from _common import make_tem_components, make_biprism_components, make_models
+
+import numpy as np
+import pytest
+
+'''Tests of Model.jacobian(), which propagates the derivatives of the rays with respect to the
+parameters of the components alongside the rays. The derivatives must agree with central finite
+differences, apart from rays which are within a step of the wire of a biprism, whose kick is not
+differentiable there.'''
+
+
+def make_jacobian_tem_components():
+    components = make_tem_components()
+    components[2].fx, components[2].fy = -0.4, 0.4
+    components[3].scan_rotation = 10
+    components[7].fx, components[7].fy = -0.4, -0.45
+    for component in components:
+        component.update_matrices()
+    return components
+
+
+columns = {'tem': make_jacobian_tem_components, 'biprism': make_biprism_components}
+
+
+def finite_differences(model, parameters, planes, step = 1e-7):
+    components = {component.name: component for component in model.components}
+    jacobian = []
+    for name, parameter in parameters:
+        component = components[name]
+        value = getattr(component, parameter)
+        rays = []
+        for change in [step, -step]:
+            setattr(component, parameter, value + change)
+            component.update_matrices()
+            model.step()
+            rays.append(model.r[[model.plane_r_idx(idx % model.steps) for idx in planes]])
+        setattr(component, parameter, value)
+        component.update_matrices()
+        jacobian.append((rays[0] - rays[1])/(2*step))
+    model.step()
+
+    return np.stack(jacobian, axis = 1)
+
+
+def differentiable_rays(model, step = 1e-5):
+    '''Rays which are not within a step of the wire of a biprism'''
+    rays = np.ones(model.num_rays, dtype=bool)
+    for idx, component in enumerate(model.components):
+        if component.type == 'Biprism':
+            biprism_rays = model.get_plane_rays(model.component_plane_idcs[idx])
+            rays &= np.abs(biprism_rays[0 if np.sin(component.theta) != 0 else 2]) > step
+
+    return rays
+
+
+def assert_same_as_finite_differences(model, parameters = None, planes = None):
+    model.step()
+    jacobian = model.jacobian(parameters, planes)
+    if parameters is None:
+        parameters = [(component.name, parameter) for component in model.components
+                      for parameter in component.differentiable_parameters]
+    differences = finite_differences(model, parameters, [-1] if planes is None else planes)
+
+    assert jacobian.shape == differences.shape
+    rays = differentiable_rays(model)
+    error = np.max(np.abs(jacobian - differences)[..., rays])/np.max(np.abs(jacobian))
+    assert error < 1e-6
+
+
+@pytest.mark.parametrize('column', columns)
+def test_jacobian(column):
+    model = make_models(columns[column], [{}], 2**10)[0]
+    assert_same_as_finite_differences(model)
+
+    # Some parameters, at some planes
+    sample_plane_idx = model.sample_plane_idx
+    assert_same_as_finite_differences(model, [('Objective Lens', 'f'), ('Projector Lens', 'f')],
+                                      [sample_plane_idx, -1])
+
+
+def test_compact_rays():
+    model, compact = make_models(columns['tem'], [{}, {'compact_rays': True}], 2**10)
+    for m in [model, compact]:
+        m.step()
+    assert np.allclose(compact.jacobian(), model.jacobian()[:, :, :4], atol = 1e-12)
+
+
+def test_invalid_parameters():
+    model = make_models(columns['tem'], [{}], 2**10)[0]
+    with pytest.raises(ValueError):
+        model.jacobian([('Intermediate Lens', 'f')])
+    with pytest.raises(ValueError):
+        model.jacobian([('Objective Aperture', 'aperture_radius_inner')])
+
+
+@pytest.mark.parametrize('column', columns)
+def test_changes(column):
+    model = make_models(columns[column], [{}], 2**10)[0]
+    model.step()
+
+    model.components[-1].f = -0.25
+    model.components[-1].set_matrix()
+    assert_same_as_finite_differences(model)
+
+    model.r[0, 1, :] += 0.01
+    assert_same_as_finite_differences(model)
+
+    model.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.4, f = -0.3))
+    assert_same_as_finite_differences(model)
@@ -0,0 +1,77 @@
+from temgymbasic import components as comp
+from _common import columns, make_models, assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of Model(keep_planes=...), which keeps only some planes of the column in the ray matrix.
+The kept planes must be those of a model which keeps every plane, and the rays must still be
+blocked at the apertures and biprisms between them.'''
+
+keep_planes = ['all', 'endpoints', ['Sample'], ['Beam Tilt', 'Objective Aperture']]
+
+
+def assert_same_as_all_planes(model, all_planes):
+    all_planes.step()
+    assert np.allclose(model.r, all_planes.r[model.r_planes], atol = 1e-12)
+    assert np.array_equal(model.get_blocked_at(), all_planes.get_blocked_at())
+
+
+@pytest.mark.parametrize('keep', keep_planes)
+def test_kept_planes(keep):
+    model, all_planes = make_models(columns['tem'], [{'keep_planes': keep}, {}])
+    model.step()
+    assert_same_as_all_planes(model, all_planes)
+    assert model.r.shape[0] == len(model.r_planes)
+    assert model.r_planes[0] == 0 and model.r_planes[-1] == model.steps - 1
+
+    # The planes of components are found by name
+    components = {component.name: component for component in model.components}
+    names = {'all': list(components), 'endpoints': []}[keep] if isinstance(keep, str) else keep
+    for name in names:
+        for plane in range(len(components[name].plane_z_positions())):
+            assert np.array_equal(model.component_rays(name, plane),
+                                  all_planes.component_rays(name, plane))
+
+    if keep != 'all':
+        with pytest.raises(ValueError):
+            model.component_rays('Objective Lens')
+        with pytest.raises(ValueError):
+            model.plane_r_idx(model.component_plane_idcs[4])
+
+
+def test_unknown_component():
+    with pytest.raises(ValueError):
+        make_models(columns['tem'], [{'keep_planes': ['Intermediate Lens']}])
+
+
+@pytest.mark.parametrize('keep', keep_planes[1:])
+def test_changes(keep):
+    model, reference, all_planes = make_models(
+        columns['tem'], [{'keep_planes': keep}, {'keep_planes': keep}, {}])
+    model.step()
+
+    for m in [model, reference, all_planes]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_planes(model, all_planes)
+
+    for m in [model, reference, all_planes]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_planes(model, all_planes)
+
+    # An aperture which is not kept still blocks rays
+    for m in [model, reference, all_planes]:
+        m.insert_component(comp.Aperture(name = 'Selected Area Aperture', z = 0.5,
+                                         aperture_radius_inner = 0.02))
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_planes(model, all_planes)
+
+    # Removed components are no longer kept
+    for m in [model, reference, all_planes]:
+        m.remove_component('Objective Aperture')
+    assert 'Objective Aperture' not in model.keep_planes
+    assert_same_as_full_trace(model, reference)
+    assert_same_as_all_planes(model, all_planes)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from temgymbasic import components as comp
+from _common import sample, make_tem_components, make_models
+
+'''Tests of the kernels of the components (Component.apply, Component.transfer and
+Component.find_blocked), which the model calls for every plane. The kernel of an affine component
+must be its matrix, and the model must trace a component which only defines its own kernel.'''
+
+components = [comp.Lens(name = 'Lens', z = 0.5, f = -0.2),
+              comp.AstigmaticLens(name = 'Astigmatic Lens', z = 0.5, fx = -0.2, fy = -0.3),
+              comp.Quadrupole(name = 'Quadrupole', z = 0.5, fx = -0.2, fy = -0.3),
+              comp.Deflector(name = 'Deflector', z = 0.5, defx = 0.01, defy = -0.02),
+              comp.DoubleDeflector(name = 'Double Deflector', z_up = 0.5, z_low = 0.4,
+                                   updefx = 0.01, lowdefx = -0.01, scan_rotation = 30),
+              comp.Biprism(name = 'Biprism', z = 0.5, deflection = 0.01),
+              comp.Aperture(name = 'Aperture', z = 0.5, aperture_radius_inner = 0.1),
+              comp.Sample(name = 'Sample', z = 0.5, sample = sample)]
+
+
+def make_rays(num_rays = 1001):
+    rays = 0.1*np.random.default_rng(0).normal(size = (5, num_rays))
+    rays[4] = 1
+    return rays
+
+
+@pytest.mark.parametrize('component', components, ids = lambda component: component.name)
+def test_kernel(component):
+    rays = make_rays()
+    for plane, matrix in enumerate(component.plane_matrices()):
+        # The kernels only write the positions and slopes
+        out = np.empty_like(rays)
+        component.apply(rays, out, plane)
+        assert np.allclose(out[:4], component.transfer(rays, plane)[:4])
+        if component.affine:
+            assert np.allclose(out[:4], (matrix @ rays)[:4])
+
+        # Rays without the row of ones
+        out = np.empty_like(rays[:4])
+        component.apply(rays[:4], out, plane)
+        assert np.allclose(out, component.transfer(rays, plane)[:4])
+
+
+@pytest.mark.parametrize('component', components, ids = lambda component: component.name)
+def test_blocked(component):
+    rays = make_rays()
+    for plane in range(len(component.plane_z_positions())):
+        blocked = component.blocked(rays, plane)
+        if component.stops_rays:
+            assert np.array_equal(blocked, component.blocked_array(rays, plane))
+            assert np.count_nonzero(blocked) < rays.shape[1]
+        else:
+            assert blocked is None
+
+
+def test_aperture():
+    rays = make_rays()
+    radius = np.hypot(rays[0], rays[2])
+    blocked = components[6].blocked(rays)
+    assert np.array_equal(blocked, (radius > 0.1) & (radius < 0.25))
+    assert np.any(blocked)
+
+
+class Shift(comp.Component):
+    '''Component which only defines its own kernel, which moves every ray in x'''
+    affine = False
+
+    def __init__(self, z, shift, name = 'Shift'):
+        self.z = z
+        self.shift = shift
+        self.name = name
+        self.type = 'Shift'
+        self.matrix = np.eye(5)
+
+    def ray_parameters(self):
+        return [self.shift]
+
+    def apply(self, rays, out, plane = 0, axes = (0, 2)):
+        for row in axes:
+            np.copyto(out[row:row+2], rays[row:row+2])
+        if 0 in axes:
+            out[0] += self.shift
+
+
+def test_custom_kernel():
+    model, reference = make_models(
+        lambda: make_tem_components() + [Shift(z = 0.1, shift = 0.0)], [{}, {}])
+    reference.step()
+    for shift in [0.01, -0.02]:
+        model.components[-1].shift = shift
+        model.step()
+        assert model.find_first_stale_plane() == model.steps
+        assert np.allclose(model.r[:-2], reference.r[:-2], atol = 1e-12)
+        assert np.allclose(model.r[-2:, 0], reference.r[-2:, 0] + shift, atol = 1e-12)
+        assert np.allclose(model.r[-2:, 1:4], reference.r[-2:, 1:4], atol = 1e-12)
@@ -0,0 +1,126 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import model_kwargs, make_tem_components, make_4dstem_components, \
+    assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of moving deflectors: a wobbler on the beam tilt coils of a TEM column, and a scan of the
+scan and descan coils of a 4DSTEM experiment. Model.step moves the rays of every plane along their
+response to the changed kicks (the kick basis, see Model.update_kick_basis), which must give the
+rays and blocked rays of propagating the column again, and must not be used once anything else
+has changed.'''
+
+
+def make_wobbler_components():
+    components = make_tem_components()
+    components[3].scan_rotation = 10
+    components[3].set_matrices()
+    return components[:-1] + [comp.Deflector(name = 'Image Shift', z = 0.6, defx = 0, defy = 0),
+                              components[-1]]
+
+
+def wobble(model, time_step):
+    components = {component.name: component for component in model.components}
+    beam_tilt, image_shift = components['Beam Tilt'], components['Image Shift']
+    beam_tilt.updefx = 0.02*np.sin(0.3*time_step)
+    beam_tilt.lowdefx = -2*beam_tilt.updefx
+    beam_tilt.updefy = 0.01*np.cos(0.3*time_step)
+    beam_tilt.set_matrices()
+    image_shift.defx = 0.01*np.sin(0.1*time_step)
+    image_shift.set_matrix()
+
+
+def scan(model, time_step):
+    model.update_scan_position()
+    model.update_scan_coil_ratio()
+
+
+experiments = {'wobbler': (make_wobbler_components,
+                           {'beam_type': 'point', 'gun_beam_semi_angle': 0.15}, wobble),
+               'scan': (make_4dstem_components, {'experiment': '4DSTEM'}, scan)}
+
+
+def make_models(experiment, **kwargs):
+    make_components, experiment_kwargs, move = experiments[experiment]
+    models = [Model(make_components(), beam_z = 3.0, num_rays = 2**10 + 3, **experiment_kwargs,
+                    **kwargs) for _ in range(2)]
+
+    # Count the steps which move the rays along the kicks
+    models[0].kick_steps = 0
+    update_rays_from_kicks = models[0].update_rays_from_kicks
+
+    def count_kick_steps(*args):
+        models[0].kick_steps += 1
+        update_rays_from_kicks(*args)
+
+    models[0].update_rays_from_kicks = count_kick_steps
+    for model in models:
+        model.step()
+
+    return models, move
+
+
+def move_and_step(models, move, time_steps):
+    for time_step in time_steps:
+        for model in models:
+            move(model, time_step)
+        assert_same_as_full_trace(*models)
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs + [{'defer_blocking': True}])
+@pytest.mark.parametrize('experiment', experiments)
+def test_kicks(experiment, kwargs):
+    models, move = make_models(experiment, **kwargs)
+    move_and_step(models, move, range(1, 11))
+    assert models[0].kick_steps == 10
+
+
+@pytest.mark.parametrize('experiment', experiments)
+def test_changes(experiment):
+    models, move = make_models(experiment)
+    move_and_step(models, move, range(1, 4))
+    kick_steps = models[0].kick_steps
+
+    # A change of a component which is not a deflector propagates the rays again, and the
+    # kicks are moved along the response of the new column
+    for model in models:
+        lens = [component for component in model.components if component.type == 'Lens'][-1]
+        lens.f = -0.25
+        lens.set_matrix()
+    assert_same_as_full_trace(*models)
+    move_and_step(models, move, range(4, 7))
+
+    # as do edited gun rays
+    for model in models:
+        model.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(*models)
+    move_and_step(models, move, range(7, 10))
+
+    # and a layout edit
+    for model in models:
+        model.insert_component(comp.Aperture(name = 'Field Aperture', z = 0.45,
+                                             aperture_radius_inner = 0.02))
+    assert_same_as_full_trace(*models)
+    move_and_step(models, move, range(10, 13))
+
+    # and a change of a stop, which is not in its matrix
+    for model in models:
+        model.components[[component.name for component in model.components].index(
+            'Field Aperture')].aperture_radius_inner = 0.01
+    assert_same_as_full_trace(*models)
+    move_and_step(models, move, range(13, 16))
+
+    assert models[0].kick_steps == kick_steps + 12
+
+
+@pytest.mark.parametrize('kwargs', [{'drop_blocked_rays': True}, {'backend': 'numba'}])
+def test_no_kick_steps(kwargs):
+    if kwargs.get('backend') == 'numba':
+        pytest.importorskip('numba')
+
+    # Dropped rays and the numba kernels always propagate the rays
+    models, move = make_models('wobbler', **kwargs)
+    move_and_step(models, move, range(1, 4))
+    assert models[0].kick_steps == 0
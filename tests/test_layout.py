@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import make_tem_components, make_4dstem_components, make_model, \
+    assert_same_as_full_trace
+
+'''Tests of changing the geometry of a column in place: moving a component
+(Model.update_z_positions) and inserting or removing one (Model.insert_component,
+Model.remove_component). The rays of a step must be those of a new model of the changed column.'''
+
+layout_kwargs = [{}, {'compact_rays': True}, {'keep_planes': ['Sample']}, {'defer_blocking': True},
+                 {'drop_blocked_rays': True}]
+
+
+def make_selected_area_aperture():
+    return comp.Aperture(name = 'Selected Area Aperture', z = 0.5, aperture_radius_inner = 0.02)
+
+
+def make_aperture_components():
+    components = make_tem_components()
+    components.insert(-1, make_selected_area_aperture())
+    return components
+
+
+def make_4dstem_model(sample_z):
+    model = Model(make_4dstem_components(sample_z), beam_z = 3.0, experiment = '4DSTEM',
+                  num_rays = 2**12 + 3)
+    model.set_obj_lens_f_from_overfocus(0.01)
+    return model
+
+
+def test_moved_sample():
+    model = make_4dstem_model(1.2)
+    model.step()
+    for sample_z in [1.25, 1.1]:
+        model.sample.z = sample_z
+        model.set_obj_lens_f_from_overfocus(0.01)
+        assert_same_as_full_trace(model, make_4dstem_model(sample_z))
+
+
+def test_moved_out_of_order():
+    model = make_model(make_tem_components)
+    model.step()
+
+    lens = model.components[4]
+    lens.z = 2.5
+    with pytest.raises(ValueError, match = lens.name):
+        model.step()
+
+    lens.z = 1.5
+    assert_same_as_full_trace(model, make_model(make_tem_components))
+
+
+@pytest.mark.parametrize('kwargs', layout_kwargs)
+def test_insert_and_remove(kwargs):
+    model = make_model(make_tem_components, **kwargs)
+    model.step()
+
+    model.insert_component(make_selected_area_aperture())
+    assert model.components[-2].name == 'Selected Area Aperture'
+    assert_same_as_full_trace(model, make_model(make_aperture_components, **kwargs))
+    assert np.any(model.get_blocked_at() == len(model.components) - 2)
+
+    model.remove_component('Selected Area Aperture')
+    assert_same_as_full_trace(model, make_model(make_tem_components, **kwargs))
@@ -0,0 +1,125 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import columns, make_models, make_4dstem_components, assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of the lens power polynomial (Model.set_variable_lenses), which evaluates the cumulative
+transfer matrices of every plane from the powers of the variable lenses. The matrices must be those
+of changing the lenses and multiplying the matrices of the column (Model.update_system_matrices of
+a model without variable lenses), and steps must give the rays of a full trace.'''
+
+focal_lengths = np.linspace(-0.3, -0.15, 8)
+
+
+def chain_series(model, params):
+    '''System matrices of the model changed to each configuration of params, given as for
+    lens_system_matrices, with one value of each parameter for each configuration'''
+    system_matrices = []
+    for k in range(len(focal_lengths)):
+        for component in model.components:
+            for parameter, values in params.get(component.name, {}).items():
+                setattr(component, parameter, values[k])
+            component.update_matrices()
+        model.update_component_matrix()
+        model.update_system_matrices()
+        system_matrices.append(model.system_matrices.copy())
+
+    return np.stack(system_matrices)
+
+
+def make_chain_models():
+    model, chain_model = make_models(columns['tem'], [{}, {}], 2**10)
+    model.set_variable_lenses()
+    return model, chain_model
+
+
+def test_every_power():
+    model, chain_model = make_chain_models()
+
+    # Every power of every lens, one at a time
+    for lens in model.components:
+        for parameter in lens.power_parameters:
+            params = {lens.name: {parameter: focal_lengths}}
+            chain_matrices = chain_series(chain_model, params)
+            assert np.allclose(model.lens_system_matrices(params), chain_matrices, atol = 1e-12)
+
+            # and the matrices of a step, which are evaluated from the polynomial
+            setattr(lens, parameter, focal_lengths[-1])
+            lens.update_matrices()
+            model.update_component_matrix()
+            model.update_system_matrices()
+            assert np.allclose(model.system_matrices, chain_matrices[-1], atol = 1e-12)
+
+
+def test_several_lenses():
+    model, chain_model = make_chain_models()
+    params = {'Objective Lens': {'f': focal_lengths},
+              'Objective Stig': {'fx': focal_lengths[::-1], 'fy': focal_lengths - 0.05},
+              'Projector Lens': {'f': focal_lengths + 0.05}}
+    assert np.allclose(model.lens_system_matrices(params), chain_series(chain_model, params),
+                       atol = 1e-12)
+
+
+def test_overfocus_series():
+    stem_chain_model, stem_model = [Model(make_4dstem_components(), beam_z = 3.0,
+                                          experiment = '4DSTEM', num_rays = 2**10)
+                                    for _ in range(2)]
+    stem_chain_model.set_variable_lenses([])
+
+    overfocus = np.linspace(0.01, 0.3, 8)
+    chain_matrices = []
+    for value in overfocus:
+        stem_chain_model.set_obj_lens_f_from_overfocus(value)
+        stem_chain_model.update_component_matrix()
+        stem_chain_model.update_system_matrices()
+        chain_matrices.append(stem_chain_model.system_matrices.copy())
+
+    assert np.allclose(stem_model.overfocus_system_matrices(overfocus), chain_matrices,
+                       atol = 1e-12)
+
+
+def test_no_variable_lenses():
+    model = make_models(columns['tem'], [{}], 2**10)[0]
+    with pytest.raises(ValueError):
+        model.lens_system_matrices()
+
+
+def test_changes():
+    model, chain_model = make_chain_models()
+    reference = make_models(columns['tem'], [{}], 2**10)[0]
+    params = {'Objective Lens': {'f': focal_lengths}}
+    model.step()
+
+    # A change of a component which is not variable finds the coefficients again
+    for m in [model, chain_model, reference]:
+        m.components[3].updefx = 0.02
+        m.components[3].set_matrices()
+    assert np.allclose(model.lens_system_matrices(params), chain_series(chain_model, params),
+                       atol = 1e-12)
+    assert_same_as_full_trace(model, reference)
+
+    for m in [model, reference]:
+        m.components[4].f = -0.25
+        m.components[4].set_matrix()
+    assert_same_as_full_trace(model, reference)
+
+    for m in [model, reference]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(model, reference)
+
+    for m in [model, chain_model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    assert 'Intermediate Lens' not in model.variable_lenses
+    assert np.allclose(model.lens_system_matrices(params), chain_series(chain_model, params),
+                       atol = 1e-12)
+    assert_same_as_full_trace(model, reference)
+
+    # Removed lenses are no longer variable
+    for m in [model, chain_model, reference]:
+        m.remove_component('Projector Lens')
+    assert 'Projector Lens' not in model.variable_lenses
+    assert np.allclose(model.lens_system_matrices(params), chain_series(chain_model, params),
+                       atol = 1e-12)
+    assert_same_as_full_trace(model, reference)
@@ -0,0 +1,71 @@
+import numpy as np
+
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.matrix_tree import MatrixProductTree
+from _common import make_tem_components, make_model
+
+'''Tests of the segment tree of matrix products (MatrixProductTree) and of the cumulative matrices
+of the planes of a model queried from it (Model.update_matrix_tree, Model.plane_matrix). They must
+be those of multiplying the matrices in order, also after a leaf, a parameter, a z position or the
+components of the column have changed.'''
+
+
+def ordered_product(matrices):
+    product = np.eye(matrices.shape[1])
+    for matrix in matrices:
+        product = matrix @ product
+    return product
+
+
+def test_products():
+    rng = np.random.default_rng(0)
+    matrices = rng.normal(size = (11, 5, 5))
+    tree = MatrixProductTree(matrices)
+
+    for idx in [3, 10, 0]:
+        matrices[idx] = rng.normal(size = (5, 5))
+        tree.update(idx, matrices[idx])
+        assert np.allclose(tree.leaf(idx), matrices[idx])
+        for start in range(len(matrices)):
+            for stop in range(start, len(matrices) + 1):
+                assert np.allclose(tree.product(start, stop),
+                                   ordered_product(matrices[start:stop]))
+
+
+def assert_same_plane_matrices(model):
+    model.update_component_matrix()
+    model.update_matrix_tree()
+    model.update_system_matrices()
+    for idx in range(model.steps):
+        assert np.allclose(model.plane_matrix(idx), model.system_matrices[idx], atol = 1e-12)
+
+
+def test_plane_matrices():
+    model = make_model(make_tem_components)
+    assert_same_plane_matrices(model)
+
+    model.components[4].f = -0.25
+    model.components[4].set_matrix()
+    assert_same_plane_matrices(model)
+
+    model.components[model.sample_idx].z = 1.25
+    assert_same_plane_matrices(model)
+
+    model.insert_component(comp.Aperture(name = 'Selected Area Aperture', z = 0.5,
+                                         aperture_radius_inner = 0.02))
+    assert_same_plane_matrices(model)
+    model.remove_component('Objective Stig')
+    assert_same_plane_matrices(model)
+
+
+def test_long_column():
+    # The detector matrix of a long column of lenses, after one lens in the middle has changed
+    components = [comp.Lens(name = 'Lens ' + str(idx), z = z, f = -10.0)
+                  for idx, z in enumerate(np.linspace(0.9, 0.1, 100))]
+    model = Model(components, beam_z = 1.0, beam_type = 'point', num_rays = 2**10)
+    assert_same_plane_matrices(model)
+
+    components[50].f = -9.0
+    components[50].set_matrix()
+    assert_same_plane_matrices(model)
@@ -0,0 +1,98 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import beam_moments
+from _common import sample, columns, make_models
+
+import numpy as np
+import pytest
+
+'''Tests of Model.propagate_moments(), which propagates the second moment matrix of the beam
+through the column instead of the rays. The moments of a plane are those of the gun propagated by
+the cumulative matrix of the plane, and the centroid, size and divergence of the traced rays
+converge to them as the number of rays grows.'''
+
+beam_types = ['paralell', 'point', 'axial', 'x_axial']
+
+
+def make_components():
+    return [comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.2),
+            comp.Quadrupole(name = 'Condenser Stig', z = 2.2, fx = -0.4, fy = 0.4),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, updefx = 0.01,
+                                 lowdefy = -0.02),
+            comp.Lens(name = 'Objective Lens', z = 1.5, f = -0.2),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.AstigmaticLens(name = 'Objective Stig', z = 1.0, fx = -0.3, fy = -0.35),
+            comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2)]
+
+
+def make_model(beam_type, num_rays = 2**16):
+    return Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = num_rays,
+                 gun_beam_semi_angle = 0.15, beam_radius = 0.1, beam_tilt_x = 0.01,
+                 beam_tilt_y = -0.02)
+
+
+def assert_same_as_rays(moments, model):
+    '''The moments match the statistics of the rays of a step, relative to the largest size and
+    slope of the column'''
+    r = model.step()
+    rms_size = r[:, [0, 2]].std(axis = 2)
+    divergence = r[:, [1, 3]].std(axis = 2)
+    size_scale = np.max(rms_size)
+    slope_scale = np.max(divergence)
+
+    assert np.max(np.abs(moments.centroid() - r[:, [0, 2]].mean(axis = 2))) < 1e-2*size_scale
+    assert np.max(np.abs(moments.rms_size() - rms_size)) < 1e-2*size_scale
+    assert np.max(np.abs(moments.divergence() - divergence)) < 1e-2*slope_scale
+
+    # Every beam comes from a point or is parallel, so it has no emittance, and the lenses and
+    # quadrupole (which do not couple x and y) keep it so at every plane
+    assert np.max(moments.emittance()) < 1e-6*size_scale*slope_scale
+
+
+@pytest.mark.parametrize('beam_type', beam_types)
+def test_propagate_moments(beam_type):
+    model = make_model(beam_type)
+    moments = model.propagate_moments()
+    assert moments.moments.shape == (model.steps, 5, 5)
+    assert_same_as_rays(moments, model)
+
+    # The moments of every plane are those of the gun moved by the matrices of the column, which
+    # holds for the moments of the traced rays as well
+    assert np.allclose(moments.moments[0], beam_moments(beam_type, 0.15, 0.1, 0.01, -0.02))
+    r = model.get_full_r()
+    ray_moments = np.einsum('pin,pjn->pij', r, r)/r.shape[-1]
+    assert np.allclose(ray_moments, model.system_matrices @ ray_moments[0]
+                       @ model.system_matrices.transpose(0, 2, 1), atol = 1e-12)
+
+
+def assert_same_as_new_model(model, reference):
+    moments = model.propagate_moments()
+    assert np.allclose(moments.moments, reference.propagate_moments().moments, atol = 1e-12)
+    assert_same_as_rays(moments, model)
+
+
+@pytest.mark.parametrize('beam_type', beam_types)
+def test_changes(beam_type):
+    model, reference = make_model(beam_type), make_model(beam_type)
+    model.propagate_moments()
+
+    for m in [model, reference]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_new_model(model, reference)
+
+    # The moments follow the beam of the model, as its rays do
+    for m in [model, reference]:
+        m.beam_tilt_x = -0.01
+        m.generate_rays()
+    assert_same_as_new_model(model, reference)
+
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    assert_same_as_new_model(model, reference)
+
+
+def test_not_affine():
+    model = make_models(columns['biprism'], [{}])[0]
+    with pytest.raises(ValueError):
+        model.propagate_moments()
@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+numba = pytest.importorskip('numba')
+
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import sample, columns, model_kwargs, make_tem_components, full_trace_images
+from _common import make_models as make_common_models
+
+'''Parity tests of the numba backend (Model(backend='numba')) against the NumPy path. The planes of
+the rays and the codes of the blocked rays of a step must match Model.update_rays_stepwise, for the
+whole column and from a plane part way down it, and the detector images of trace_chunked must match
+get_image_from_rays of the rays of a step.'''
+
+
+def make_symmetric_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.1),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.8),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Lens(name = 'Objective Lens', z = 1.0, f = -0.15),
+            comp.Aperture(name = 'Objective Aperture', z = 0.8, aperture_radius_inner = 0.03),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+
+model_kwargs = model_kwargs + [{'num_workers': 4}]
+
+
+def make_models(make_components, num_rays = 2**12 + 3, **kwargs):
+    return make_common_models(make_components, [{'backend': 'numpy'}, {'backend': 'numba'}],
+                              num_rays, **kwargs)
+
+
+def assert_same_rays(models):
+    atol = 1e-12 if models[0].dtype == np.float64 else 1e-5
+    assert np.allclose(models[0].get_full_r(), models[1].get_full_r(), atol = atol,
+                       equal_nan = True)
+    assert np.array_equal(models[0].get_blocked_at(), models[1].get_blocked_at())
+
+
+def change_projector(models):
+    for model in models:
+        model.components[-1].f = -0.25
+        model.update_component_matrix()
+
+
+def test_numba_column_compiles():
+    for make_components in columns.values():
+        assert make_models(make_components)[1].get_numba_column() is not None
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_step(column, kwargs):
+    models = make_models(columns[column], **kwargs)
+    for model in models:
+        model.update_rays_stepwise()
+    assert_same_rays(models)
+
+    # Change a component part way down the column, and step again from its plane
+    change_projector(models)
+    for model in models:
+        model.update_rays_stepwise(models[0].component_plane_idcs[-1])
+    assert_same_rays(models)
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs)
+@pytest.mark.parametrize('column', columns)
+def test_image(column, kwargs):
+    numpy_model, numba_model = models = make_models(columns[column], **kwargs)
+    images = full_trace_images(numpy_model)
+
+    # Chunks of a quarter of the beam, so that images of several chunks are merged
+    memory_budget = numba_model.estimate_ray_memory(numba_model.num_rays // 4, 1)
+    for model in models:
+        for chunked_image, image in zip(model.trace_chunked(memory_budget), images):
+            assert np.array_equal(chunked_image, image)
+
+
+@pytest.mark.parametrize('keep_planes', ['all', 'endpoints', ['Sample']])
+@pytest.mark.parametrize('column', columns)
+def test_keep_planes(column, keep_planes):
+    models = make_models(columns[column], keep_planes = keep_planes)
+    all_planes = make_models(columns[column])[0]
+    for model in models + [all_planes]:
+        model.step()
+    assert_same_rays(models)
+
+    # The kept planes are the planes of the full ray matrix
+    for model in models:
+        assert np.allclose(model.r, all_planes.r[model.r_planes], atol = 1e-12)
+
+
+@pytest.mark.parametrize('column', columns)
+def test_drop_blocked_rays(column):
+    models = make_models(columns[column], drop_blocked_rays = True)
+    for model in models:
+        model.step()
+    assert_same_rays(models)
+
+    change_projector(models)
+    for model in models:
+        model.step()
+    assert_same_rays(models)
+
+
+@pytest.mark.parametrize('column', columns)
+def test_deferred_blocking(column):
+    models = make_models(columns[column], defer_blocking = True) + make_models(columns[column])
+    for model in models:
+        model.step()
+
+    # The blocked rays are found when they are asked for, and are those of a step which finds them
+    for deferred_model, model in zip(models[:2], models[2:]):
+        assert np.array_equal(deferred_model.get_blocked_at(), model.get_blocked_at())
+    assert_same_rays(models[:2])
+
+
+@pytest.mark.parametrize('beam_type, beam_kwargs', [('paralell', {'beam_radius': 0.15}),
+                                                    ('point', {'gun_beam_semi_angle': 0.05})])
+def test_ring_tracing(beam_type, beam_kwargs):
+    models = [Model(make_symmetric_components(), beam_z = 3.0, beam_type = beam_type,
+                    num_rays = 2**10, detector_pixels = 256, backend = backend, **beam_kwargs)
+              for backend in ['numpy', 'numba']]
+    assert all(model.is_rotationally_symmetric() for model in models)
+
+    # The ring kernel rotates the rays of each ring as the NumPy path does
+    numpy_images, numba_images = [model.trace_chunked(num_rays = 2**16 + 5) for model in models]
+    for numpy_image, numba_image in zip(numpy_images, numba_images):
+        assert np.array_equal(numpy_image, numba_image)
+
+
+def test_thread_count_is_restored():
+    num_threads = numba.get_num_threads()
+    model = make_models(make_tem_components, num_workers = numba.config.NUMBA_NUM_THREADS + 1)[1]
+    model.step()
+    model.trace_chunked()
+    assert numba.get_num_threads() == num_threads
@@ -0,0 +1,55 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import make_models, make_4dstem_components, assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of single precision models (dtype = np.float32) and of Model.check_precision(), which
+compares the pixel coordinates of the rays of a model with those of a double precision trace.'''
+
+
+def make_4dstem_model(dtype, **kwargs):
+    return Model(make_4dstem_components(), beam_z = 3.0, beam_type = 'paralell', num_rays = 2**10,
+                 experiment = '4DSTEM', detector_pixels = 256, dtype = dtype, **kwargs)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_check_precision(dtype):
+    model = make_4dstem_model(dtype)
+    deviations = model.check_precision()
+
+    assert model.r.dtype == dtype
+    assert set(deviations) == {'detector', 'sample'}
+    if dtype == np.float64:
+        assert deviations == {'detector': 0, 'sample': 0}
+    else:
+        assert max(deviations.values()) <= 1
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'drop_blocked_rays': True}])
+def test_check_precision_keeps_rays(kwargs):
+    model, reference = make_models(make_4dstem_components, [kwargs, kwargs],
+                                   dtype = np.float32)
+    model.step()
+    r = model.r.copy()
+    model.check_precision()
+
+    # The rays of the model are kept, and are still up to date
+    assert model.r.dtype == np.float32
+    assert np.array_equal(model.r, r, equal_nan = True)
+    assert model.find_first_stale_plane() == model.steps
+
+    # and the model is still stepped from them
+    for m in [model, reference]:
+        m.components[1].f = -0.25
+        m.components[1].set_matrix()
+    assert_same_as_full_trace(model, reference)
+
+    for m in [model, reference]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_full_trace(model, reference)
+
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Projector Lens', z = 0.2, f = -0.2))
+    assert_same_as_full_trace(model, reference)
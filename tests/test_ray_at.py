@@ -0,0 +1,80 @@
+from temgymbasic import components as comp
+from _common import sample, columns, model_kwargs, make_models
+
+import numpy as np
+import pytest
+
+'''Tests of Model.ray_at(), which finds the rays of the last step at any z. The rays must be those
+of a model with a screen (a sample which does not change the rays) at each z.'''
+
+screen_z = {'tem': [2.5, 1.7, 1.1, 0.5, 0.1], 'biprism': [2.0, 1.3, 0.8, 0.1]}
+
+
+def add_screens(model, z_values):
+    for idx, z in enumerate(z_values):
+        model.insert_component(comp.Sample(name = 'Screen {}'.format(idx), sample = sample,
+                                           z = z))
+
+
+def assert_same_as_screens(model, reference, z_values):
+    model.step()
+    reference.step()
+    atol = 1e-12 if model.dtype == np.float64 else 1e-5
+
+    rays = model.ray_at(np.array(z_values))
+    for idx, z in enumerate(z_values):
+        screen_rays = reference.get_full_plane(reference.component_plane_idcs[
+            [component.name for component in reference.components].index('Screen {}'.format(idx))])
+        assert np.allclose(rays[idx], screen_rays, atol = atol, equal_nan = True)
+        assert np.allclose(model.ray_at(z), screen_rays, atol = atol, equal_nan = True)
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs + [
+    {'keep_planes': 'endpoints'}, {'drop_blocked_rays': True},
+    {'drop_blocked_rays': True, 'keep_planes': 'endpoints'}])
+@pytest.mark.parametrize('column', columns)
+def test_ray_at(column, kwargs):
+    model, reference = make_models(columns[column], [kwargs, dict(kwargs, keep_planes = 'all')])
+    add_screens(reference, screen_z[column])
+    assert_same_as_screens(model, reference, screen_z[column])
+
+    # At the z of a component, the rays leaving the component
+    if kwargs.get('keep_planes', 'all') == 'all':
+        idx = model.sample_plane_idx
+        assert np.array_equal(model.ray_at(model.z_positions[idx]), model.get_full_plane(idx),
+                              equal_nan = True)
+
+
+def test_outside_column():
+    model = make_models(columns['tem'], [{}])[0]
+    model.step()
+
+    # Rays above the gun and below the detector are extrapolated
+    for z, distance, r in [(model.beam_z + 0.5, 0.5, model.r[0]), (-0.5, -0.5, model.r[-1])]:
+        rays = model.ray_at(z)
+        assert np.allclose(rays[0], r[0] + distance*r[1])
+        assert np.allclose(rays[2], r[2] + distance*r[3])
+        assert np.array_equal(rays[[1, 3]], r[[1, 3]])
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'keep_planes': 'endpoints'}, {'drop_blocked_rays': True}])
+@pytest.mark.parametrize('column', columns)
+def test_changes(column, kwargs):
+    model, reference = make_models(columns[column], [kwargs, dict(kwargs, keep_planes = 'all')])
+    add_screens(reference, screen_z[column])
+    model.step()
+
+    # The last component of the reference is a screen
+    for m in [model, reference]:
+        lens = [component for component in m.components if component.name == 'Projector Lens'][0]
+        lens.f = -0.25
+        lens.set_matrix()
+    assert_same_as_screens(model, reference, screen_z[column])
+
+    for m in [model, reference]:
+        m.r[0, 1, :] += 0.01
+    assert_same_as_screens(model, reference, screen_z[column])
+
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.4, f = -0.3))
+    assert_same_as_screens(model, reference, screen_z[column])
@@ -0,0 +1,99 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from _common import assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of the ray layouts of Model.update_rays_stepwise(). The separable layout propagates x and
+y as independent 2-row systems, the x-only layout propagates x alone, and the compact layout
+drops the row of ones from the ray matrix. Each must give the rays of the coupled layout, which
+propagates x and y together.'''
+
+
+def make_components():
+    return [comp.Lens(name = '1st Condenser Lens', z = 1.5, f = -0.2),
+            comp.Aperture(name = 'Condenser Aperture', z = 1.3, aperture_radius_inner = 0.05),
+            comp.Lens(name = '2nd Condenser Lens', z = 1.1, f = -0.5),
+            comp.Deflector(name = 'Deflector', z = 0.9, defx = 0.01, defy = 0),
+            comp.Lens(name = 'Objective Lens', z = 0.7, f = -0.2),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+
+def coupled_axes(gun_rays = None):
+    return [(0, 2)]
+
+
+def make_model(beam_type, coupled = False, **kwargs):
+    model = Model(make_components(), beam_z = 2, beam_type = beam_type, num_rays = 2**10,
+                  gun_beam_semi_angle = 0.1, **kwargs)
+
+    # Small enough tiles of rays are propagated coupled, which is not what is tested here
+    model.separable_axes_min_rays = 1
+    if coupled:
+        model.get_ray_axes = coupled_axes
+    return model
+
+
+def test_get_ray_axes():
+    model = make_model('point')
+    model.update_component_matrix()
+    assert model.get_ray_axes() == [(0,), (2,)]
+
+    model = make_model('x_axial')
+    model.update_component_matrix()
+    assert model.get_ray_axes() == [(0,)]
+
+    # Rays are propagated in y once they have a y component
+    assert model.get_ray_axes(model.r[0] + np.array([[0], [0], [0], [0.01], [0]])) == [(0,), (2,)]
+
+    # or once they are deflected in y
+    model.components[3].defy = 0.01
+    model.components[3].set_matrix()
+    model.update_component_matrix()
+    assert model.get_ray_axes() == [(0,), (2,)]
+
+    # A scan rotation couples x and y
+    model.insert_component(comp.DoubleDeflector(name = 'Scan Coils', z_up = 1.0, z_low = 0.95,
+                                                scan_rotation = 30))
+    model.update_component_matrix()
+    assert model.get_ray_axes() == [(0, 2)]
+
+
+@pytest.mark.parametrize('beam_type', ['point', 'x_axial'])
+def test_layouts(beam_type):
+    coupled = make_model(beam_type, coupled = True)
+    separable = make_model(beam_type)
+    compact = make_model(beam_type, compact_rays = True)
+    for model in [coupled, separable, compact]:
+        model.update_rays_stepwise()
+
+    assert np.allclose(coupled.r, separable.r)
+    assert np.allclose(coupled.r[:, :4], compact.r)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'compact_rays': True}])
+@pytest.mark.parametrize('beam_type', ['point', 'x_axial'])
+def test_changes(beam_type, kwargs):
+    model = make_model(beam_type, **kwargs)
+    reference = make_model(beam_type, coupled = True, **kwargs)
+    model.step()
+
+    # A kick in y must be propagated, even by the x-only layout of the 'x_axial' beam
+    for m in [model, reference]:
+        m.components[3].defy = 0.01
+        m.components[3].set_matrix()
+    assert_same_as_full_trace(model, reference)
+
+    # as must the y slopes of edited gun rays
+    for m in [model, reference]:
+        m.components[3].defy = 0
+        m.components[3].set_matrix()
+        m.r[0, 3, :] += 0.01
+    assert_same_as_full_trace(model, reference)
+
+    # and a component which couples x and y
+    for m in [model, reference]:
+        m.insert_component(comp.DoubleDeflector(name = 'Scan Coils', z_up = 1.0, z_low = 0.95,
+                                                updefy = 0.01, scan_rotation = 30))
+    assert_same_as_full_trace(model, reference)
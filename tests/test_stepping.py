@@ -0,0 +1,47 @@
+import numpy as np
+
+from temgymbasic.model import Model
+from _common import make_tem_components, make_4dstem_components, make_model, legacy_planes
+
+'''Tests of stepping the rays through the column with the cached propagation matrices of the model
+(Model.update_propagation_matrices, Model.update_rays_stepwise). The rays of every plane must be
+those of the original stepping loop, also after a parameter or a z position has changed.'''
+
+
+def make_4dstem_model():
+    return Model(make_4dstem_components(), beam_z = 3.0, experiment = '4DSTEM',
+                 num_rays = 2**12 + 3)
+
+
+def test_step_matches_legacy_loop():
+    for model in [make_model(make_tem_components), make_4dstem_model()]:
+        model.update_rays_stepwise()
+        assert np.allclose(model.r, legacy_planes(model), atol = 1e-12)
+
+
+def test_changed_parameter():
+    model = make_model(make_tem_components)
+    model.step()
+
+    model.components[4].f = -0.25
+    model.components[4].set_matrix()
+    model.step()
+    assert np.allclose(model.r, legacy_planes(model), atol = 1e-12)
+
+
+def test_changed_z():
+    model = make_4dstem_model()
+    model.step()
+    propagation_matrices = model.propagation_matrices.copy()
+
+    # Only the gaps on either side of the sample get new propagation matrices
+    model.sample.z = 1.25
+    model.step()
+    sample_plane_idx = model.sample_plane_idx
+    changed = np.any(model.propagation_matrices != propagation_matrices, axis = (1, 2))
+    assert np.array_equal(np.flatnonzero(changed), [sample_plane_idx - 1, sample_plane_idx])
+    assert np.allclose(model.r, legacy_planes(model), atol = 1e-12)
+
+    model.beam_z = 3.5
+    model.step()
+    assert np.allclose(model.r, legacy_planes(model), atol = 1e-12)
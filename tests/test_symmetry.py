@@ -0,0 +1,139 @@
+from temgymbasic import components as comp
+from temgymbasic.model import Model
+from temgymbasic.functions import rotate_ring_rays
+from _common import sample, assert_same_as_full_trace, full_trace_images
+
+import numpy as np
+import pytest
+
+'''Tests of tracing rotationally symmetric columns (round lenses, centred apertures and a sample)
+from one ray of each ring of the beam (Model.trace_rings), as Model.trace_chunked does. The rotated
+rays and blocked rays must be those of tracing every ray, and the images must be the same apart
+from the few pixels where the rounding of a rotated ray puts it in the neighbouring pixel. Anything
+which breaks the symmetry must trace every ray.'''
+
+
+def make_components():
+    return [comp.Aperture(name = 'Condenser Aperture', z = 2.6, aperture_radius_inner = 0.1),
+            comp.Lens(name = '1st Condenser Lens', z = 2.3, f = -0.8),
+            comp.DoubleDeflector(name = 'Beam Tilt', z_up = 2.0, z_low = 1.9, scan_rotation = 10),
+            comp.Sample(name = 'Sample', sample = sample, z = 1.2),
+            comp.Lens(name = 'Objective Lens', z = 1.0, f = -0.15),
+            comp.Aperture(name = 'Objective Aperture', z = 0.8, aperture_radius_inner = 0.03),
+            comp.Lens(name = 'Projector Lens', z = 0.3, f = -0.1)]
+
+
+beams = {'paralell': {'beam_radius': 0.15}, 'point': {'gun_beam_semi_angle': 0.05}}
+
+
+def make_model(beam_type, **kwargs):
+    return Model(make_components(), beam_z = 3.0, beam_type = beam_type, num_rays = 2**12 + 3,
+                 detector_pixels = 256, **beams[beam_type], **kwargs)
+
+
+def get_component(model, name):
+    return model.components[[component.name for component in model.components].index(name)]
+
+
+def assert_same_as_every_ray(model, reference):
+    '''The images of the model traced from rings, against a full trace of every ray of the
+    reference'''
+    ray_image, sample_image, blocked_ray_counts = model.trace_chunked()
+    every_ray_image, every_sample_image, every_blocked_ray_counts = full_trace_images(reference)
+    assert np.array_equal(blocked_ray_counts, every_blocked_ray_counts)
+
+    pixels_off = (np.count_nonzero(ray_image != every_ray_image)
+                  + np.count_nonzero(sample_image != every_sample_image))
+    lit_pixels = np.count_nonzero((every_ray_image > 0) | (every_sample_image != 0))
+    assert lit_pixels > 0
+    assert pixels_off <= 1e-3*lit_pixels
+
+
+def assert_rings_same_as_every_ray(model):
+    model.step()
+    ring_r, ring_blocked_at = model.trace_rings(list(range(model.steps)))
+    rings, t = model.ring_coords(0, model.num_rays)
+
+    r = model.get_full_r()
+    assert np.allclose(rotate_ring_rays(ring_r, rings, t, np.empty_like(r)), r, atol = 1e-12)
+    assert np.array_equal(ring_blocked_at[rings], model.get_blocked_at())
+
+
+@pytest.mark.parametrize('beam_type', beams)
+def test_trace_rings(beam_type):
+    assert_rings_same_as_every_ray(make_model(beam_type))
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+@pytest.mark.parametrize('beam_type', beams)
+def test_trace_chunked(beam_type, backend):
+    if backend == 'numba':
+        pytest.importorskip('numba')
+
+    model, reference = make_model(beam_type, backend = backend), make_model(beam_type)
+    assert model.is_rotationally_symmetric()
+    assert_same_as_every_ray(model, reference)
+
+
+def test_not_symmetric():
+    model = make_model('point')
+    assert model.is_rotationally_symmetric()
+
+    model.components.append(comp.AstigmaticLens(name = 'Projector Stig', z = 0.2, fx = -2.0,
+                                                fy = -2.2))
+    assert not model.is_rotationally_symmetric()
+
+    model = make_model('point')
+    get_component(model, 'Objective Aperture').x = 0.01
+    assert not model.is_rotationally_symmetric()
+
+    model = make_model('point')
+    beam_tilt = get_component(model, 'Beam Tilt')
+    beam_tilt.updefx = 0.01
+    beam_tilt.set_matrices()
+    assert not model.is_rotationally_symmetric()
+
+    model = make_model('point', beam_tilt_x = 0.01)
+    assert not model.is_rotationally_symmetric()
+
+    model = Model(make_components(), beam_z = 3.0, beam_type = 'axial', num_rays = 2**10)
+    assert not model.is_rotationally_symmetric()
+
+
+@pytest.mark.parametrize('beam_type', beams)
+def test_changes(beam_type):
+    model, reference = make_model(beam_type), make_model(beam_type)
+    model.trace_chunked()
+
+    for m in [model, reference]:
+        m.components[-1].f = -0.12
+        m.components[-1].set_matrix()
+    assert_same_as_every_ray(model, reference)
+    assert_rings_same_as_every_ray(model)
+
+    for m in [model, reference]:
+        get_component(m, 'Objective Aperture').aperture_radius_inner = 0.02
+    assert_same_as_every_ray(model, reference)
+    assert_rings_same_as_every_ray(model)
+
+    # A round lens keeps the column symmetric
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    assert model.is_rotationally_symmetric()
+    assert_same_as_every_ray(model, reference)
+    assert_rings_same_as_every_ray(model)
+
+    # A stigmator does not, and every ray is traced
+    for m in [model, reference]:
+        m.insert_component(comp.AstigmaticLens(name = 'Projector Stig', z = 0.2, fx = -2.0,
+                                               fy = -2.2))
+    assert not model.is_rotationally_symmetric()
+    for chunked_image, image in zip(model.trace_chunked(), full_trace_images(reference)):
+        assert np.array_equal(chunked_image, image)
+
+    # Edited rays of the model are stepped from, and are not lost by a chunked trace
+    for m in [model, reference]:
+        m.remove_component('Projector Stig')
+        m.r[0, 1, :] += 0.01
+    model.trace_chunked()
+    assert_same_as_full_trace(model, reference)
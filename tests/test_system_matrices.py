@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from temgymbasic import components as comp
+from _common import make_tem_components, make_biprism_components, make_model, make_models, \
+    legacy_planes
+
+'''Tests of the column compiled into a cumulative transfer matrix for every plane
+(Model.update_system_matrices), and of computing only some planes from them (Model.step_planes).
+The planes must be those of stepping the rays through the whole column, also after a parameter,
+the gun rays or the components of the column have changed.'''
+
+
+def change_lens(model):
+    model.components[4].f = -0.25
+    model.components[4].set_matrix()
+
+
+def edit_gun_rays(model):
+    model.r[0, 1, :] += 0.01
+
+
+def insert_aperture(model):
+    model.insert_component(comp.Aperture(name = 'Selected Area Aperture', z = 0.5,
+                                         aperture_radius_inner = 0.02))
+
+
+def test_system_matrices():
+    model = make_model(make_tem_components)
+    for change in [None, change_lens, insert_aperture]:
+        if change is not None:
+            change(model)
+        model.update_component_matrix()
+        model.update_system_matrices()
+        assert np.allclose(model.system_matrices @ model.r[0], legacy_planes(model),
+                           atol = 1e-12)
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'keep_planes': ['Sample']}, {'compact_rays': True}])
+def test_step_planes(kwargs):
+    model, reference = make_models(make_tem_components, [kwargs, kwargs])
+    for change in [None, change_lens, edit_gun_rays, insert_aperture]:
+        for m in [model, reference]:
+            if change is not None:
+                change(m)
+        model.step_planes()
+        reference.update_rays_stepwise()
+
+        for idx in [model.sample_plane_idx, -1]:
+            r_idx = model.plane_r_idx(idx)
+            assert np.allclose(model.r[r_idx], reference.r[r_idx], atol = 1e-12)
+        assert np.array_equal(model.get_blocked_at(), reference.get_blocked_at())
+
+
+def test_step_planes_biprism():
+    # The biprism is not affine, so every plane is stepped instead
+    model, reference = make_models(make_biprism_components, [{}, {}])
+    model.step_planes()
+    reference.update_rays_stepwise()
+    assert np.allclose(model.r, reference.r, atol = 1e-12)
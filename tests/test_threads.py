@@ -0,0 +1,62 @@
+from temgymbasic import components as comp
+from _common import columns, model_kwargs, make_models, assert_same_as_full_trace
+
+import numpy as np
+import pytest
+
+'''Tests of tiled ray propagation on a thread pool (Model(num_workers=...)). The rays and blocked
+rays of every worker count and tile size must be identical to those of untiled serial
+propagation, for a whole trace and for the steps after a change.'''
+
+num_rays = 2**12 + 3
+tiled_kwargs = [{'num_workers': workers, 'tile_size': 2**9} for workers in [1, 2, 4]]
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs + [{'drop_blocked_rays': True}])
+@pytest.mark.parametrize('column', columns)
+def test_identical_rays(column, kwargs):
+    serial, *models = make_models(columns[column], [{'tile_size': num_rays}] + tiled_kwargs,
+                                  num_rays, **kwargs)
+    for model in [serial] + models:
+        model.update_rays_stepwise()
+
+    for model in models:
+        assert np.array_equal(model.r, serial.r, equal_nan = True)
+        assert np.array_equal(model.get_blocked_at(), serial.get_blocked_at())
+
+
+@pytest.mark.parametrize('column', columns)
+def test_changes(column):
+    for kwargs in tiled_kwargs:
+        model, reference = make_models(columns[column], [kwargs, {'tile_size': num_rays}],
+                                       num_rays)
+        model.step()
+
+        for m in [model, reference]:
+            m.components[-1].f = -0.25
+            m.components[-1].set_matrix()
+        assert_same_as_full_trace(model, reference)
+
+        for m in [model, reference]:
+            m.r[0, 1, :] += 0.01
+        assert_same_as_full_trace(model, reference)
+
+        for m in [model, reference]:
+            m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+        assert_same_as_full_trace(model, reference)
+
+
+def test_worker_count_change():
+    model, reference = make_models(columns['tem'], [tiled_kwargs[0], {'tile_size': num_rays}],
+                                   num_rays)
+    model.step()
+    pool = model.get_thread_pool()
+
+    # The thread pool is created again when the number of workers changes
+    model.num_workers = 4
+    assert model.get_thread_pool() is not pool
+    assert model.get_thread_pool()._max_workers == 4
+    for m in [model, reference]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    assert_same_as_full_trace(model, reference)
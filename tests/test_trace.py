@@ -0,0 +1,88 @@
+from temgymbasic import components as comp
+from _common import columns, model_kwargs, make_models, set_params
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+'''Tests of Model.trace(), which traces rays through the column with changed parameters without
+changing the model or its components. A trace must give the rays and blocked rays of a model with
+the same parameters, and must leave the model up to date, so that traces can run from many
+threads at once.'''
+
+params = {'tem': {'Objective Lens': {'f': -0.25}, 'Beam Tilt': {'updefx': 0.02}},
+          'biprism': {'Objective Lens': {'f': -0.4}, 'Image Shift': {'defx': 0.02}}}
+
+
+def assert_same_as_trace(result, reference):
+    reference.update_rays_stepwise()
+    atol = 1e-12 if reference.dtype == np.float64 else 1e-5
+    assert np.allclose(result.r, reference.r, atol = atol)
+    assert np.array_equal(result.blocked_at, reference.get_blocked_at())
+    assert np.array_equal(result.allowed_ray_bools(), reference.allowed_ray_bools())
+
+
+@pytest.mark.parametrize('kwargs', model_kwargs + [{'num_workers': 2, 'tile_size': 2**9}])
+@pytest.mark.parametrize('column', columns)
+def test_trace(column, kwargs):
+    model, reference = make_models(columns[column], [kwargs, kwargs])
+    model.step()
+    r = model.r.copy()
+    versions = [component.update_version() for component in model.components]
+
+    result = model.trace(params = params[column])
+    set_params(reference, params[column])
+    assert_same_as_trace(result, reference)
+    assert np.array_equal(result.component_rays('Sample'), reference.component_rays('Sample'))
+
+    # The model and its components are not changed
+    assert np.array_equal(model.r, r, equal_nan = True)
+    assert [component.update_version() for component in model.components] == versions
+    assert model.find_first_stale_plane() == model.steps
+
+
+@pytest.mark.parametrize('column', columns)
+def test_changes(column):
+    model, reference = make_models(columns[column], [{}, {}])
+    model.step()
+
+    # Rays given to the trace
+    rays = model.r[0].copy()
+    rays[1] += 0.01
+    reference.r[0, 1, :] += 0.01
+    assert_same_as_trace(model.trace(rays), reference)
+
+    # A change of the model
+    for m in [model, reference]:
+        m.components[-1].f = -0.25
+        m.components[-1].set_matrix()
+    reference.r[0, 1, :] -= 0.01
+    assert_same_as_trace(model.trace(), reference)
+
+    # A layout edit of the model
+    for m in [model, reference]:
+        m.insert_component(comp.Lens(name = 'Intermediate Lens', z = 0.5, f = -0.3))
+    result = model.trace(params = params[column])
+    set_params(reference, params[column])
+    assert_same_as_trace(result, reference)
+
+
+def test_concurrent_traces():
+    model = make_models(columns['tem'], [{}])[0]
+    sweep = [{'Objective Lens': {'f': f}} for f in np.linspace(-0.3, -0.15, 16)]
+    serial = [model.trace(params = p) for p in sweep]
+
+    with ThreadPoolExecutor(max_workers = 4) as pool:
+        results = list(pool.map(lambda p: model.trace(params = p), sweep))
+
+    for result, serial_result in zip(results, serial):
+        assert np.array_equal(result.r, serial_result.r)
+        assert np.array_equal(result.blocked_at, serial_result.blocked_at)
+
+
+def test_unknown_parameters():
+    model = make_models(columns['tem'], [{}])[0]
+    with pytest.raises(ValueError):
+        model.trace(params = {'Intermediate Lens': {'f': -0.2}})
+    with pytest.raises(AttributeError):
+        model.trace(params = {'Objective Lens': {'focus': -0.2}})